@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Offline benchmarks of the `trainline` package, on generated responses."""
+
+# To be run from the repository root with : python3 -m pytest benchmarks
+# (see benchmarks/README.md to compare with the baseline)
+
+import copy
+import io
+import json
+import sys
+import tracemalloc
+
+import pytest
+
+import trainline
+from trainline import Folders
+
+from make_responses import DAY_SEARCH, day_passenger
+
+_FROM_DATE = "15/10/2018 00:00"
+_TO_DATE = "15/10/2018 23:59"
+
+
+def test_json_decode(benchmark, response_text):
+    benchmark(json.loads, response_text)
+
+
+def test_get_folders(benchmark, response_text):
+    # _get_folders modifies the decoded response, so decode it every round
+    folders = benchmark.pedantic(
+        trainline._get_folders,
+        setup=lambda: ((json.loads(response_text),), {}),
+        rounds=20)
+    assert len(folders) > 0
+
+
+def test_get_folders_filtered(benchmark, responses):
+    # Parse of the large response for 2 hours of departures : the other
+    # folders are rejected on their raw fields, before any object is built
+    folder_filter = trainline._FolderFilter(
+        from_date_obj=trainline._str_datetime_to_datetime_obj(
+            "15/10/2018 08:00", date_format=trainline._READABLE_DATE_FORMAT),
+        to_date_obj=trainline._str_datetime_to_datetime_obj(
+            "15/10/2018 10:00", date_format=trainline._READABLE_DATE_FORMAT))
+    response_text = responses["large"]
+    folders = benchmark.pedantic(
+        trainline._get_folders,
+        setup=lambda: ((json.loads(response_text), folder_filter), {}),
+        rounds=20)
+    assert 0 < len(folders) < 50
+
+
+def test_project_folders(benchmark, response_text):
+    # Same response as test_get_folders, read into rows of a few fields
+    # instead of Folder objects (search(fields=...))
+    rows = benchmark.pedantic(
+        trainline._project_folders,
+        setup=lambda: ((json.loads(response_text),
+                        ("departure_date", "price", "currency")), {}),
+        rounds=20)
+    assert len(rows) > 0
+
+
+def test_search_fields(benchmark, replayed_day):
+    # Same search as test_search, returning rows instead of Folders
+    rows = benchmark(
+        trainline.search,
+        passengers=[day_passenger()],
+        trainline_session=replayed_day,
+        fields=("departure_date", "price", "currency"),
+        **DAY_SEARCH)
+    assert len(rows) > 0
+
+
+def _string_bytes(folders):
+    """ Returns the memory (in bytes) of the distinct strings referenced by
+    the folders, their trips, segments and comfort classes """
+    sizes = {}
+    objects = list(folders)
+    while objects:
+        obj = objects.pop()
+        for value in vars(obj).values():
+            if type(value) is str:
+                sizes[id(value)] = sys.getsizeof(value)
+        objects += getattr(obj, "trips", []) + \
+            getattr(obj, "segments", []) + getattr(obj, "comfort_classes", [])
+    return sum(sizes.values())
+
+
+def test_value_pool_memory(benchmark, responses):
+    # 20 pages of the large response (5000 folders), parsed with a value
+    # pool shared by the pages (like a session), compared to without
+    response_text = responses["large"]
+
+    def parse_pages(value_pool=None):
+        return [folder for _ in range(20)
+                for folder in trainline._get_folders(
+                    json.loads(response_text), value_pool=value_pool)]
+    folders = benchmark.pedantic(
+        parse_pages, args=(trainline.ValuePool(),), rounds=3)
+    pooled_bytes = _string_bytes(folders)
+    unpooled_bytes = _string_bytes(parse_pages())
+    benchmark.extra_info["string_bytes"] = pooled_bytes
+    benchmark.extra_info["string_bytes_without_pool"] = unpooled_bytes
+    assert pooled_bytes < 0.75 * unpooled_bytes
+
+
+def _peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _parse_text(content):
+    return trainline._get_folders(json.loads(content.decode("utf8")))
+
+
+def test_parse_stream(benchmark, responses):
+    # Incremental parse of the large response (search(stream=True)),
+    # compared to the text + decoded json tree + objects of a json.loads
+    streaming = pytest.importorskip("trainline.streaming")
+    content = responses["large"].encode("utf8")
+
+    def parse_stream(content):
+        return streaming.parse_search_results(io.BytesIO(content)).folders
+    folders = benchmark.pedantic(parse_stream, args=(content,), rounds=20)
+    assert len(folders) == len(_parse_text(content))
+    stream_peak = _peak_memory(parse_stream, content)
+    text_peak = _peak_memory(_parse_text, content)
+    benchmark.extra_info["peak_memory"] = stream_peak
+    benchmark.extra_info["peak_memory_json_loads"] = text_peak
+    assert stream_peak < text_peak
+
+
+def test_to_pandas(benchmark, large_folders):
+    pytest.importorskip("pyarrow")
+    pytest.importorskip("pandas")
+    df = benchmark(Folders(large_folders).to_pandas)
+    assert len(df) == len(large_folders)
+
+
+def test_to_pandas_from_dicts(benchmark, large_folders):
+    # Baseline of test_to_pandas : one dict per folder, then a DataFrame
+    pandas = pytest.importorskip("pandas")
+
+    def from_dicts(folders):
+        return pandas.DataFrame([{
+            "id": folder.id,
+            "departure_date": folder.departure_date_obj,
+            "arrival_date": folder.arrival_date_obj,
+            "price": folder.price,
+            "currency": folder.currency,
+            "transportation_mean": folder.transportation_mean,
+            "segment_nb": folder.segment_nb,
+        } for folder in folders])
+    df = benchmark(from_dicts, large_folders)
+    assert len(df) == len(large_folders)
+
+
+def test_archive_add(benchmark, fares_archive, large_folders):
+    # 20 observations of the large response (5000 folders, about 40 000
+    # rows) added to an archive of millions of rows
+    def add_observations():
+        for _ in range(20):
+            fares_archive.add(large_folders)
+    benchmark.pedantic(add_observations, rounds=5)
+    benchmark.extra_info["archived_folders"] = len(fares_archive)
+
+
+def test_archive_price_history(benchmark, fares_archive, large_folders):
+    folder = large_folders[0]
+    history = benchmark(fares_archive.price_history,
+                        folder.departure_station_id,
+                        folder.arrival_station_id,
+                        "15/10/2018 08:00", "15/10/2018 10:00")
+    assert len(history) >= 1000
+
+
+def test_archive_train_prices(benchmark, fares_archive, large_folders):
+    segment = large_folders[0].trips[0].segments[0]
+    prices = benchmark(fares_archive.train_prices, segment.train_number,
+                       segment.departure_date_obj.date())
+    assert len(prices) >= 1000
+
+
+def test_filter_folders(benchmark, large_folders):
+    folder_list = large_folders
+    from_date_obj = trainline._str_datetime_to_datetime_obj(
+        _FROM_DATE, date_format=trainline._READABLE_DATE_FORMAT)
+    to_date_obj = trainline._str_datetime_to_datetime_obj(
+        "15/10/2018 18:00", date_format=trainline._READABLE_DATE_FORMAT)
+    filtered = benchmark(
+        trainline._filter_folders, folder_list=folder_list,
+        from_date_obj=from_date_obj, to_date_obj=to_date_obj,
+        transportation_mean="train", max_price=150,
+        bicycle_with_or_without_reservation=True)
+    assert len(filtered) < len(folder_list)
+
+
+def test_dedup(benchmark, day_pages):
+    folder_list = []
+    for page in copy.deepcopy(day_pages):
+        folder_list += trainline._get_folders(page)
+    deduplicated = benchmark(lambda: list(set(folder_list)))
+    assert len(deduplicated) < len(folder_list)
+
+
+def test_folders_csv(benchmark, large_folders):
+    folders = Folders(large_folders)
+    csv_str = benchmark(folders.csv)
+    assert len(csv_str.split("\n")) == len(folders) + 2
+
+
+def test_get_station_id(benchmark):
+    # Station at the end of the stations file (worst case of the lookup)
+    station_name = trainline._read_file(
+        trainline._STATIONS_CSV).strip().split("\n")[-1].split(";", 1)[1]
+    benchmark(trainline.get_station_id, station_name)
+
+
+def test_search_payload(benchmark):
+    # Payload of one page (the template is serialized once per search)
+    session = trainline.Trainline()
+    payload = session._search_payload(
+        "5311", "828", [day_passenger().get_dict() for _ in range(4)])
+    benchmark(payload.render, "2018-10-15T08:00:00+0200")
+
+
+def test_search(benchmark, replayed_day):
+    results = benchmark(
+        trainline.search,
+        passengers=[day_passenger()],
+        trainline_session=replayed_day,
+        **DAY_SEARCH)
+    assert len(results) > 0
+
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_search_many(benchmark, replayed_day, processes):
+    # 8 searches of the recorded day, with 4 threads, parsed in the threads
+    # or in 2 processes (to compare on a machine with several cores)
+    from trainline import batch
+    searches = [dict(DAY_SEARCH, passengers=[day_passenger()])] * 8
+
+    def search_many():
+        return list(batch.search_many(
+            searches, trainline_session=replayed_day, processes=processes,
+            fields=trainline.PROJECTION_FIELDS))
+    results = benchmark.pedantic(search_many, rounds=5)
+    assert all(result.error is None for result in results)
+
+
+@pytest.mark.parametrize("workers", [1, 7])
+def test_fare_calendar(benchmark, workers):
+    # A week of fares from the stub server (50 ms per response), one day at
+    # a time or all the days at once
+    from trainline import batch, stubserver
+    with stubserver.StubServer(page_size=30, latency=0.05) as stub:
+        session = trainline.Trainline(transport=stub.transport())
+        calendar = benchmark.pedantic(
+            batch.fare_calendar,
+            args=("Toulouse Matabiau", "Bordeaux St-Jean", "15/10/2018", 7),
+            kwargs={"trainline_session": session, "workers": workers},
+            rounds=3)
+    assert all(day.cheapest is not None for day in calendar)
+
+
+@pytest.mark.parametrize("workers", [1, 7])
+def test_search_city(benchmark, workers):
+    # The 7 stations of Lyon to Bordeaux St-Jean on the stub server (50 ms
+    # per response), one station pair at a time or all the pairs at once
+    from trainline import batch, stubserver
+    with stubserver.StubServer(page_size=30, latency=0.05) as stub:
+        session = trainline.Trainline(transport=stub.transport())
+        folders = benchmark.pedantic(
+            batch.search_city,
+            args=("Lyon", ["Bordeaux St-Jean"], "15/10/2018 08:00",
+                  "15/10/2018 12:00"),
+            kwargs={"trainline_session": session, "workers": workers},
+            rounds=3)
+    assert len(folders) > 0
+
+
+def test_pair_round_trips(benchmark, large_folders):
+    # 10 cheapest combinations of 250 outbounds and 250 inbounds of a day
+    from trainline import batch
+    round_trips = benchmark(batch.pair_round_trips, large_folders,
+                            large_folders, max_total_price=300)
+    assert len(round_trips) == 10
+
+
+def test_pair_round_trips_nested(benchmark, large_folders):
+    # Baseline of test_pair_round_trips : every combination, then sorted
+    def pair(outbounds, inbounds):
+        return sorted(
+            ((outbound.price + inbound.price, outbound, inbound)
+             for outbound in outbounds for inbound in inbounds
+             if inbound.departure_date_obj >= outbound.arrival_date_obj and
+             outbound.price + inbound.price <= 300),
+            key=lambda round_trip: round_trip[0])[:10]
+    round_trips = benchmark(pair, large_folders, large_folders)
+    assert len(round_trips) == 10
+
+
+def test_replay_transport(benchmark, replayed_day):
+    # Requests served per second by the replay transport alone
+    cassette = replayed_day.transport.cassette
+    method, url, payload = next(iter(cassette._responses))
+
+    def replay_requests():
+        for _ in range(1000):
+            replayed_day.transport.post(url=url, data=payload)
+    benchmark(replay_requests)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Fixtures for the offline benchmarks of the `trainline` package."""
+
+import json
+
+import pytest
+import trainline
+from trainline import transport
+
+from make_responses import build_responses, record_day_search
+
+RESPONSE_SIZES = ["small", "medium", "large"]
+
+
+@pytest.fixture(scope="session")
+def responses():
+    """ Returns the responses of the benchmarks, as json strings (built
+    once, from a fixed seed) """
+    return {name: json.dumps(content, ensure_ascii=False)
+            for name, content in build_responses().items()}
+
+
+@pytest.fixture(params=RESPONSE_SIZES)
+def response_text(request, responses):
+    return responses[request.param]
+
+
+@pytest.fixture
+def large_folders(responses):
+    return trainline._get_folders(json.loads(responses["large"]))
+
+
+@pytest.fixture(scope="session")
+def day_pages(responses):
+    return json.loads(responses["day_pages"])
+
+
+@pytest.fixture(scope="session")
+def day_cassette(tmp_path_factory, day_pages):
+    """ Returns a cassette with the requests of a search on the pages of a
+    whole day """
+    filename = str(tmp_path_factory.mktemp("cassettes") /
+                   "day_search.cassette.gz")
+    record_day_search(day_pages, filename)
+    return transport.Cassette(filename)
+
+
+@pytest.fixture
+def replayed_day(day_cassette):
+    """ Returns a Trainline session replaying the recorded search of a
+    whole day """
+    return trainline.Trainline(
+        transport=transport.ReplayTransport(day_cassette))
+
+
+@pytest.fixture(scope="session")
+def fares_archive(tmp_path_factory, responses):
+    """ Returns an archive of 1000 observations of the large response (250
+    000 folders, with their trips and segments : about 2 million rows) """
+    from datetime import timedelta
+    from trainline import archive
+    folders = trainline._get_folders(json.loads(responses["large"]))
+    observed_at = trainline._str_datetime_to_datetime_obj(
+        "01/09/2018 00:00", date_format=trainline._READABLE_DATE_FORMAT)
+    fares = archive.Archive(str(tmp_path_factory.mktemp("archives") /
+                                "fares.sqlite"))
+    for hour in range(1000):
+        fares.add(folders, observed_at=observed_at + timedelta(hours=hour))
+    yield fares
+    fares.close()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Build the search responses used by the benchmarks, in the format of
+the Trainline search API (with the generator of trainline.stubserver).
+
+The responses are generated from a fixed seed, so that the benchmarks
+always run on the same content. They are built in memory when the
+benchmarks start, but they can be written in the responses folder
+(ignored by git) to be inspected :
+
+    python3 benchmarks/make_responses.py
+"""
+
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from trainline.stubserver import CARRIERS, generate_journey, \
+    generate_search_results, assemble_search_results
+
+_BENCHMARKS_PATH = os.path.dirname(os.path.realpath(__file__))
+_RESPONSES_PATH = os.path.join(_BENCHMARKS_PATH, "responses")
+DAY_SEARCH = {  # Search recorded on the day pages
+    "departure_station": "Toulouse Matabiau",
+    "arrival_station": "Bordeaux St-Jean",
+    "from_date": "15/10/2018 00:00",
+    "to_date": "15/10/2018 23:59",
+}
+DAY_PASSENGER_AGE = 38  # Age of the passenger of the recorded search
+_SEED = 20181015
+_DAY = datetime(2018, 10, 15, tzinfo=timezone(timedelta(hours=2)))
+_DEPARTURE_STATION_ID = "5311"  # Toulouse Matabiau
+_ARRIVAL_STATION_ID = "828"  # Bordeaux St-Jean
+
+_SIZES = {
+    # name : (number of folders, number of passengers, carriers)
+    "small": (10, 1, ["sncf"]),
+    "medium": (60, 2, ["sncf", "ouigo", "flixbus"]),
+    "large": (250, 4, sorted(CARRIERS)),
+}
+_DAY_PAGES = 5  # Pages of the "day" responses, used for paginated searches
+_PAGES_OVERLAP = 3  # Folders of a page repeated at the start of the next one
+
+
+def _journey(rng, departure, carriers, passengers):
+    return generate_journey(rng, departure, carriers, passengers,
+                            _DEPARTURE_STATION_ID, _ARRIVAL_STATION_ID)
+
+
+def generate_response(rng, departures, carriers, passengers):
+    """ Returns a search response (as a dict) with one folder per departure
+    date """
+    return generate_search_results(rng, departures, carriers, passengers,
+                                   _DEPARTURE_STATION_ID, _ARRIVAL_STATION_ID)
+
+
+def _departures(rng, folder_nb, start=_DAY):
+    """ Returns sorted departure dates spread over one day """
+    return sorted(start + timedelta(minutes=rng.randint(0, 24 * 60 - 1))
+                  for _ in range(folder_nb))
+
+
+class _DayPagesTransport(object):
+    """ Serve the page which starts at (or just before) the departure date
+    of the search request, like the search API """
+
+    def __init__(self, pages):
+        import trainline
+        from trainline.transport import ReplayedResponse
+        self.pages = []
+        for page in pages:
+            first_departure = trainline._str_datetime_to_datetime_obj(
+                trainline._fix_date_offset_format(
+                    page["folders"][0]["departure_date"]))
+            self.pages.append((first_departure, ReplayedResponse(
+                200, json.dumps(page, ensure_ascii=False))))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        import trainline
+        departure_date = trainline._str_datetime_to_datetime_obj(
+            json.loads(data)["search"]["departure_date"])
+        ret = self.pages[0][1]
+        for first_departure, page_ret in self.pages:
+            if first_departure <= departure_date:
+                ret = page_ret
+        return ret
+
+
+def day_passenger():
+    """ Returns the passenger of the recorded search (with a fixed age,
+    so that the requests match the recorded ones every year) """
+    import trainline
+    passenger = trainline.Passenger(birthdate="01/01/1980")
+    passenger.age = DAY_PASSENGER_AGE
+    return passenger
+
+
+def record_day_search(pages, filename):
+    """ Record the requests of a search on the day pages in a cassette """
+    import trainline
+    from trainline import transport
+    with transport.Cassette(filename) as cassette:
+        session = trainline.Trainline(transport=transport.RecordTransport(
+            cassette, transport=_DayPagesTransport(pages)))
+        trainline.search(passengers=[day_passenger()],
+                         trainline_session=session, **DAY_SEARCH)
+    return cassette
+
+
+def build_responses():
+    """ Returns the responses of the benchmarks, as a dict
+    name : decoded response ("day_pages" is a list of responses) """
+    rng = random.Random(_SEED)
+    responses = {}
+    for name, (folder_nb, passengers, carriers) in sorted(_SIZES.items()):
+        responses[name] = generate_response(
+            rng, _departures(rng, folder_nb), carriers, passengers)
+
+    # Consecutive pages of a whole day, as fetched by a paginated search :
+    # each page starts with the last journeys of the previous one
+    folder_nb, passengers, carriers = _SIZES["medium"]
+    journeys = [_journey(rng, departure, carriers, passengers)
+                for departure in _departures(
+                    rng, folder_nb * _DAY_PAGES // 2)]
+    page_size = len(journeys) // _DAY_PAGES
+    pages = []
+    for i in range(_DAY_PAGES):
+        page_journeys = journeys[
+            max(0, i * page_size - _PAGES_OVERLAP):(i + 1) * page_size]
+        pages.append(assemble_search_results(rng, page_journeys,
+                                             passengers))
+    # Last page : the next morning, to stop the pagination
+    pages.append(generate_response(
+        rng, _departures(rng, 5, start=_DAY + timedelta(days=1, hours=6)),
+        carriers, passengers))
+    responses["day_pages"] = pages
+    return responses
+
+
+def main():
+    """ Write the responses in the responses folder, to inspect them """
+    os.makedirs(_RESPONSES_PATH, exist_ok=True)
+    for name, content in sorted(build_responses().items()):
+        filename = os.path.join(_RESPONSES_PATH, name + ".json")
+        with open(filename, "w", encoding="utf8") as f:
+            json.dump(content, f, ensure_ascii=False)
+        print("{} : {} bytes".format(filename, os.path.getsize(filename)))
+
+
+if __name__ == "__main__":
+    main()
@@ -43,11 +43,16 @@ setup(
     keywords=_KEYWORDS,
     setup_requires=requirements,
     install_requires=requirements,
+    extras_require={
+        'stream': ['ijson>=3.1'],  # search(stream=True)
+        'export': ['pyarrow', 'pandas'],  # Folders.to_arrow, to_pandas...
+    },
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
-    python_requires='>=3',
+    python_requires='>=3.7',  # Lazy module attributes (PEP 562)
     tests_require=['pytest'],
 )
 
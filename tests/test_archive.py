@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.archive` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_archive.py
+
+import copy
+from datetime import timedelta
+
+import pytest
+import trainline
+from trainline import archive, stubserver
+
+_SEARCH = {
+    "departure_station": "Toulouse Matabiau",
+    "arrival_station": "Bordeaux St-Jean",
+    "from_date": "15/10/2018 08:00",
+    "to_date": "15/10/2018 18:00",
+}
+_OBSERVED_AT = trainline._str_datetime_to_datetime_obj(
+    "01/10/2018 12:00", date_format=trainline._READABLE_DATE_FORMAT)
+
+
+@pytest.fixture(scope="module")
+def results():
+    with stubserver.StubServer(page_size=10) as stub:
+        return trainline.search(
+            trainline_session=trainline.Trainline(transport=stub.transport()),
+            **_SEARCH)
+
+
+def test_add(results, tmp_path):
+    path = str(tmp_path / "fares.sqlite")
+    with archive.Archive(path, batch_size=7) as fares:
+        assert fares.add(results, observed_at=_OBSERVED_AT) == len(results)
+        assert fares.add(iter(results)) == len(results)
+        assert len(fares) == 2 * len(results)
+    with archive.Archive(path) as fares:  # Reopened : the ids continue
+        fares.add(results[:1])
+        connection = fares.connection
+        assert len(fares) == 2 * len(results) + 1
+        trips_nb = sum(len(folder.trips) for folder in results)
+        assert connection.execute("SELECT COUNT(*) FROM trips").fetchone() \
+            == (2 * trips_nb + len(results[0].trips),)
+        segments_nb = sum(len(trip.segments) for folder in results
+                          for trip in folder.trips)
+        assert connection.execute(
+            "SELECT COUNT(DISTINCT trip) FROM segments").fetchone()[0] == \
+            connection.execute("SELECT COUNT(*) FROM trips").fetchone()[0]
+        assert connection.execute(
+            "SELECT COUNT(*) FROM segments").fetchone()[0] > segments_nb
+
+
+def test_add_several_writers(results, tmp_path):
+    # Two archives of the same file (like two processes) : the ids of
+    # their batches do not collide
+    path = str(tmp_path / "fares.sqlite")
+    with archive.Archive(path) as first, archive.Archive(path) as second:
+        first.add(results[:2])
+        second.add(results[:3])
+        first.add(results[:1])
+        assert len(first) == len(second) == 6
+        assert first.connection.execute(
+            "SELECT COUNT(*) FROM trips").fetchone()[0] == \
+            sum(len(folder.trips) for folder in
+                results[:2] + results[:3] + results[:1])
+
+
+def test_price_history(results):
+    with archive.Archive(":memory:") as fares:
+        fares.add(results, observed_at=_OBSERVED_AT)
+        cheaper = [copy.copy(folder) for folder in results]
+        for folder in cheaper:
+            folder.price -= 1
+        fares.add(cheaper, observed_at=_OBSERVED_AT + timedelta(days=1))
+
+        folder = results[0]
+        history = fares.price_history(
+            folder.departure_station_id, folder.arrival_station_id,
+            _SEARCH["from_date"], _SEARCH["to_date"])
+        departures = sorted({f.departure_date_obj for f in results})
+        assert [point.departure_date for point in history[::2]] == departures
+        first, second = history[:2]
+        assert first.observed_at == _OBSERVED_AT
+        assert second.observed_at == _OBSERVED_AT + timedelta(days=1)
+        assert second.price == first.price - 1 == min(
+            f.price for f in results
+            if f.departure_date_obj == first.departure_date) - 1
+
+        cheapest = fares.cheapest(
+            folder.departure_station_id, folder.arrival_station_id,
+            _SEARCH["from_date"], _SEARCH["to_date"])
+        assert [point.departure_date for point in cheapest] == departures
+        assert cheapest[0].price == second.price
+        assert cheapest[0].observed_at == second.observed_at
+        assert fares.price_history(folder.arrival_station_id,
+                                   folder.departure_station_id,
+                                   _SEARCH["from_date"],
+                                   _SEARCH["to_date"]) == []
+
+
+def test_train_prices(results):
+    with archive.Archive(":memory:") as fares:
+        fares.add(results, observed_at=_OBSERVED_AT)
+        segment = results[0].trips[0].segments[0]
+        prices = fares.train_prices(segment.train_number,
+                                    segment.departure_date_obj.date())
+        assert prices == fares.train_prices(segment.train_number,
+                                            "15/10/2018")
+        assert len(prices) == 1
+        assert prices[0].departure_date == segment.departure_date_obj
+        assert prices[0].price == min(
+            folder.price for folder in results for trip in folder.trips
+            for s in trip.segments if s.train_number == segment.train_number
+            and s.departure_date_obj == segment.departure_date_obj)
+        assert fares.train_prices(segment.train_number, "16/10/2018") == []
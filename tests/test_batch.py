@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.batch` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_batch.py
+
+from datetime import timedelta
+
+import pytest
+import trainline
+from trainline import batch, stubserver
+
+_SEARCHES = [{
+    "departure_station": "Toulouse Matabiau",
+    "arrival_station": "Bordeaux St-Jean",
+    "from_date": "{:02d}/10/2018 08:00".format(day),
+    "to_date": "{:02d}/10/2018 18:00".format(day),
+} for day in range(15, 19)]
+
+
+@pytest.fixture(scope="module")
+def session():
+    with stubserver.StubServer(page_size=10) as stub:
+        yield trainline.Trainline(transport=stub.transport())
+
+
+def _by_date(batch_results):
+    return {result.params["from_date"]: result.results
+            for result in batch_results}
+
+
+def test_search_many(session):
+    results = _by_date(batch.search_many(_SEARCHES,
+                                         trainline_session=session))
+    assert len(results) == len(_SEARCHES)
+    for params in _SEARCHES:
+        folders = trainline.search(trainline_session=session, **params)
+        assert [repr(folder) for folder in results[params["from_date"]]] \
+            == [repr(folder) for folder in folders]
+
+
+def test_search_many_processes(session):
+    fields = ("departure_date", "price", "segment_nb")
+    parsed = _by_date(batch.search_many(
+        _SEARCHES, trainline_session=session, processes=2, fields=fields))
+    expected = _by_date(batch.search_many(
+        _SEARCHES, trainline_session=session, fields=fields))
+    assert parsed == expected
+    rows = parsed[_SEARCHES[0]["from_date"]]
+    assert len(rows) > 10 and rows[0]._fields == fields
+
+    # PROJECTION_FIELDS by default
+    result = next(batch.search_many(_SEARCHES[:1], trainline_session=session,
+                                    processes=1))
+    assert result.results[0]._fields == trainline.PROJECTION_FIELDS
+
+
+def test_search_many_errors(session):
+    searches = [dict(_SEARCHES[0], departure_station="Nowhere"),
+                dict(_SEARCHES[0], bicycle_with_reservation_only=True)]
+    results = list(batch.search_many(searches, trainline_session=session,
+                                     processes=1))
+    errors = [type(result.error) for result in results]
+    assert sorted(errors, key=str) == sorted([KeyError, ValueError], key=str)
+    assert all(result.results is None for result in results)
+
+    with pytest.raises(ValueError):
+        trainline.search(trainline_session=session,
+                         parse_executor=object(), **_SEARCHES[0])
+
+
+def test_fare_calendar(session):
+    calendar = batch.fare_calendar("Toulouse Matabiau", "Bordeaux St-Jean",
+                                   "15/10/2018", 3, top_k=2,
+                                   trainline_session=session)
+    assert [str(day.date) for day in calendar] == \
+        ["2018-10-15", "2018-10-16", "2018-10-17"]
+    for day in calendar:
+        folders = trainline.search(
+            "Toulouse Matabiau", "Bordeaux St-Jean",
+            day.date.strftime("%d/%m/%Y 00:00"),
+            day.date.strftime("%d/%m/%Y 23:59"), trainline_session=session)
+        prices = sorted(folder.price for folder in folders)
+        assert day.error is None
+        assert [row.price for row in day.top] == prices[:2]
+        assert day.cheapest == day.top[0]
+        assert day.cheapest.departure_date.date() == day.date
+
+    calendar = batch.fare_calendar("Nowhere", "Bordeaux St-Jean",
+                                   "15/10/2018", 1, trainline_session=session)
+    assert isinstance(calendar[0].error, KeyError)
+    assert calendar[0].cheapest is None and calendar[0].top == []
+    with pytest.raises(ValueError):
+        batch.fare_calendar("Toulouse Matabiau", "Bordeaux St-Jean",
+                            "15/10/2018", 1, fields=("departure_date",))
+
+
+def _brute_force_round_trips(outbounds, inbounds, min_stay, max_stay,
+                             max_total_price):
+    return sorted(
+        round(outbound.price + inbound.price, 2)
+        for outbound in outbounds for inbound in inbounds
+        if min_stay <= inbound.departure_date_obj -
+        outbound.arrival_date_obj <= max_stay and
+        outbound.price + inbound.price <= max_total_price)
+
+
+def test_search_round_trip(session):
+    outbound_dates = ("15/10/2018 06:00", "15/10/2018 14:00")
+    inbound_dates = ("16/10/2018 08:00", "16/10/2018 22:00")
+    round_trips = batch.search_round_trip(
+        "Toulouse Matabiau", "Bordeaux St-Jean", outbound_dates,
+        inbound_dates, min_stay=timedelta(hours=24),
+        max_stay=timedelta(hours=30), max_total_price=150, top_k=20,
+        trainline_session=session)
+    outbounds = trainline.search("Toulouse Matabiau", "Bordeaux St-Jean",
+                                 *outbound_dates, trainline_session=session)
+    inbounds = trainline.search("Bordeaux St-Jean", "Toulouse Matabiau",
+                                *inbound_dates, trainline_session=session)
+    expected = _brute_force_round_trips(
+        outbounds, inbounds, timedelta(hours=24), timedelta(hours=30), 150)
+    assert len(expected) > 20
+    assert [round_trip.price for round_trip in round_trips] == expected[:20]
+    for round_trip in round_trips:
+        assert round_trip.outbound.departure_station_id == \
+            round_trip.inbound.arrival_station_id
+        assert round_trip.inbound.departure_date_obj >= \
+            round_trip.outbound.arrival_date_obj + timedelta(hours=24)
+
+    rows = batch.search_round_trip(
+        "Toulouse Matabiau", "Bordeaux St-Jean", outbound_dates,
+        inbound_dates, min_stay=timedelta(hours=24),
+        max_stay=timedelta(hours=30), max_total_price=150, top_k=20,
+        trainline_session=session, fields=trainline.PROJECTION_FIELDS)
+    assert [row.price for row in rows] == expected[:20]
+    assert rows[0].outbound._fields == trainline.PROJECTION_FIELDS
+    with pytest.raises(ValueError):
+        batch.search_round_trip(
+            "Toulouse Matabiau", "Bordeaux St-Jean", outbound_dates,
+            inbound_dates, trainline_session=session, fields=("price",))
+
+
+def test_pair_round_trips_empty():
+    assert batch.pair_round_trips([], []) == []
+    range_min = batch._RangeMin([5, 3, 8, 3, 1, 9, 2])
+    assert [range_min.query(lo, hi) for lo, hi in
+            ((0, 1), (0, 2), (2, 4), (0, 7), (5, 7), (2, 3))] == \
+        [0, 1, 3, 4, 6, 2]
+
+
+def test_get_city_stations():
+    lyon = trainline.get_city_stations("Lyon ")
+    assert "lyon part-dieu" in lyon and "lyon perrache" in lyon
+    assert "lyon" not in lyon
+    assert all(station.startswith("lyon ") for station in lyon)
+    assert trainline.get_city_stations("La Crau") == ("la crau",)
+    with pytest.raises(KeyError):
+        trainline.get_city_stations("Nowhere")
+
+
+def test_search_city(session):
+    bordeaux = trainline.get_city_stations("Bordeaux")
+    folders = batch.search_city("Toulouse Matabiau", "Bordeaux",
+                                "15/10/2018 08:00", "15/10/2018 12:00",
+                                trainline_session=session)
+    expected = set()
+    for station in bordeaux:
+        expected.update(trainline.search(
+            "Toulouse Matabiau", station, "15/10/2018 08:00",
+            "15/10/2018 12:00", trainline_session=session))
+    assert isinstance(folders, trainline.Folders)
+    assert sorted(repr(folder) for folder in folders) == \
+        sorted(repr(folder) for folder in expected)
+    assert len({folder.arrival_station_id for folder in folders}) == \
+        len(bordeaux)
+    dates = [folder.departure_date_obj for folder in folders]
+    assert dates == sorted(dates)
+
+    # The failed pairs are skipped, unless every pair failed
+    assert len(batch.search_city(
+        ["Toulouse Matabiau", "Nowhere"], "Bordeaux St-Jean",
+        "15/10/2018 08:00", "15/10/2018 12:00",
+        trainline_session=session)) > 0
+    with pytest.raises(KeyError):
+        batch.search_city(["Nowhere"], "Bordeaux", "15/10/2018 08:00",
+                          "15/10/2018 12:00", trainline_session=session)
+    with pytest.raises(ValueError):
+        batch.search_city("Berlin", "Paris", "15/10/2018 08:00",
+                          "15/10/2018 12:00", trainline_session=session)
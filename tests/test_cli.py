@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for the `trainline_cli.py` CLI tool."""
+
+# To be tested with : python3 -m pytest -vs tests/test_cli.py
+
+import copy
+import json
+import os
+import pstats
+from datetime import datetime, timedelta
+
+from click.testing import CliRunner
+import pytest
+import trainline
+import trainline_cli
+
+from test_trainline import _SEARCH_RESULTS_DICT, _FakeResponse, \
+    _FakeTransport
+
+_CSV_HEADER = "departure_date;arrival_date;duration;number_of_segments;\
+price;currency;transportation_mean;bicycle_reservation"
+
+
+def _search_results_from_now():
+    """ Returns search results with a folder in 1 hour, and another one
+    in 2 days (after the end of the search, to stop the pagination) """
+    now = datetime.now().replace(second=0, microsecond=0)
+    search_results = copy.deepcopy(_SEARCH_RESULTS_DICT)
+    folder = search_results["folders"][0]
+    later_folder = copy.deepcopy(folder)
+    later_folder["id"] = "f721d0a4a2cb11e880abfc0416222639"
+    search_results["folders"].append(later_folder)
+    for obj, departure in [(folder, now + timedelta(hours=1)),
+                           (later_folder, now + timedelta(days=2))]:
+        obj["departure_date"] = departure.strftime("%Y-%m-%dT%H:%M:%S+01:00")
+        obj["arrival_date"] = (departure + timedelta(hours=2)).strftime(
+            "%Y-%m-%dT%H:%M:%S+01:00")
+    return search_results
+
+
+@pytest.fixture
+def fake_search(monkeypatch):
+    """ Run the searches of the CLI on fake search results """
+    trainline.get_circuit_breaker(trainline._SEARCH_URL).reset()
+    text = json.dumps(_search_results_from_now())
+    real_search = trainline.search
+
+    def search(**kwargs):
+        session = trainline.Trainline(
+            transport=_FakeTransport(_FakeResponse(200, text)))
+        return real_search(trainline_session=session, **kwargs)
+    monkeypatch.setattr(trainline, "search", search)
+
+
+def test_cli_timings_and_profile(fake_search, tmpdir):
+    profile = str(tmpdir.join("search.prof"))
+    result = CliRunner().invoke(trainline_cli.main, [
+        "-d", "Toulouse Matabiau", "-a", "Bordeaux St-Jean", "-n", "1d",
+        "--timings", "--profile", profile])
+    assert result.exit_code == 0, result.output
+
+    # stdout only contains the csv
+    lines = result.stdout.strip().split("\n")
+    assert lines[0] == _CSV_HEADER
+    assert len(lines) == 2
+
+    # timings are on stderr, parents before their children
+    phases = [line.split()[0]
+              for line in result.stderr.strip().split("\n")[1:]]
+    assert phases[:3] == ["search", "search.station_lookup", "http.post"]
+    assert "parse.folders" in phases
+    assert phases[-1] == "csv"
+
+    assert pstats.Stats(profile).total_calls > 0
+
+
+def test_cli_help_is_lazy():
+    import subprocess
+    import sys
+    ret = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, trainline_cli\n"
+         "try:\n"
+         "    trainline_cli.main(['--help'])\n"
+         "except SystemExit:\n"
+         "    print(' '.join(sorted(sys.modules)))"],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(trainline_cli.__file__)))
+    assert "Search trips with Trainline" in ret.stdout
+    modules = ret.stdout.strip().split("\n")[-1].split()
+    assert "trainline" not in modules
+    assert "requests" not in modules
+
+
+@pytest.fixture
+def stub_transport(monkeypatch):
+    """ Send the requests of the batch searches to a stub server """
+    from trainline import stubserver, transport
+    trainline.get_circuit_breaker(trainline._SEARCH_URL).reset()
+    with stubserver.StubServer(page_size=10) as stub:
+        stub_transport = stub.transport()
+        monkeypatch.setattr(transport, "PassthroughTransport",
+                            lambda session=None: stub_transport)
+        yield stub_transport
+
+
+_BATCH_CSV = """departure;arrival;from_date;to_date
+Toulouse Matabiau;Bordeaux St-Jean;15/10/2018 08:00;15/10/2018 10:00
+Bordeaux St-Jean;Toulouse Matabiau;15/10/2018 08:00;15/10/2018 09:00
+Nowhere;Bordeaux St-Jean;15/10/2018 08:00;15/10/2018 10:00
+"""
+
+
+def test_cli_batch_csv(stub_transport, tmpdir):
+    batch_file = tmpdir.join("routes.csv")
+    batch_file.write_text(_BATCH_CSV, encoding="utf-8")
+    result = CliRunner().invoke(trainline_cli.main, [
+        "--batch", str(batch_file), "--workers", "2", "-t", "any"])
+    assert result.exit_code == 1  # A route failed
+    lines = result.stdout.strip().split("\n")
+    assert lines[0] == "departure;arrival;" + _CSV_HEADER
+    routes = {tuple(line.split(";")[:2]) for line in lines[1:]}
+    assert routes == {("Toulouse Matabiau", "Bordeaux St-Jean"),
+                      ("Bordeaux St-Jean", "Toulouse Matabiau")}
+    assert all(len(line.split(";")) == 10 for line in lines)
+
+    progress = result.stderr.strip().split("\n")
+    assert len(progress) == 4
+    assert sum("failed" in line for line in progress[:3]) == 1
+    assert "Nowhere" in [line for line in progress if "failed" in line][0]
+    assert progress[-1] == "3 routes searched, 1 failed"
+
+
+def test_cli_batch_ndjson(stub_transport):
+    routes = [{"departure": "Toulouse Matabiau",
+               "arrival": "Bordeaux St-Jean",
+               "from_date": "15/10/2018 08:00",
+               "to_date": "15/10/2018 10:00", "transport": "train"}]
+    for batch_input in [json.dumps(routes), json.dumps(routes[0]) + "\n"]:
+        result = CliRunner().invoke(trainline_cli.main, [
+            "--batch", "-", "--format", "ndjson", "--max-rps", "100"],
+            input=batch_input)
+        assert result.exit_code == 0, result.output
+        records = [json.loads(line)
+                   for line in result.stdout.strip().split("\n")]
+        assert len(records) > 1
+        assert {record["departure"] for record in records} == \
+            {"Toulouse Matabiau"}
+        assert all(record["transportation_mean"] == "train"
+                   for record in records)
+        assert result.stderr.strip().split("\n")[-1] == \
+            "1 routes searched, 0 failed"
+
+
+def test_cli_batch_usage(tmpdir):
+    batch_file = tmpdir.join("routes.csv")
+    batch_file.write("departure,next\nToulouse Matabiau,1d\n")
+    result = CliRunner().invoke(trainline_cli.main,
+                                ["--batch", str(batch_file)])
+    assert result.exit_code == 2
+    assert "row 1 has no departure or arrival" in result.output
+
+    result = CliRunner().invoke(trainline_cli.main, [
+        "--batch", str(batch_file), "-d", "Toulouse Matabiau"])
+    assert result.exit_code == 2
+    result = CliRunner().invoke(trainline_cli.main, ["-d", "Toulouse"])
+    assert result.exit_code == 2
+    assert "Missing option '--arrival'" in result.output
+
+
+@pytest.mark.parametrize("batch_input, error", [
+    ('[{"departure": "A", "arrival": "B", "next": "xd"}]',
+     "row 1 has an invalid next"),
+    ('{"departure": "A", "arrival": "B"}\n'
+     '{"departure": "A", "arrival": "B", "transport": "plane"}',
+     "row 2 has an unknown transport"),
+    ('[{"departure": "A", "arrival": "B", "from_date": "2018-10-15 08:00",'
+     ' "to_date": "15/10/2018 10:00"}]', "row 1 has an invalid from_date"),
+    ('[{"departure": "A", "arrival": "B", "from_date": "15/10/2018 08:00"}]',
+     "row 1 has an invalid to_date"),
+    ('[{"departure": "A", "arrival": "B"}, ["A", "B"]]',
+     "row 2 is not an object"),
+    ('[{"departure": "A"', "invalid JSON"),
+])
+def test_cli_batch_invalid_rows(batch_input, error):
+    result = CliRunner().invoke(trainline_cli.main, ["--batch", "-"],
+                                input=batch_input)
+    assert result.exit_code == 2
+    assert error in result.output
+    assert "--batch" in result.output
+
+
+def test_cli_batch_departure_envvar(stub_transport):
+    # The default departure of PARAM1 does not conflict with --batch
+    result = CliRunner().invoke(trainline_cli.main, [
+        "--batch", "-", "--max-rps", "100"], input=json.dumps([{
+            "departure": "Toulouse Matabiau", "arrival": "Bordeaux St-Jean",
+            "from_date": "15/10/2018 08:00",
+            "to_date": "15/10/2018 10:00"}]), env={"PARAM1": "Toulouse"})
+    assert result.exit_code == 0, result.output
+
+    result = CliRunner().invoke(trainline_cli.main, [
+        "--batch", "-", "--max-rps", "0"], input="[]")
+    assert result.exit_code == 2
+
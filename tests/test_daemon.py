@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.daemon` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_daemon.py
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+from click.testing import CliRunner
+import pytest
+import trainline_cli
+from trainline import daemon, forward, stubserver
+
+_SEARCH = {
+    "departure": "Toulouse Matabiau",
+    "arrival": "Bordeaux St-Jean",
+    "from_date": "15/10/2018 08:00",
+    "to_date": "15/10/2018 12:00",
+}
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with stubserver.StubServer(page_size=10) as stub:
+        yield stub
+
+
+@pytest.fixture
+def search_daemon(stub, tmpdir):
+    search_daemon = daemon.SearchDaemon(transport=stub.transport())
+    search_daemon.listen(socket_path=str(tmpdir.join("trainline.sock")))
+    search_daemon.start()
+    yield search_daemon
+    search_daemon.stop()
+
+
+def test_daemon_search(search_daemon, stub):
+    status, text, count = daemon.forward_search(
+        search_daemon.address, **_SEARCH)
+    assert status == 200
+    lines = text.strip().split("\n")
+    assert lines[0].startswith("departure_date;arrival_date")
+    assert count == len(lines) - 1 > 0
+
+    # The second search is served from the results cache
+    requests_nb = stub.requests_nb
+    assert daemon.forward_search(search_daemon.address, **_SEARCH) == \
+        (status, text, count)
+    assert stub.requests_nb == requests_nb
+    assert search_daemon.status()["cache_hits"] == 1
+
+    status, text, _ = daemon.forward_search(
+        search_daemon.address, output_format="json", **_SEARCH)
+    folders = json.loads(text)
+    assert len(folders) == count
+    assert folders[0]["departure_date"] == "15/10/2018 08:00"
+
+
+def test_daemon_socket_permissions(search_daemon):
+    assert os.stat(search_daemon.address).st_mode & 0o777 == 0o600
+
+
+def test_daemon_errors(search_daemon):
+    status, text, _ = daemon.forward_search(
+        search_daemon.address, **dict(_SEARCH, departure="Nowhere"))
+    assert status == 400
+    assert "Nowhere" in json.loads(text)["error"]
+
+    with pytest.raises(OSError):
+        search_daemon.listen(socket_path=search_daemon.address)
+
+
+def test_daemon_http_and_login(stub):
+    search_daemon = daemon.SearchDaemon(
+        email_account="me@example.com", password_account="secret",
+        passengers=[("Sophie", "Martin", "02/01/1990")],
+        transport=stub.transport())
+    search_daemon.listen(port=0).start()
+    try:
+        assert search_daemon.address.startswith("http://127.0.0.1:")
+        status, text, count = daemon.forward_search(
+            search_daemon.address, **_SEARCH)
+        assert status == 200 and count > 0
+        assert search_daemon.status()["logged_in"]
+    finally:
+        search_daemon.stop()
+
+
+def test_cli_forwards_to_daemon(search_daemon):
+    result = CliRunner().invoke(trainline_cli.main, [
+        "-d", "Toulouse Matabiau", "-a", "Bordeaux St-Jean", "-n", "2h",
+        "--daemon", search_daemon.address, "--transport", "any"])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith("departure_date;arrival_date")
+    assert search_daemon.status()["searches"] == 1
+
+    result = CliRunner().invoke(trainline_cli.main, [
+        "-d", "Nowhere", "-a", "Bordeaux St-Jean",
+        "--daemon", search_daemon.address])
+    assert result.exit_code == 1
+    assert "Nowhere" in result.output
+
+
+def test_cli_daemon_not_running(tmpdir, monkeypatch):
+    searches = []
+    monkeypatch.setattr(trainline_cli, "_search",
+                        lambda *args: searches.append(args))
+    for address in [str(tmpdir.join("missing.sock")), "http://127.0.0.1:1"]:
+        result = CliRunner().invoke(trainline_cli.main, [
+            "-d", "Toulouse Matabiau", "-a", "Bordeaux St-Jean", "-n", "2h",
+            "--daemon", address])
+        assert result.exit_code == 0, result.output
+    assert len(searches) == 2  # Searched locally
+
+
+def test_cli_daemon_timeout(tmpdir, monkeypatch):
+    monkeypatch.setattr(forward, "_FORWARD_TIMEOUT", 0.1)
+    socket_path = str(tmpdir.join("stuck.sock"))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen(1)  # Never answers
+        result = CliRunner().invoke(trainline_cli.main, [
+            "-d", "Toulouse Matabiau", "-a", "Bordeaux St-Jean", "-n", "2h",
+            "--daemon", socket_path])
+    assert result.exit_code == 1
+    assert "did not answer in 0.1 s" in result.output
+
+
+def test_cli_without_daemon_imports(tmpdir):
+    # Without a daemon, the CLI does not import the forwarding code
+    ret = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, trainline_cli\n"
+         "assert not trainline_cli._forward_search("
+         "'Toulouse', 'Bordeaux', '1d', 'any', False, None)\n"
+         "print(' '.join(sorted(sys.modules)))"],
+        env=dict(os.environ, XDG_RUNTIME_DIR=str(tmpdir)),
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = ret.stdout.split()
+    for module in ["http.client", "http.server", "requests",
+                   "trainline.daemon"]:
+        assert module not in modules
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.export` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_export.py
+
+import pytest
+import trainline
+from trainline import stubserver
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+export = pytest.importorskip("trainline.export")
+
+_SEARCH = {
+    "departure_station": "Toulouse Matabiau",
+    "arrival_station": "Bordeaux St-Jean",
+    "from_date": "15/10/2018 08:00",
+    "to_date": "15/10/2018 18:00",
+}
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with stubserver.StubServer(page_size=10) as stub:
+        yield stub
+
+
+@pytest.fixture(scope="module")
+def results(stub):
+    return trainline.search(
+        trainline_session=trainline.Trainline(transport=stub.transport()),
+        **_SEARCH)
+
+
+def test_to_arrow(results):
+    table = results.to_arrow()
+    assert table.schema == export.FOLDER_SCHEMA
+    assert table.num_rows == len(results)
+    assert table.column("departure_date").to_pylist() == \
+        [folder.departure_date_obj for folder in results]
+    assert table.column("price").to_pylist() == \
+        [folder.price for folder in results]
+    assert table.column("transportation_mean").to_pylist() == \
+        [folder.transportation_mean for folder in results]
+
+    segments = results.to_arrow(segments=True)
+    assert segments.schema == export.SEGMENT_SCHEMA
+    assert segments.num_rows == sum(len(trip.segments)
+                                    for folder in results
+                                    for trip in folder.trips)
+    assert set(segments.column("folder_id").to_pylist()) == \
+        {folder.id for folder in results}
+
+
+def test_to_pandas(results):
+    pytest.importorskip("pandas")
+    df = results.to_pandas()
+    assert str(df["departure_date"].dtype) == \
+        "datetime64[us, Europe/Paris]"
+    assert str(df["price"].dtype) == "float64"
+    assert str(df["carrier"].dtype) == "category"
+    assert df["duration"].iloc[0] == \
+        results[0].arrival_date_obj - results[0].departure_date_obj
+    segments_df = results.to_pandas(segments=True)
+    assert str(segments_df["transportation_mean"].dtype) == "category"
+
+
+def test_write_parquet(stub, results, tmpdir):
+    path = str(tmpdir.join("folders.parquet"))
+    segments_path = str(tmpdir.join("segments.parquet"))
+    count = export.write_parquet(
+        trainline.iter_search(
+            trainline_session=trainline.Trainline(
+                transport=stub.transport()), **_SEARCH),
+        path, segments_path=segments_path, batch_size=5)
+    assert count == len(results)
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_row_groups == -(-count // 5)
+    assert sorted(parquet_file.read().column("id").to_pylist()) == \
+        sorted(folder.id for folder in results)
+    assert pq.read_table(segments_path).num_rows == \
+        results.to_arrow(segments=True).num_rows
+
+    results.to_parquet(path)
+    assert pq.read_table(path).equals(results.to_arrow())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.metrics` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_metrics.py
+
+import trainline
+from trainline import metrics
+
+
+def test_class_Registry():
+    registry = metrics.Registry()
+    counter = registry.counter("test_requests_total", "Requests")
+    counter.inc(endpoint="search")
+    counter.inc(2, endpoint="search")
+    assert counter.get(endpoint="search") == 3
+    assert registry.counter("test_requests_total", "Requests") is counter
+
+    histogram = registry.histogram("test_duration_seconds", "Duration",
+                                   buckets=(0.1, 1))
+    histogram.observe(0.5)
+    histogram.observe(2)
+
+    assert registry.render() == """\
+# HELP test_duration_seconds Duration
+# TYPE test_duration_seconds histogram
+test_duration_seconds_bucket{le="0.1"} 0
+test_duration_seconds_bucket{le="1"} 1
+test_duration_seconds_bucket{le="+Inf"} 2
+test_duration_seconds_sum 2.5
+test_duration_seconds_count 2
+# HELP test_requests_total Requests
+# TYPE test_requests_total counter
+test_requests_total{endpoint="search"} 3
+"""
+
+
+def test_metrics_hook():
+    registry = metrics.Registry()
+    metrics.enable(registry)
+    try:
+        with trainline._span("http.post", endpoint="search") as span:
+            span.set("status_code", 200)
+            span.set("status_codes", [503, 200])
+            span.set("retries", 1)
+            span.set("sleep_time", 10)
+            span.set("bytes", 1234)
+        with trainline._span("parse", path="objects") as span:
+            with trainline._span("parse.folders") as folders_span:
+                folders_span.set("count", 30)
+            span.set("count", 30)
+        with trainline._span("search") as span:
+            span.set("pages", 2)
+    finally:
+        metrics.disable(registry)
+
+    hook = metrics.MetricsHook(registry)  # Same metrics, already registered
+    assert hook.http_responses.get(endpoint="search", status_code=200) == 1
+    assert hook.http_responses.get(endpoint="search", status_code=503) == 1
+    assert hook.http_retries.get(endpoint="search") == 1
+    assert hook.http_sleep.get(endpoint="search") == 10
+    assert hook.parsed_objects.get(kind="folders") == 30
+    assert hook.parsed_folders.get(path="objects") == 30
+    assert hook.parse_duration.get_count(path="objects") == 1
+    assert hook.search_pages.get_count() == 1
+    assert hook.folders_per_second.get() > 0
+    assert 'trainline_http_responses_total{endpoint="search",\
+status_code="200"} 1' in registry.render()
+
+
+def test_metrics_hook_searches():
+    from concurrent.futures import ThreadPoolExecutor
+    from trainline import stubserver
+    trainline.get_circuit_breaker(trainline._SEARCH_URL).reset()
+    registry = metrics.Registry()
+    metrics.enable(registry)
+    try:
+        with stubserver.StubServer(page_size=10) as stub:
+            session = trainline.Trainline(
+                transport=stub.transport(),
+                cache=trainline.ResponseCache(ttl=60))
+            search = dict(departure_station="Toulouse Matabiau",
+                          arrival_station="Bordeaux St-Jean",
+                          from_date="15/10/2018 08:00",
+                          to_date="15/10/2018 10:00",
+                          trainline_session=session)
+            paths = ["objects", "objects", "project", "executor"]
+            trainline.search(**search)
+            trainline.search(**search)  # Served from the cache
+            trainline.search(fields=("departure_date", "price"), **search)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                trainline.search(fields=("departure_date", "price"),
+                                 parse_executor=executor, **search)
+            try:
+                import ijson  # noqa: F401
+                trainline.search(stream=True, **search)
+                paths.append("stream")
+            except ImportError:
+                pass
+    finally:
+        metrics.disable(registry)
+
+    hook = metrics.MetricsHook(registry)
+    pages = hook.parse_duration.get_count(path="objects") // 2
+    assert pages > 0
+    for path in paths[2:]:
+        assert hook.parse_duration.get_count(path=path) == pages
+        assert hook.parsed_folders.get(path=path) > 0
+    lookups = len(paths) * pages
+    hits = hook.cache_requests.get(result="hit")
+    assert hits + hook.cache_requests.get(result="miss") == lookups
+    assert hits == lookups - pages  # Only the first search was sent
+    assert hook.cache_hit_ratio.get() == hits / lookups
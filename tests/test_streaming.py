@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.streaming` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_streaming.py
+
+import io
+import json
+from collections import OrderedDict
+
+import pytest
+import requests
+import trainline
+from trainline import stubserver
+
+streaming = pytest.importorskip("trainline.streaming")
+
+_SEARCH = {
+    "departure_station": "Toulouse Matabiau",
+    "arrival_station": "Bordeaux St-Jean",
+    "from_date": "15/10/2018 08:00",
+    "to_date": "15/10/2018 18:00",
+}
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with stubserver.StubServer(page_size=10) as stub:
+        yield stub
+
+
+@pytest.fixture(scope="module")
+def page(stub):
+    """ Returns a page of search results of the stub server """
+    payload = json.dumps({"search": {
+        "departure_station_id": "5311", "arrival_station_id": "828",
+        "departure_date": "2018-10-15T08:00:00+0200",
+        "passengers": [{"id": "a", "age": 30}, {"id": "b", "age": 40}]}})
+    return requests.post(stub.url + stubserver.SEARCH_PATH,
+                         data=payload).json()
+
+
+def _content(page, arrays_order):
+    """ Returns the page as json bytes, with its arrays in arrays_order """
+    return json.dumps(OrderedDict(
+        (name, page[name]) for name in arrays_order)).encode("utf8")
+
+
+@pytest.mark.parametrize("arrays_order", [
+    ("folders", "trips", "segments", "comfort_classes"),
+    ("comfort_classes", "segments", "trips", "folders"),
+    ("segments", "folders", "comfort_classes", "trips"),
+])
+def test_parse_search_results(page, arrays_order):
+    content = _content(page, arrays_order)
+    expected = trainline._get_folders(json.loads(content.decode("utf8")))
+    streamed = streaming.parse_search_results(io.BytesIO(content))
+    assert [repr(folder) for folder in streamed.folders] == \
+        [repr(folder) for folder in expected]
+    assert [len(folder.trips[0].segments[0].comfort_classes)
+            for folder in streamed.folders] == \
+        [len(folder.trips[0].segments[0].comfort_classes)
+         for folder in expected]
+    assert streamed.last_departure_date == \
+        json.loads(content.decode("utf8"))["folders"][-1]["departure_date"]
+
+
+def test_parse_filtered_search_results(page):
+    content = _content(page, ("folders", "trips", "segments",
+                              "comfort_classes"))
+    folder_filter = trainline._FolderFilter(max_price=60)
+    results = streaming.StreamedResults(folder_filter=folder_filter)
+    for name, raw_item in streaming.raw_items(io.BytesIO(content)):
+        if raw_item is None:
+            results.end(name)
+        else:
+            results.add(name, raw_item)
+    folders = results.finish()
+    assert folders == trainline._get_folders(
+        json.loads(content.decode("utf8")), folder_filter=folder_filter)
+    # Only the trips of the folders accepted were kept
+    assert len(results._built["trips"]) == \
+        sum(len(folder.trips) for folder in folders)
+
+
+def test_stream_search(stub):
+    session = trainline.Trainline(transport=stub.transport())
+    folders = trainline.search(trainline_session=session, **_SEARCH)
+    streamed = trainline.search(trainline_session=session, stream=True,
+                                **_SEARCH)
+    assert len(streamed) > 10  # Several pages
+    assert [repr(folder) for folder in streamed] == \
+        [repr(folder) for folder in folders]
+
+    with pytest.raises(ValueError):
+        trainline.search(fields=["price"], stream=True, **_SEARCH)
+
+
+class _TruncatedResponse(object):
+    """ Streamed response whose connection is lost in the middle of the
+    body """
+
+    def __init__(self, content):
+        self.status_code = 200
+        self.headers = {"Content-Length": str(len(content))}
+        self.raw = io.BytesIO(content[:len(content) // 2])
+        self._content_consumed = False
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _TruncatedTransport(object):
+    def __init__(self, content):
+        self.responses = []
+        self.content = content
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        self.responses.append(_TruncatedResponse(self.content))
+        return self.responses[-1]
+
+
+def test_stream_search_truncated(page):
+    transport = _TruncatedTransport(json.dumps(page).encode("utf8"))
+    session = trainline.Trainline(transport=transport)
+    with pytest.raises(streaming.ijson.JSONError):
+        trainline.search(trainline_session=session, stream=True, **_SEARCH)
+    assert len(transport.responses) == 1
+    assert transport.responses[0].closed
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.stubserver` and `trainline.loadgen` modules."""
+
+# To be tested with : python3 -m pytest -vs tests/test_stubserver.py
+
+import json
+from datetime import datetime
+
+import pytest
+import requests
+import trainline
+from trainline import loadgen, stubserver
+
+
+@pytest.fixture(scope="module")
+def server():
+    with stubserver.StubServer(page_size=10) as server:
+        yield server
+
+
+def test_stub_search(server):
+    results = trainline.search(
+        departure_station="Toulouse Matabiau",
+        arrival_station="Bordeaux St-Jean",
+        from_date="15/10/2018 08:00",
+        to_date="15/10/2018 18:00",
+        trainline_session=trainline.Trainline(transport=server.transport()))
+    assert len(results) > 10  # Several pages
+    departure_dates = [folder.departure_date_obj for folder in results]
+    assert departure_dates[0] == datetime(2018, 10, 15, 8, 0,
+                                          tzinfo=departure_dates[0].tzinfo)
+    assert departure_dates[-1] <= datetime(2018, 10, 15, 18, 0,
+                                           tzinfo=departure_dates[0].tzinfo)
+    assert departure_dates == sorted(departure_dates)
+    assert all(folder.departure_station_id == "5311" and
+               folder.arrival_station_id == "828" for folder in results)
+
+
+def test_stub_pages_are_deterministic(server):
+    payload = json.dumps({"search": {
+        "departure_station_id": "5311", "arrival_station_id": "828",
+        "departure_date": "2018-10-15T08:00:00+0200",
+        "passengers": [{"id": "a", "age": 30}, {"id": "b", "age": 40}],
+        "systems": ["ouigo"]}})
+    url = server.url + stubserver.SEARCH_PATH
+    first = requests.post(url, data=payload).json()
+    assert first == requests.post(url, data=payload).json()
+    assert len(first["folders"]) == 10
+    assert len(first["trips"]) == 20  # One trip per passenger
+    assert {segment["carrier"] for segment in first["segments"]} == {"ouigo"}
+
+
+def test_stub_signin(server):
+    session = trainline.Trainline(email_account="me@example.com",
+                                  password_account="secret",
+                                  transport=server.transport())
+    assert session.token_session
+    passenger = trainline.Passenger(birthdate="01/01/1990",
+                                    firstname="Pierre", lastname="Martin",
+                                    trainline_session=session)
+    assert passenger.id == session.account_passengers[0]["id"]
+    assert passenger.cards == session.account_cards
+
+
+def test_stub_errors():
+    with stubserver.StubServer(error_rate=1) as server:
+        ret = requests.post(server.url + stubserver.SEARCH_PATH, data="{}")
+    assert ret.status_code == 503
+    assert server.requests_nb == 1
+
+
+def test_stub_unknown_distribution():
+    with pytest.raises(KeyError):
+        stubserver.StubServer(latency_distribution="normal")
+
+
+def test_loadgen(server):
+    report = loadgen.run(server.url, searches=6, concurrency=3, hours=2)
+    assert report.searches == 6
+    assert not report.errors
+    assert report.folders > 0
+    assert report.throughput > 0
+    assert 0 < report.percentile(0.5) <= report.percentile(0.99)
+    assert "throughput" in str(report)
@@ -9,6 +9,11 @@ import pytest
 import trainline
 from trainline import Trainline, Trip, Passenger, Segment, ComfortClass, Folder
 from datetime import date, timedelta
+import time
+import copy
+import json
+import requests
+from requests import ConnectionError
 
 
 TOULOUSE_STATION_ID = "5311"
@@ -64,6 +69,56 @@ _DEFAULT_FOLDER_DICT = {
     }
 
 
+# Minimal search results, as returned (and decoded) by the search API
+_SEARCH_RESULTS_DICT = {
+    "folders": [{
+        "id": "f721d0a4a2cb11e880abfc0416222638",
+        "departure_date": "2018-10-15T08:49:00+02:00",
+        "departure_station_id": TOULOUSE_STATION_ID,
+        "arrival_date": "2018-10-15T10:58:00+02:00",
+        "arrival_station_id": BORDEAUX_STATION_ID,
+        "cents": 6600,
+        "currency": "EUR",
+        "trip_ids": ["f721ce4ca2cb11e88152d3a9f56d4f85"],
+    }],
+    "trips": [{
+        "id": "f721ce4ca2cb11e88152d3a9f56d4f85",
+        "departure_date": "2018-10-15T08:49:00+02:00",
+        "departure_station_id": TOULOUSE_STATION_ID,
+        "arrival_date": "2018-10-15T10:58:00+02:00",
+        "arrival_station_id": BORDEAUX_STATION_ID,
+        "cents": 6600,
+        "currency": "EUR",
+        "segment_ids": ["ae8b939ca7c211e8967edcf1e2aa0fd7"],
+    }],
+    "segments": [{
+        "id": "ae8b939ca7c211e8967edcf1e2aa0fd7",
+        "departure_date": "2018-10-15T08:49:00+02:00",
+        "departure_station_id": TOULOUSE_STATION_ID,
+        "arrival_date": "2018-10-15T10:58:00+02:00",
+        "arrival_station_id": BORDEAUX_STATION_ID,
+        "transportation_mean": "train",
+        "carrier": "sncf",
+        "train_number": "8202",
+        "travel_class": "first",
+        "trip_id": "f721ce4ca2cb11e88152d3a9f56d4f85",
+        "comfort_class_ids": ["ae9ba138a7c211e88f35afa2c1b6c287"],
+    }],
+    "comfort_classes": [_DEFAULT_COMFORT_CLASS_DICT],
+}
+
+
+def _paginated_search_results():
+    """ Returns the search results with a second folder, departing after
+    10:00 (to stop the pagination of a search ending at 10:00) """
+    search_results = copy.deepcopy(_SEARCH_RESULTS_DICT)
+    later_folder = copy.deepcopy(search_results["folders"][0])
+    later_folder["id"] = "f721d0a4a2cb11e880abfc0416222639"
+    later_folder["departure_date"] = "2018-10-15T12:49:00+02:00"
+    search_results["folders"].append(later_folder)
+    return search_results
+
+
 # Get the date of tomorrow for search tests,
 # otherwise they will become obsolete in the future
 tommorow_obj = date.today() + timedelta(days=1)
@@ -135,6 +190,50 @@ def test_class_Trip_errors():
         Trip(mydict=modified_trip_dict)
 
 
+def test_compiled_schema():
+    raw_trip = _SEARCH_RESULTS_DICT["trips"][0]
+    segments = [Segment(mydict=_DEFAULT_SEGMENT_DICT)]
+    trip = Trip._from_raw(raw_trip, segments)
+    assert trip.price == 66.0
+    assert trip.segments == segments
+    assert trip.segment_ids == [segments[0].id]
+    assert trip.departure_date_obj == Trip(
+        mydict=_DEFAULT_TRIP_DICT).departure_date_obj
+
+    comfort_class = ComfortClass._from_raw(dict(
+        _DEFAULT_COMFORT_CLASS_DICT, description=None, options=None))
+    assert comfort_class.description == ""
+    assert comfort_class.options == {}
+
+    # Same error messages as when building from a dict
+    with pytest.raises(TypeError, match="Type <class 'str'> expected for "
+                                        "currency, <class 'int'> received"):
+        Trip._from_raw(dict(raw_trip, currency=978), segments)
+    with pytest.raises(TypeError, match="Type <class 'str'> expected for "
+                                        "currency, <class 'int'> received"):
+        Trip(mydict=dict(_DEFAULT_TRIP_DICT, currency=978))
+
+
+def test_value_pool():
+    pool = trainline.ValuePool()
+    pages = [json.loads(json.dumps(_SEARCH_RESULTS_DICT)) for _ in range(2)]
+    first, second = [trainline._get_folders(page, value_pool=pool)[0]
+                     for page in pages]
+    assert first.currency is second.currency
+    segments = [folder.trips[0].segments[0] for folder in (first, second)]
+    assert segments[0].carrier is segments[1].carrier
+    assert segments[0].comfort_classes[0].name is \
+        segments[1].comfort_classes[0].name
+    assert segments[0].id is not segments[1].id  # Not pooled
+
+    pool = trainline.ValuePool(max_size=1)
+    assert pool.intern("".join(["EU", "R"])) is pool.intern("EUR")
+    chf = "".join(["CH", "F"])
+    assert pool.intern(chf) is chf  # Full : not shared
+    assert len(pool) == 1
+    assert pool.intern(None) is None
+
+
 def test_class_Passenger():
     p1 = Passenger(birthdate="01/01/1980")
     print()
@@ -374,3 +473,409 @@ def test_basic_search_with_card():
     assert len(results) > 0
 
     display_trips(results)
+
+
+def test_class_CircuitBreaker():
+    changes = []
+    breaker = trainline.CircuitBreaker(name="test", minimum_calls=2,
+                                       reset_timeout=0.05)
+    breaker.add_listener(lambda b, old, new: changes.append((old, new)))
+    assert breaker.state == breaker.CLOSED
+
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN  # 50% of failed requests
+    assert breaker.allow_request() is False
+
+    time.sleep(0.06)
+    assert breaker.allow_request() is True  # Trial request
+    assert breaker.allow_request() is False
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert changes == [("closed", "open"), ("open", "half_open"),
+                       ("half_open", "closed")]
+
+
+class _FakeResponse(object):
+    def __init__(self, status_code, text="{}"):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf8")
+
+
+class _FakeTransport(object):
+    """ Returns the responses (or raises the exceptions) in order """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests_nb = 0
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.requests_nb += 1
+        ret = self.responses.pop(0)
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+
+@pytest.fixture
+def search_breaker(monkeypatch):
+    monkeypatch.setattr(trainline, "_TIME_AFTER_FAILED_REQUEST", 0)
+    breaker = trainline.get_circuit_breaker(trainline._SEARCH_URL)
+    breaker.reset()
+    yield breaker
+    breaker.reset()
+    breaker.listeners = []
+
+
+def test_circuit_breaker_fail_fast(search_breaker):
+    for _ in range(search_breaker.minimum_calls):
+        search_breaker.record_failure()
+    assert search_breaker.state == search_breaker.OPEN
+
+    with pytest.raises(trainline.CircuitOpenError):
+        trainline.Client()._post(url=trainline._SEARCH_URL, post_data="{}")
+
+
+def test_circuit_breaker_cache(search_breaker):
+    # Passengers ids differ for every search, but the cached response matches
+    def post_data():
+        passenger = Passenger(birthdate="01/01/1980")
+        return json.dumps({"search": {"passengers": [passenger.get_dict()]}})
+
+    cache = trainline.ResponseCache(maxsize=1)
+    c = trainline.Client(cache=cache,
+                         transport=_FakeTransport(_FakeResponse(200, "[1]")))
+    c._post(url=trainline._SEARCH_URL, post_data=post_data())
+    assert len(cache) == 1
+
+    for _ in range(search_breaker.minimum_calls):
+        search_breaker.record_failure()
+    ret = c._post(url=trainline._SEARCH_URL, post_data=post_data())
+    assert ret.text == "[1]"
+
+
+def test_circuit_breaker_listener_reads_state(search_breaker):
+    states = []
+    search_breaker.add_listener(
+        lambda b, old, new: states.append((b.state, b.failure_rate)))
+    for _ in range(search_breaker.minimum_calls):
+        search_breaker.record_failure()  # Must not deadlock
+    assert states == [("open", 1.0)]
+
+
+def test_circuit_breaker_open_during_retries(search_breaker):
+    c = trainline.Client(transport=_FakeTransport(
+        *[_FakeResponse(503, "unavailable")] * 10))
+    with pytest.raises(ConnectionError) as e:
+        c._post(url=trainline._SEARCH_URL, post_data="{}")
+    assert not isinstance(e.value, trainline.CircuitOpenError)
+    assert "503" in str(e.value)  # The error of the request actually sent
+    assert search_breaker.state == search_breaker.OPEN
+
+
+def test_circuit_breaker_client_errors(search_breaker):
+    # Invalid requests are not retried, and do not open the circuit
+    for _ in range(2 * search_breaker.minimum_calls):
+        transport = _FakeTransport(_FakeResponse(400, "bad request"),
+                                   _FakeResponse(200))
+        c = trainline.Client(transport=transport)
+        with pytest.raises(ConnectionError) as e:
+            c._post(url=trainline._SEARCH_URL, post_data="{}")
+        assert "400" in str(e.value)
+        assert transport.requests_nb == 1
+    assert search_breaker.state == search_breaker.CLOSED
+
+    # Too many requests : retried, and counted as failures
+    c = trainline.Client(transport=_FakeTransport(
+        *[_FakeResponse(429, "slow down")] * 10))
+    with pytest.raises(ConnectionError):
+        c._post(url=trainline._SEARCH_URL, post_data="{}")
+    assert search_breaker.failure_rate > 0
+
+
+def test_circuit_breaker_half_open_trial(search_breaker):
+    search_breaker.reset_timeout = 0
+    try:
+        for _ in range(search_breaker.minimum_calls):
+            search_breaker.record_failure()
+        # The trial request does not reach the server : trial given back
+        c = trainline.Client(transport=_FakeTransport(LookupError("miss")))
+        with pytest.raises(LookupError):
+            c._post(url=trainline._SEARCH_URL, post_data="{}")
+        assert search_breaker.allow_request() is True
+        search_breaker.release_trial()
+
+        # Any request error is a failure of the trial
+        c = trainline.Client(transport=_FakeTransport(
+            requests.Timeout("timeout"), _FakeResponse(200)))
+        with pytest.raises(requests.Timeout):
+            c._post(url=trainline._SEARCH_URL, post_data="{}")
+        assert c._post(url=trainline._SEARCH_URL, post_data="{}").text == "{}"
+        assert search_breaker.state == search_breaker.CLOSED
+    finally:
+        search_breaker.reset_timeout = trainline._BREAKER_RESET_TIMEOUT
+
+
+def test_instrumentation_hooks():
+    spans = []
+    trainline.add_hook(spans.append)
+    try:
+        folders = trainline._get_folders(
+            search_results_obj=copy.deepcopy(_SEARCH_RESULTS_DICT))
+    finally:
+        trainline.remove_hook(spans.append)
+    assert len(folders) == 1
+    assert [span.name for span in spans] == [
+        "parse.comfort_classes", "parse.segments",
+        "parse.trips", "parse.folders"]
+    for span in spans:
+        assert span.attributes["count"] == 1
+        assert span.duration >= 0
+
+    # No hook registered : no span is created
+    assert trainline._span("search") is trainline._NULL_SPAN
+
+
+def test_instrumentation_search_spans(monkeypatch):
+    monkeypatch.setattr(trainline, "_TIME_AFTER_FAILED_REQUEST", 0)
+    trainline.get_circuit_breaker(trainline._SEARCH_URL).reset()
+    text = json.dumps(_paginated_search_results())
+    session = Trainline(transport=_FakeTransport(
+        _FakeResponse(500), _FakeResponse(200, text)))
+
+    def faulty_hook(span):
+        raise ValueError("bug in a hook")
+
+    spans = []
+    trainline.add_hook(faulty_hook)  # Must not break the search
+    trainline.add_hook(spans.append)
+    try:
+        results = trainline.search(
+            departure_station="Toulouse Matabiau",
+            arrival_station="Bordeaux St-Jean",
+            from_date="15/10/2018 08:00",
+            to_date="15/10/2018 10:00",
+            trainline_session=session)
+    finally:
+        trainline.remove_hook(faulty_hook)
+        trainline.remove_hook(spans.append)
+    assert len(results) == 1
+
+    spans = {span.name: span for span in spans}
+    http_span = spans["http.post"]
+    assert http_span.attributes["status_code"] == 200
+    assert http_span.attributes["retries"] == 1
+    assert http_span.attributes["bytes"] == len(text)
+    assert http_span.parent is spans["search"]
+    assert spans["search"].attributes["pages"] == 1
+    assert spans["search"].attributes["count"] == 1
+
+
+def test_lazy_imports():
+    # `import trainline` must not import requests nor pytz (more than
+    # 100 ms), only the searches do
+    import subprocess
+    import sys
+    ret = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, trainline; print(' '.join(sorted(sys.modules)))"],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = ret.stdout.split()
+    for module in ["requests", "pytz", "uuid"]:
+        assert module not in modules
+
+
+def test_lazy_exceptions():
+    assert trainline.ConnectionError is ConnectionError
+    assert issubclass(trainline.CircuitOpenError, ConnectionError)
+    assert trainline.CircuitOpenError.__name__ == "CircuitOpenError"
+    with pytest.raises(AttributeError):
+        trainline.NotAnAttribute
+
+
+def test_token_store(tmpdir):
+    import os
+    from trainline import stubserver
+    store = trainline.TokenStore(str(tmpdir.join("store", "tokens.json")))
+    assert store.get("me@example.com") is None
+    with stubserver.StubServer(page_size=5) as stub:
+        def _session():
+            return Trainline(email_account="me@example.com",
+                             password_account="secret",
+                             transport=stub.transport(), token_store=store)
+
+        session = _session()
+        assert stub.signins_nb == 1
+        assert os.stat(store.filename).st_mode & 0o777 == 0o600
+        assert store.get("ME@example.com")["token"] == session.token_session
+
+        # The next sessions start without signing in
+        session = _session()
+        assert stub.signins_nb == 1
+        passenger = Passenger(birthdate="01/01/1990", firstname="Pierre",
+                              lastname="Martin", trainline_session=session)
+
+        # A rejected token is renewed transparently
+        stub.revoke_tokens()
+        old_token = session.token_session
+        ret = session.search(TOULOUSE_STATION_ID, BORDEAUX_STATION_ID,
+                             "2018-10-15T08:00:00+0200",
+                             [passenger.get_dict()])
+        assert ret.status_code == 200
+        assert stub.signins_nb == 2
+        assert session.token_session != old_token
+        assert store.get("me@example.com")["token"] == session.token_session
+
+    # Expired sessions, and files readable by other users, are ignored
+    assert trainline.TokenStore(store.filename, ttl=0).get(
+        "me@example.com") is None
+    os.chmod(store.filename, 0o644)
+    assert store.get("me@example.com") is None
+
+
+def test_account_passengers_index():
+    from trainline import stubserver
+    with stubserver.StubServer() as stub:
+        session = Trainline(email_account="me@example.com",
+                            password_account="secret",
+                            transport=stub.transport())
+    pierre, enzo = session.get_passengers([
+        ("pierre", "MARTIN", "01/01/1990"),
+        ("Enzo", "Martin", "03/01/1990")])
+    assert pierre.id == session.account_passengers[0]["id"]
+    assert pierre.cards == session.account_cards
+    assert enzo.id == session.account_passengers[2]["id"]
+    assert enzo.cards == []
+
+    with pytest.raises(KeyError) as e:
+        session.get_passengers([("Pierre", "Martin", "02/01/1990"),
+                                ("Paul", "Martin", "01/01/1990")])
+    assert "Pierre Martin, Paul Martin" in str(e.value)
+
+
+def test_search_systems():
+    from trainline import stubserver
+    with stubserver.StubServer(page_size=10) as stub:
+        results = trainline.search(
+            departure_station="Toulouse Matabiau",
+            arrival_station="Bordeaux St-Jean",
+            from_date="15/10/2018 08:00",
+            to_date="15/10/2018 12:00",
+            systems=["flixbus", "busbud"],
+            trainline_session=Trainline(transport=stub.transport()))
+    assert len(results) > 0
+    assert {folder.transportation_mean for folder in results} == {"coach"}
+
+    with pytest.raises(KeyError):
+        Trainline()._search_payload("5311", "828", [], systems=["eurostar"])
+
+
+def test_search_payload():
+    passenger = Passenger(birthdate="01/01/1980").get_dict()
+    payload = Trainline()._search_payload("5311", "828", [passenger])
+    post_data = payload.render("2018-10-15T08:00:00+0200")
+    assert json.loads(post_data) == {
+        "local_currency": "EUR",
+        "search": {
+            "arrival_station_id": "828",
+            "departure_date": "2018-10-15T08:00:00+0200",
+            "departure_station_id": "5311",
+            "systems": list(trainline.SYSTEMS),
+            "passengers": [passenger],
+        }
+    }
+
+
+def test_folder_filter():
+    from_date_obj = trainline._str_datetime_to_datetime_obj(
+        "15/10/2018 08:00", date_format=trainline._READABLE_DATE_FORMAT)
+    to_date_obj = trainline._str_datetime_to_datetime_obj(
+        "15/10/2018 10:00", date_format=trainline._READABLE_DATE_FORMAT)
+    search_results = _paginated_search_results()
+    # The later folder refers to an invalid trip, which is never built
+    search_results["folders"][1]["trip_ids"] = ["invalid_trip"]
+    search_results["trips"].append({"id": "invalid_trip", "cents": 100})
+
+    spans = []
+    trainline.add_hook(spans.append)
+    try:
+        folders = trainline._get_folders(
+            search_results, folder_filter=trainline._FolderFilter(
+                from_date_obj=from_date_obj, to_date_obj=to_date_obj,
+                transportation_mean="train"))
+    finally:
+        trainline.remove_hook(spans.append)
+    assert [folder.id for folder in folders] == [
+        "f721d0a4a2cb11e880abfc0416222638"]
+    counts = {span.name: (span.attributes.get("count_in"),
+                          span.attributes["count"]) for span in spans}
+    assert counts["filter.raw"] == (2, 1)
+    assert counts["parse.trips"] == (None, 1)
+    assert counts["filter"] == (1, 1)
+
+    # Criteria checked on the built folders
+    assert trainline._FolderFilter(
+        transportation_mean="coach").filter(folders) == []
+    assert trainline._FolderFilter(max_price=65).filter(folders) == []
+    assert trainline._FolderFilter(max_price=66).filter(folders) == folders
+    assert trainline._filter_folders(
+        folders, max_segment_nb=1, min_price=66) == folders
+
+
+def test_search_fields():
+    from trainline import stubserver
+    with stubserver.StubServer(page_size=10) as stub:
+        session = Trainline(transport=stub.transport())
+        search_params = dict(
+            departure_station="Toulouse Matabiau",
+            arrival_station="Bordeaux St-Jean",
+            from_date="15/10/2018 08:00",
+            to_date="15/10/2018 18:00",
+            transportation_mean="train",
+            trainline_session=session)
+        folders = trainline.search(**search_params)
+        rows = trainline.search(fields=trainline.PROJECTION_FIELDS,
+                                **search_params)
+        prices = list(trainline.iter_search(fields=["price"],
+                                            **search_params))
+        iterated = list(trainline.iter_search(**search_params))
+    assert len(folders) > 10  # Several pages
+    # Same results, in the same order (but for equal departure dates)
+    assert [row.departure_date for row in rows] == \
+        [folder.departure_date_obj for folder in folders]
+    assert sorted((row.departure_date, row.arrival_date, row.price,
+                   row.transportation_mean, row.segment_nb)
+                  for row in rows) == \
+        sorted((folder.departure_date_obj, folder.arrival_date_obj,
+                folder.price, folder.transportation_mean, folder.segment_nb)
+               for folder in folders)
+    assert rows[0].duration == int((folders.folders[0].arrival_date_obj -
+                                    folders.folders[0].departure_date_obj)
+                                   .total_seconds() // 60)
+    assert sorted(row.price for row in prices) == \
+        sorted(folder.price for folder in folders)
+    assert set(iterated) == set(folders.folders)
+
+    with pytest.raises(ValueError):
+        trainline.search(fields=["price", "unknown"], **search_params)
+    with pytest.raises(ValueError):
+        trainline.search(fields=["price"],
+                         bicycle_with_or_without_reservation=True,
+                         **search_params)
+
+
+def test_project_folders():
+    search_results = _paginated_search_results()
+    search_results["folders"].append(dict(search_results["folders"][0]))
+    projected = trainline._project_folders(
+        search_results, ("id", "price", "segment_nb"),
+        folder_filter=trainline._FolderFilter(transportation_mean="train"))
+    rows = trainline._unique_rows(projected)
+    assert len(projected) == 3
+    assert [row.id for row in rows] == [
+        "f721d0a4a2cb11e880abfc0416222638",
+        "f721d0a4a2cb11e880abfc0416222639"]
+    assert trainline._project_folders(
+        search_results, ("id",),
+        folder_filter=trainline._FolderFilter(min_segment_nb=2)) == []
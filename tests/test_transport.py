@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.transport` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_transport.py
+
+import json
+import time
+
+import pytest
+import trainline
+from trainline import transport
+
+from test_trainline import _paginated_search_results
+
+
+class _ServerTransport(object):
+    """ Always returns the same search results """
+
+    def __init__(self):
+        self.requests_nb = 0
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.requests_nb += 1
+        return transport.ReplayedResponse(200, json.dumps(_paginated_search_results()))
+
+
+def _search(session):
+    return trainline.search(
+        departure_station="Toulouse Matabiau",
+        arrival_station="Bordeaux St-Jean",
+        from_date="15/10/2018 08:00",
+        to_date="15/10/2018 09:00",
+        trainline_session=session)
+
+
+def test_record_and_replay(tmpdir):
+    filename = str(tmpdir.join("search.cassette.gz"))
+    server = _ServerTransport()
+    with transport.Cassette(filename) as cassette:
+        session = trainline.Trainline(transport=transport.RecordTransport(
+            cassette, transport=server))
+        results = _search(session)
+    assert server.requests_nb == 1  # The later folder stops the pagination
+    assert len(cassette) == 1
+    assert len(results) == 1
+
+    # Passengers ids are different for every search, but the request matches
+    replay = transport.ReplayTransport(transport.Cassette(filename))
+    results = _search(trainline.Trainline(transport=replay))
+    assert len(results) == 1
+    assert results[0].price == 66.0
+
+
+def test_replay_unknown_request():
+    replay = transport.ReplayTransport(transport.Cassette())
+    with pytest.raises(transport.ReplayMissError):
+        replay.post(url=trainline._SEARCH_URL, data="{}")
+
+    # A cassette miss is not a failure of the server
+    breaker = trainline.get_circuit_breaker(trainline._SEARCH_URL)
+    breaker.reset()
+    client = trainline.Client(transport=replay)
+    for _ in range(breaker.minimum_calls):
+        with pytest.raises(LookupError):
+            client._post(url=trainline._SEARCH_URL, post_data="{}")
+    assert breaker.state == breaker.CLOSED
+    assert breaker.failure_rate == 0.0
+
+
+def test_throttled_transport():
+    server = _ServerTransport()
+    throttled = transport.ThrottledTransport(20, transport=server)
+    session = trainline.Trainline(transport=throttled)
+    start = time.monotonic()
+    for _ in range(5):
+        _search(session)
+    assert server.requests_nb >= 5
+    assert time.monotonic() - start >= (server.requests_nb - 1) / 20
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for `trainline.watch` module."""
+
+# To be tested with : python3 -m pytest -vs tests/test_watch.py
+
+import time
+
+import pytest
+import trainline
+from trainline import batch, stubserver, watch
+
+_ROUTE = ("Toulouse Matabiau", "Bordeaux St-Jean", "15/10/2018 08:00",
+          "15/10/2018 18:00")
+
+
+@pytest.fixture(scope="module")
+def session():
+    with stubserver.StubServer(page_size=10) as stub:
+        yield trainline.Trainline(transport=stub.transport())
+
+
+def _row(departure_date, price):
+    return trainline._projection(watch._FIELDS)(
+        departure_date, "2018-10-15T12:00:00+02:00", "train", 1, price, "EUR")
+
+
+def test_diff():
+    old = watch.snapshot([_row("A", 30.0), _row("A", 25.0), _row("B", 40.0),
+                          _row("C", 50.0)])
+    assert old[watch.departure_key(_row("A", 0))].price == 25.0
+    new = watch.snapshot([_row("A", 25.0), _row("B", 45.0), _row("D", 20.0)])
+    events = watch.diff(old, new)
+    assert [(event.kind, event.key[0], event.old_price, event.new_price)
+            for event in events] == [
+        (watch.PRICE_CHANGED, "B", 40.0, 45.0),
+        (watch.REMOVED, "C", 50.0, None),
+        (watch.NEW, "D", None, 20.0)]
+    assert watch.diff(new, new) == []
+
+
+def test_poll(session):
+    watcher = watch.Watcher(trainline_session=session)
+    subscription = watcher.subscribe(*_ROUTE)
+    assert watcher.poll(subscription) == []  # Baseline
+    assert subscription.polls_nb == 1 and len(subscription.snapshot) > 1
+    assert watcher.poll(subscription) == []
+
+    first_key, second_key = list(subscription.snapshot)[:2]
+    row = subscription.snapshot[first_key]
+    subscription.snapshot[first_key] = row._replace(price=row.price + 1)
+    del subscription.snapshot[second_key]
+    removed_key = (row.departure_date.replace(year=2000),) + first_key[1:]
+    subscription.snapshot[removed_key] = row
+    events = watcher.poll(subscription)
+    assert sorted(event.kind for event in events) == [
+        watch.NEW, watch.PRICE_CHANGED, watch.REMOVED]
+    assert all(event.subscription is subscription for event in events)
+
+    failing = watcher.subscribe("Nowhere", *_ROUTE[1:])
+    assert watcher.poll(failing) == []
+    assert failing.errors_nb == 1 and isinstance(failing.last_error,
+                                                 KeyError)
+    assert failing.snapshot is None
+
+
+def test_run(session, monkeypatch):
+    watcher = watch.Watcher(trainline_session=session, max_rate=100)
+    subscriptions = [watcher.subscribe(*_ROUTE, interval=0.05),
+                     watcher.subscribe(*_ROUTE, interval=0.05)]
+    polled = []
+    poll = watcher.poll
+
+    def poll_changing(subscription):
+        # Every poll finds a new price for one departure
+        if subscription.snapshot:
+            key = next(iter(subscription.snapshot))
+            subscription.snapshot[key] = subscription.snapshot[key]._replace(
+                price=-1)
+        polled.append(subscription)
+        return poll(subscription)
+    monkeypatch.setattr(watcher, "poll", poll_changing)
+    events = []
+    watcher.add_listener(events.append)
+    watcher.run(duration=1)
+    for subscription in subscriptions:
+        assert subscription.polls_nb >= 3
+    # One change by poll, except the first one of each subscription
+    assert len(events) == len(polled) - 2
+    assert {event.kind for event in events} == {watch.PRICE_CHANGED}
+
+    watcher.unsubscribe(subscriptions[0])
+    polls_nb = subscriptions[0].polls_nb
+    for event in watcher.events(duration=0.5):
+        assert event.subscription is subscriptions[1]
+        watcher.stop()
+    assert subscriptions[0].polls_nb == polls_nb
+
+
+def test_events_busy_workers(session, monkeypatch):
+    # The polls are always due, but the only worker is busy with a slow
+    # search : the watcher waits for its end instead of spinning
+    watcher = watch.Watcher(trainline_session=session, max_rate=1000,
+                            workers=1)
+    subscriptions = [watcher.subscribe(*_ROUTE, interval=0.001),
+                     watcher.subscribe(*_ROUTE, interval=0.001)]
+    poll = watcher.poll
+
+    def slow_poll(subscription):
+        time.sleep(0.1)
+        return poll(subscription)
+    monkeypatch.setattr(watcher, "poll", slow_poll)
+    waits = []
+    real_wait = watch.wait
+
+    def counting_wait(*args, **kwargs):
+        waits.append(kwargs.get("timeout"))
+        return real_wait(*args, **kwargs)
+    monkeypatch.setattr(watch, "wait", counting_wait)
+    list(watcher.events(duration=0.5))
+    polls_nb = sum(subscription.polls_nb for subscription in subscriptions)
+    assert polls_nb >= 3
+    # About one wait per poll (at most 5 slow polls in 0.5 s)
+    assert len(waits) <= 10
+    assert all(timeout is None or timeout > 0 for timeout in waits)
+
+
+def test_rate_limiter():
+    now = [0.0]
+    limiter = batch.RateLimiter(2, burst=2, clock=lambda: now[0])
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert limiter.delay() == pytest.approx(0.5)
+    now[0] += 0.5
+    assert limiter.try_acquire() and not limiter.try_acquire()
+    now[0] += 10
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
@@ -3,16 +3,17 @@
 
 """Top-level package for Trainline."""
 
-import requests
-from requests import ConnectionError
+# requests (and its exceptions), pytz, uuid, copy and re are imported on
+# first use, to keep `import trainline` and the CLI startup fast
+import io
 import json
 from datetime import datetime, timedelta, date
-import pytz
 import time
-import uuid
 import os
-import copy
-import re
+import threading
+import logging
+from collections import deque, namedtuple, OrderedDict
+from functools import lru_cache
 
 __author__ = """Thibault Ducret"""
 __email__ = 'hello@tducret.com'
@@ -22,10 +23,23 @@ _SEARCH_URL = "https://www.trainline.eu/api/v5_1/search"
 _LOGIN_URL = "https://www.trainline.fr/api/v5_1/account/signin"
 _DEFAULT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 _BIRTHDATE_FORMAT = '%d/%m/%Y'
+_ACCOUNT_BIRTHDATE_FORMAT = '%Y-%m-%dT00:00:00+00:00'
 _READABLE_DATE_FORMAT = "%d/%m/%Y %H:%M"
+_DATE_FORMAT = "%d/%m/%Y"  # Day of a search (ex : fare_calendar)
 _DEFAULT_SEARCH_TIMEZONE = 'Europe/Paris'
 _MAX_SERVER_RETRY = 3  # If a request is rejected, retry X times
 _TIME_AFTER_FAILED_REQUEST = 10  # and wait Y seconds after a rejected request
+_REQUEST_TIMEOUT = 30  # Seconds without response before a request fails
+_RESPONSE_CACHE_SIZE = 256  # Responses kept by default in a ResponseCache
+_VALUE_POOL_SIZE = 10000  # Distinct values shared by default in a ValuePool
+_BREAKER_FAILURE_RATE = 0.5  # Open the circuit above 50% of failed requests
+_BREAKER_MINIMUM_CALLS = 4  # among at least X requests
+_BREAKER_WINDOW_SIZE = 20  # of the last Y requests
+_BREAKER_RESET_TIMEOUT = 60  # and retry Z seconds after the circuit opened
+_AUTH_FAILURE_STATUS_CODES = (401, 403)  # Token rejected, log in again
+_TOO_MANY_REQUESTS = 429  # The only client error retried (and counted)
+_TOKEN_TTL = 7 * 24 * 3600  # Seconds during which a stored token is reused
+_TOKEN_STORE_FILE = os.path.join("~", ".trainline", "tokens.json")
 
 ENFANT_PLUS = "SNCF.CarteEnfantPlus"
 JEUNE = "SNCF.Carte1225"
@@ -40,17 +54,524 @@ _AVAILABLE_CARDS = [ENFANT_PLUS, JEUNE, WEEK_END, SENIOR, AVANTAGE_FAMILLE,
                     AVANTAGE_JEUNE, AVANTAGE_WEEK_END]
 _SPECIAL_CARDS = [TGVMAX]
 
+# Carriers (and aggregators) searched by default, see search(systems=...)
+SYSTEMS = ("sncf", "db", "idtgv", "ouigo", "trenitalia", "ntv", "hkx",
+           "renfe", "cff", "benerail", "ocebo", "westbahn", "leoexpress",
+           "locomore", "busbud", "flixbus", "distribusion",
+           "cityairporttrain", "obb", "timetable")
+_COACH_ONLY_SYSTEMS = ("busbud",)  # Not searched for trains only
+
+# Fields of the folders which can be returned by search(fields=...)
+PROJECTION_FIELDS = ("id", "departure_date", "arrival_date", "duration",
+                     "departure_station_id", "arrival_station_id", "price",
+                     "currency", "transportation_mean", "segment_nb")
+
 _DEFAULT_PASSENGER_BIRTHDATE = "01/01/1980"
+# Fields of the passengers in the search payload which are random for every
+# search (generated with uuid4)
+_VOLATILE_PASSENGER_FIELDS = ("id", "label")
 
 _SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 _STATIONS_CSV = os.path.join(_SCRIPT_PATH, "stations_mini.csv")
 
 
-class Client(object):
-    """ Do the requests with the servers """
+# Instrumentation hooks, called with every finished Span
+_HOOKS = []
+_LOGGER = logging.getLogger(__name__)
+_SPAN_STACK = threading.local()
+
+
+def add_hook(hook):
+    """ Register an instrumentation hook : a callable receiving every
+    finished Span (search phases and HTTP calls) """
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """ Unregister an instrumentation hook """
+    _HOOKS.remove(hook)
+
+
+class Span(object):
+    """ Class to represent a timed phase of a search (ex : "http.post",
+    "parse.folders"), with its attributes (ex : "bytes", "count") """
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None  # time.time() at the beginning of the phase
+        self.perf_start = None  # time.perf_counter() (to order the spans)
+        self.duration = None  # in seconds
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = _SPAN_STACK.__dict__.setdefault("spans", [])
+        if stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.perf_start
+        self.error = exc_value
+        _SPAN_STACK.spans.pop()
+        for hook in list(_HOOKS):
+            try:
+                hook(self)
+            except Exception:
+                # A faulty hook must not break the searches
+                _LOGGER.exception("Instrumentation hook %r failed", hook)
+        return False
+
+    def __repr__(self):
+        return "[Span] {} : {:.6f}s {}".format(
+            self.name, self.duration or 0, self.attributes)
+
+
+class _NullSpan(object):
+    """ Span used when no hook is registered (does nothing) """
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _span(name, **attributes):
+    """ Returns a Span for the phase, or a no-op span if no hook is
+    registered (to keep the overhead near zero) """
+    if not _HOOKS:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+def _circuit_open_error():
+    """ Returns the CircuitOpenError class, which inherits from
+    requests.ConnectionError (so it is only defined when requests is
+    imported) """
+    global _CIRCUIT_OPEN_ERROR
+    with _CIRCUIT_OPEN_ERROR_LOCK:
+        if _CIRCUIT_OPEN_ERROR is None:
+            from requests import ConnectionError
+
+            class CircuitOpenError(ConnectionError):
+                """ Raised when a request is rejected because the circuit
+                of its endpoint is open (the server failed too often
+                recently) """
+                pass
+            CircuitOpenError.__module__ = __name__
+            CircuitOpenError.__qualname__ = "CircuitOpenError"
+            _CIRCUIT_OPEN_ERROR = CircuitOpenError
+    return _CIRCUIT_OPEN_ERROR
+
+
+_CIRCUIT_OPEN_ERROR = None
+_CIRCUIT_OPEN_ERROR_LOCK = threading.Lock()
+
+
+def __getattr__(name):
+    """ Import the exceptions of requests on first access (PEP 562) :
+    trainline.ConnectionError and trainline.CircuitOpenError """
+    if name == "ConnectionError":
+        from requests import ConnectionError
+        return ConnectionError
+    if name == "CircuitOpenError":
+        return _circuit_open_error()
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
+
+
+def _account_passenger_key(firstname, lastname, birthdate):
+    """ Returns the index key of an account passenger
+    >>> _account_passenger_key("Pierre", "MARTIN", "1990-01-01T00:00:00+00:00")
+    ('pierre', 'martin', '1990-01-01T00:00:00+00:00')
+    """
+    return (firstname.lower(), lastname.lower(), birthdate)
+
+
+def _is_auth_failure(error):
+    """ Returns True if the error is a request rejected for its token """
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) in \
+        _AUTH_FAILURE_STATUS_CODES
+
+
+def _is_client_error(status_code):
+    """ Returns True for a 4xx status code other than 429 : the request is
+    invalid, but the endpoint is healthy """
+    return 400 <= status_code < 500 and status_code != _TOO_MANY_REQUESTS
+
+
+def _connection_error(status_code, url, text, response=None):
+    """ Returns the requests.ConnectionError of a rejected request """
+    from requests import ConnectionError
+    return ConnectionError(
+        'Status code {status} for url {url}\n{content}'.format(
+            status=status_code, url=url, content=text), response=response)
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker protecting one endpoint of the servers
+
+    - closed : requests are sent, their results are recorded in a sliding
+      window. When the failure rate of the window exceeds
+      failure_rate_threshold (with at least minimum_calls requests), the
+      circuit opens
+    - open : requests fail fast (or are served from cache) during
+      reset_timeout seconds, then the circuit becomes half-open
+    - half-open : half_open_max_calls trial requests are sent. The circuit
+      closes if they succeed, and opens again at the first failure
+
+    Listeners are called with (breaker, old_state, new_state) at every
+    state change """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name,
+                 failure_rate_threshold=_BREAKER_FAILURE_RATE,
+                 minimum_calls=_BREAKER_MINIMUM_CALLS,
+                 window_size=_BREAKER_WINDOW_SIZE,
+                 reset_timeout=_BREAKER_RESET_TIMEOUT,
+                 half_open_max_calls=1):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.listeners = []
+        self._state = self.CLOSED
+        self._window = deque(maxlen=window_size)  # True if the call failed
+        self._opened_at = None
+        self._half_open_calls = 0
+        self._transitions = []  # State changes not notified yet
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh_state()
+            state = self._state
+        self._notify()
+        return state
+
+    @property
+    def failure_rate(self):
+        with self._lock:
+            if not self._window:
+                return 0.0
+            return sum(self._window) / len(self._window)
+
+    def add_listener(self, callback):
+        """ Register a callback(breaker, old_state, new_state) """
+        self.listeners.append(callback)
+
+    def allow_request(self):
+        """ Returns True if a request can be sent to the endpoint """
+        with self._lock:
+            self._refresh_state()
+            allowed = False
+            if self._state == self.CLOSED:
+                allowed = True
+            elif self._state == self.HALF_OPEN:
+                if self._half_open_calls < self.half_open_max_calls:
+                    self._half_open_calls += 1
+                    allowed = True
+        self._notify()
+        return allowed
+
+    def release_trial(self):
+        """ Give back a half-open trial which has not reached the server """
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._window.clear()
+                self._set_state(self.CLOSED)
+            else:
+                self._window.append(False)
+        self._notify()
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open()
+            else:
+                self._window.append(True)
+                if self._state == self.CLOSED and \
+                        len(self._window) >= self.minimum_calls and \
+                        sum(self._window) / len(self._window) >= \
+                        self.failure_rate_threshold:
+                    self._open()
+        self._notify()
+
+    def reset(self):
+        """ Close the circuit and forget the recorded calls """
+        with self._lock:
+            self._window.clear()
+            self._set_state(self.CLOSED)
+        self._notify()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._set_state(self.OPEN)
+
+    def _refresh_state(self):
+        if self._state == self.OPEN and \
+                time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+
+    def _set_state(self, new_state):
+        """ Change the state (with the lock held). The listeners are called
+        later by _notify, once the lock is released """
+        old_state = self._state
+        if new_state == old_state:
+            return
+        self._state = new_state
+        self._half_open_calls = 0
+        self._transitions.append((old_state, new_state))
+
+    def _notify(self):
+        """ Call the listeners with the state changes (without the lock, so
+        that they can read the state of the breaker) """
+        with self._lock:
+            transitions, self._transitions = self._transitions, []
+        for old_state, new_state in transitions:
+            for callback in self.listeners:
+                callback(self, old_state, new_state)
+
+    def __repr__(self):
+        return "[CircuitBreaker] {} : {}".format(self.name, self._state)
+
+
+# One circuit breaker per endpoint, shared by every Client
+_CIRCUIT_BREAKERS = {
+    _SEARCH_URL: CircuitBreaker(name="search"),
+    _LOGIN_URL: CircuitBreaker(name="login"),
+}
+
+
+def get_circuit_breaker(url):
+    """ Returns the circuit breaker protecting an endpoint
+    (None if the endpoint is not protected) """
+    return _CIRCUIT_BREAKERS.get(url)
+
+
+def _normalize_payload(post_data):
+    """ Returns the payload of a request in a canonical form, without the
+    passengers ids (random for every search), to identify identical requests
+    >>> print(_normalize_payload('{"b": 1, "a": [2, 3]}'))
+    {"a":[2,3],"b":1}
+    >>> print(_normalize_payload('{"search": {"passengers": \
+[{"id": "7a6f", "age": 38, "label": "7a6f"}]}}'))
+    {"search":{"passengers":[{"age":38}]}}
+    """
+    if not post_data:
+        return ""
+    try:
+        payload = json.loads(post_data)
+    except ValueError:
+        return post_data
+    passengers = payload.get("search", {}).get("passengers") \
+        if isinstance(payload, dict) else None
+    for passenger in passengers or []:
+        for field in _VOLATILE_PASSENGER_FIELDS:
+            passenger.pop(field, None)
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"))
+
+
+def _cache_key(url, post_data):
+    return (url, _normalize_payload(post_data))
+
+
+class CachedResponse(object):
+    """ Class to represent a response served from a cache, with the
+    attributes of a requests.Response used by the Client """
+
+    def __init__(self, text, status_code=200):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf8")
 
-    def __init__(self, token=None):
-        self.session = requests.session()
+    def json(self):
+        return json.loads(self.text)
+
+    def __repr__(self):
+        return "[CachedResponse] {} ({} bytes)".format(
+            self.status_code, len(self.content))
+
+
+class ResponseCache(object):
+    """ Cache of the last maxsize responses texts (least recently used
+    responses are dropped first). With a ttl (in seconds), the responses
+    younger than ttl are served without sending their request (see
+    get_fresh) : by default, they are only served while the circuit of
+    their endpoint is open """
+
+    def __init__(self, maxsize=_RESPONSE_CACHE_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._texts = OrderedDict()  # key : (time stored, text)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._texts.get(key)
+            if entry is None:
+                return default
+            self._texts.move_to_end(key)
+            return entry[1]
+
+    def get_fresh(self, key):
+        """ Returns the text of a response younger than ttl, or None """
+        if self.ttl is None:
+            return None
+        with self._lock:
+            entry = self._texts.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                return None
+            self._texts.move_to_end(key)
+            return entry[1]
+
+    def __setitem__(self, key, text):
+        with self._lock:
+            self._texts[key] = (time.monotonic(), text)
+            self._texts.move_to_end(key)
+            while len(self._texts) > self.maxsize:
+                self._texts.popitem(last=False)
+
+    def __len__(self):
+        return len(self._texts)
+
+
+class ValuePool(object):
+    """ Class to share the values repeated on every parsed object (station
+    ids, currencies, carriers, comfort classes...) : each of them is
+    replaced by the first equal value received, instead of one string per
+    object and per page. Up to max_size distinct values are kept """
+
+    def __init__(self, max_size=_VALUE_POOL_SIZE):
+        self.max_size = max_size
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def intern(self, value):
+        """ Returns the pooled value equal to value
+        >>> pool = ValuePool()
+        >>> pool.intern("".join(["EU", "R"])) is pool.intern("EUR")
+        True
+        """
+        pooled = self._values.get(value)
+        if pooled is not None:
+            return pooled
+        if value is None or len(self._values) >= self.max_size:
+            return value
+        return self._values.setdefault(value, value)
+
+
+class TokenStore(object):
+    """ File store of the login sessions (token, passengers and cards),
+    keyed by account email, so that new sessions start without signing in.
+
+    The file is created readable by its owner only, and it is ignored if
+    other users can read or write it. A session is reused during ttl
+    seconds (and Trainline.search logs in again if its token is rejected
+    earlier) """
+
+    def __init__(self, filename=None, ttl=_TOKEN_TTL):
+        self.filename = os.path.expanduser(filename or _TOKEN_STORE_FILE)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(email_account):
+        return email_account.strip().lower()
+
+    def _load(self):
+        try:
+            fd = os.open(self.filename, os.O_RDONLY)
+        except FileNotFoundError:
+            return {}
+        with os.fdopen(fd, "r", encoding="utf8") as f:
+            if os.name == "posix" and os.fstat(f.fileno()).st_mode & 0o077:
+                _LOGGER.warning("Token store %s ignored : it must only be "
+                                "accessible by its owner (chmod 600)",
+                                self.filename)
+                return {}
+            try:
+                return json.load(f)
+            except ValueError:
+                return {}
+
+    def _save(self, sessions):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        temporary_filename = "{}.{}.tmp".format(self.filename, os.getpid())
+        fd = os.open(temporary_filename,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf8") as f:
+            json.dump(sessions, f)
+        os.replace(temporary_filename, self.filename)  # Atomic
+
+    def get(self, email_account):
+        """ Returns the stored session of an account (dict with token,
+        passengers and cards), or None if it is missing or expired """
+        with self._lock:
+            session = self._load().get(self._key(email_account))
+        if session is None or time.time() - session["time"] > self.ttl:
+            return None
+        return session["infos"]
+
+    def set(self, email_account, infos):
+        with self._lock:
+            sessions = self._load()
+            sessions[self._key(email_account)] = {"time": time.time(),
+                                                  "infos": infos}
+            self._save(sessions)
+
+    def delete(self, email_account):
+        with self._lock:
+            sessions = self._load()
+            if sessions.pop(self._key(email_account), None) is not None:
+                self._save(sessions)
+
+
+class Client(object):
+    """ Do the requests with the servers
+
+    If a cache is given (a ResponseCache, or any dict-like object managed
+    by the caller), the texts of successful POST responses are stored in
+    it, and served from it while the circuit of the endpoint is open.
+    The requests are sent with the transport (an object with the get and
+    post methods of a requests session, see trainline.transport), or with
+    a new requests session by default """
+
+    def __init__(self, token=None, cache=None, transport=None):
+        if transport is None:
+            import requests
+            transport = requests.session()
+        self.session = transport
+        self.cache = cache
         self.headers = {
             'Accept': 'application/json',
             'User-Agent': 'CaptainTrain/1574360965(web) (Ember 3.5.1)',
@@ -63,80 +584,238 @@ class Client(object):
 
     def _get(self, url, expected_status_code=200, headers = None):
         if not headers:
-            ret = self.session.get(url=url, headers=self.headers)
+            ret = self.session.get(url=url, headers=self.headers,
+                                   timeout=_REQUEST_TIMEOUT)
         else:
-            ret = self.session.get(url=url, headers=headers)
+            ret = self.session.get(url=url, headers=headers,
+                                   timeout=_REQUEST_TIMEOUT)
         if (ret.status_code != expected_status_code):
-            raise ConnectionError(
-                'Status code {status} for url {url}\n{content}'.format(
-                    status=ret.status_code, url=url, content=ret.text))
+            raise _connection_error(ret.status_code, url, ret.text)
         return ret
 
-    def _post(self, url, post_data, expected_status_code=200):
-        trials = 0
-        while trials <= _MAX_SERVER_RETRY:
-            trials += 1
-            ret = self.session.post(url=url,
-                    headers=self.headers,
-                    data=post_data)
-            if (ret.status_code == expected_status_code):
-                break
-            else:
-                time.sleep(_TIME_AFTER_FAILED_REQUEST)
+    def _post(self, url, post_data, expected_status_code=200, stream=False):
+        """ Send a POST request (retried if it is rejected). With stream,
+        the body of a successful response is not read, unless it is stored
+        in the cache : the transport must accept stream=True (like a
+        requests session) """
+        breaker = get_circuit_breaker(url)
+        endpoint = breaker.name if breaker is not None else url
+        with _span("http.post", url=url, endpoint=endpoint) as span:
+            if self.cache is not None:
+                # One lookup per request : a fresh response (see
+                # ResponseCache.get_fresh), or the fallback of _fail_fast
+                get_fresh = getattr(self.cache, "get_fresh", None)
+                cached_text = get_fresh(_cache_key(url, post_data)) \
+                    if get_fresh is not None else None
+                span.set("cache_hit", cached_text is not None)
+                if cached_text is not None:
+                    span.set("bytes", len(cached_text))
+                    return CachedResponse(cached_text)
+            trials = 0
+            sleep_time = 0
+            status_codes = []  # Status code of every trial
+            ret = None
+            while trials <= _MAX_SERVER_RETRY:
+                if breaker is not None and not breaker.allow_request():
+                    span.set("circuit_open", True)
+                    return self._fail_fast(url, post_data, breaker, span)
+                trials += 1
+                span.set("retries", trials - 1)
+                ret = self._send_post(url, post_data, breaker, stream)
+                status_codes.append(ret.status_code)
+                span.set("status_code", ret.status_code)
+                span.set("status_codes", status_codes)
+                if (ret.status_code == expected_status_code):
+                    if breaker is not None:
+                        breaker.record_success()
+                    if self.cache is not None:
+                        self.cache[_cache_key(url, post_data)] = ret.text
+                    break
+                elif ret.status_code in _AUTH_FAILURE_STATUS_CODES or \
+                        _is_client_error(ret.status_code):
+                    # The server works but rejects the token (Trainline.search
+                    # logs in again) or the request (ex : an unknown
+                    # station) : retrying would not help
+                    if breaker is not None:
+                        breaker.record_success()
+                    break
+                else:
+                    if breaker is not None:
+                        breaker.record_failure()
+                        if breaker.state != CircuitBreaker.CLOSED:
+                            break  # Do not retry, the circuit is now open
+                    if trials > _MAX_SERVER_RETRY:
+                        break
+                    time.sleep(_TIME_AFTER_FAILED_REQUEST)
+                    sleep_time += _TIME_AFTER_FAILED_REQUEST
+                    span.set("sleep_time", sleep_time)
 
-        if (ret.status_code != expected_status_code):
-            raise ConnectionError(
-                'Status code {status} for url {url}\n{content}'.format(
-                    status=ret.status_code, url=url, content=ret.text))
-        return ret
+            if stream and ret.status_code == expected_status_code and \
+                    self.cache is None:
+                span.set("bytes", int(ret.headers.get("Content-Length", 0)))
+            else:
+                span.set("bytes", len(ret.content))
+            if (ret.status_code != expected_status_code):
+                raise _connection_error(ret.status_code, url, ret.text,
+                                        response=ret)
+            return ret
+
+    def _send_post(self, url, post_data, breaker, stream=False):
+        """ Send one POST request. A request error (including a timeout) is
+        recorded as a failure of the endpoint. Any other error (ex : a
+        request missing from a replay cassette) is not, but it gives back
+        its half-open trial to the breaker """
+        kwargs = {"stream": True} if stream else {}
+        if breaker is None:
+            return self.session.post(url=url, headers=self.headers,
+                                     data=post_data,
+                                     timeout=_REQUEST_TIMEOUT, **kwargs)
+        from requests import RequestException
+        sent = False
+        try:
+            ret = self.session.post(url=url, headers=self.headers,
+                                    data=post_data, timeout=_REQUEST_TIMEOUT,
+                                    **kwargs)
+            sent = True
+            return ret
+        except RequestException:
+            sent = True
+            breaker.record_failure()
+            raise
+        finally:
+            if not sent:
+                breaker.release_trial()
+
+    def _fail_fast(self, url, post_data, breaker, span=_NULL_SPAN):
+        """ Returns the cached response of a request whose circuit is open,
+        or raises a CircuitOpenError if it is not cached """
+        if self.cache is not None:
+            cached_text = self.cache.get(_cache_key(url, post_data))
+            span.set("cache_hit", cached_text is not None)
+            if cached_text is not None:
+                return CachedResponse(cached_text)
+        raise _circuit_open_error()(
+            'Circuit {name} is open for url {url}'.format(
+                name=breaker.name, url=url))
 
 
 class Trainline(object):
     """ Class to... """
 
-    def __init__(self, email_account=None, password_account=None):
+    def __init__(self, email_account=None, password_account=None,
+                 cache=None, transport=None, token_store=None,
+                 value_pool=None):
+        # Search responses are stored in the cache (ResponseCache or
+        # dict-like object), and served from it while the circuit is open
+        # (or while they are fresh, see ResponseCache)
+        self.cache = cache
+        # Requests are sent with the transport (see trainline.transport)
+        self.transport = transport
+        # Login sessions are reused from the token store (see TokenStore)
+        self.token_store = token_store
+        # Repeated values of the results are shared (see ValuePool)
+        self.value_pool = value_pool if value_pool is not None \
+            else ValuePool()
+        self._email_account = email_account
+        self._password_account = password_account
         if not email_account or not password_account:
             self.token_session = None
             self.account_passengers = None
             self.account_cards = None
 
         else:
-            infos_account_session = self._connection(email_account, password_account)
-            self.token_session = infos_account_session['token']
-            self.account_passengers = infos_account_session['passengers']
-            self.account_cards = infos_account_session['cards']
+            self._login()
+
+    def _login(self, force=False):
+        """ Get a session from the token store, or sign in (always if
+        force is True) """
+        infos_account_session = None
+        if self.token_store is not None and not force:
+            infos_account_session = self.token_store.get(self._email_account)
+        if infos_account_session is None:
+            infos_account_session = self._connection(self._email_account,
+                                                     self._password_account)
+            if self.token_store is not None:
+                self.token_store.set(self._email_account,
+                                     infos_account_session)
+        self.token_session = infos_account_session['token']
+        self.account_passengers = infos_account_session['passengers']
+        self.account_cards = infos_account_session['cards']
+        self._index_account()
+
+    def _index_account(self):
+        """ Index the account passengers by (first name, last name,
+        birthdate), and the account cards by id """
+        self._cards_by_id = {}  # id : (position in the account, card)
+        for position, card in enumerate(self.account_cards):
+            self._cards_by_id.setdefault(card['id'], (position, card))
+        self._passengers_by_name = {}
+        for passenger in self.account_passengers:
+            key = _account_passenger_key(passenger['first_name'],
+                                         passenger['last_name'],
+                                         passenger['birthdate'])
+            self._passengers_by_name.setdefault(key, passenger)
+
+    def get_account_passenger(self, firstname, lastname, birthdate_obj):
+        """ Returns the account passenger (dict) with this name and
+        birthdate (date object), and its cards, or raises a KeyError """
+        key = _account_passenger_key(
+            firstname, lastname,
+            birthdate_obj.strftime(_ACCOUNT_BIRTHDATE_FORMAT))
+        passenger = self._passengers_by_name.get(key) \
+            if self.account_passengers is not None else None
+        if passenger is None:
+            raise KeyError("No passenger in your business trainline account "
+                           "named {} {}".format(firstname, lastname))
+        cards = sorted(self._cards_by_id[card_id]
+                       for card_id in set(passenger['card_ids'])
+                       if card_id in self._cards_by_id)
+        return passenger, [card for _, card in cards]
+
+    def get_passengers(self, passengers):
+        """ Returns the Passenger objects of account passengers given as
+        (firstname, lastname, birthdate) tuples (birthdate as dd/mm/yyyy).
+        Raises a KeyError naming every passenger not found """
+        passenger_objs = []
+        missing = []
+        for firstname, lastname, birthdate in passengers:
+            try:
+                passenger_objs.append(Passenger(
+                    birthdate=birthdate, firstname=firstname,
+                    lastname=lastname, trainline_session=self))
+            except KeyError:
+                missing.append("{} {}".format(firstname, lastname))
+        if missing:
+            raise KeyError("No passenger in your business trainline account "
+                           "named {}".format(", ".join(missing)))
+        return passenger_objs
 
     def search(self, departure_station_id, arrival_station_id, departure_date,
-               passenger_list):
+               passenger_list, systems=None):
         """ Search on Trainline """
+        payload = self._search_payload(
+            departure_station_id=departure_station_id,
+            arrival_station_id=arrival_station_id,
+            passenger_list=passenger_list,
+            systems=systems)
+        return self._post_search(payload.render(departure_date))
+
+    def _search_payload(self, departure_station_id, arrival_station_id,
+                        passenger_list, systems=None):
+        """ Returns the payload of the searches of a route (for all the
+        departure dates) """
+        systems = list(SYSTEMS if systems is None else systems)
+        for system in systems:
+            if system not in SYSTEMS:
+                raise KeyError("System '{}' unknown, [{}] available".format(
+                    system, ",".join(SYSTEMS)))
         data = {
             "local_currency": "EUR",
             "search": {
                 "arrival_station_id": arrival_station_id,
-                "departure_date": departure_date,
+                "departure_date": None,
                 "departure_station_id": departure_station_id,
-                "systems": [
-                    "sncf",
-                    "db",
-                    "idtgv",
-                    "ouigo",
-                    "trenitalia",
-                    "ntv",
-                    "hkx",
-                    "renfe",
-                    "cff",
-                    "benerail",
-                    "ocebo",
-                    "westbahn",
-                    "leoexpress",
-                    "locomore",
-                    "busbud",
-                    "flixbus",
-                    "distribusion",
-                    "cityairporttrain",
-                    "obb",
-                    "timetable"
-                ]
+                "systems": systems,
             }
         }
 
@@ -150,18 +829,37 @@ class Trainline(object):
                 passenger_ids.append(passenger['id'])
             data['search']["passenger_ids"] = passenger_ids
             data['search']["card_ids"] = card_ids
-            post_data = json.dumps(data)
-            c = Client(token=self.token_session)
         else:
             data['search']["passengers"] = passenger_list
-            post_data = json.dumps(data)
-            c = Client()
+        return _SearchPayload(data)
+
+    def _post_search(self, post_data, stream=False):
+        """ Send a search payload, and log in again if the token of the
+        session is rejected. With stream, the body of the response is not
+        read (see Client._post) """
+        if self.token_session:
+            c = Client(token=self.token_session, cache=self.cache,
+                       transport=self.transport)
+        else:
+            c = Client(cache=self.cache, transport=self.transport)
 
-        ret = c._post(url=_SEARCH_URL, post_data=post_data)
+        from requests import ConnectionError
+        try:
+            ret = c._post(url=_SEARCH_URL, post_data=post_data,
+                          stream=stream)
+        except ConnectionError as e:
+            if not (self.token_session and _is_auth_failure(e)):
+                raise
+            # The token expired (or was revoked) : log in again, once
+            self._login(force=True)
+            c = Client(token=self.token_session, cache=self.cache,
+                       transport=self.transport)
+            ret = c._post(url=_SEARCH_URL, post_data=post_data,
+                          stream=stream)
         return ret
 
     def _connection(self, email_account, password_account):
-        c = Client()
+        c = Client(transport=self.transport)
         data_login = {"id":"1","email":email_account,"password":password_account,
          "facebook_id":None,"facebook_token": None,"google_code": None,"concur_auth_code": None,"concur_new_email": None,"concur_migration_type": None,"source": None,"correlation_key": None,"auth_token": None, "user_id": None}
         post_data_login = json.dumps(data_login)
@@ -172,6 +870,86 @@ class Trainline(object):
         cards = dict_ret_login['cards']
         return {'token' : token, 'passengers' : passengers, 'cards': cards}
 
+class _SearchPayload(object):
+    """ Class to represent the payload of the searches of a route. It is
+    serialized once : only the departure date changes between the pages
+    >>> payload = _SearchPayload({"search": {"departure_date": None, \
+"systems": ["sncf"]}})
+    >>> print(payload.render("2018-10-15T08:00:00+0200"))
+    {"search": {"departure_date": "2018-10-15T08:00:00+0200", \
+"systems": ["sncf"]}}
+    """
+
+    _DATE_PLACEHOLDER = '"__departure_date__"'
+
+    def __init__(self, data):
+        data = dict(data, search=dict(data["search"],
+                                      departure_date="__departure_date__"))
+        self._prefix, self._suffix = json.dumps(data).split(
+            self._DATE_PLACEHOLDER)
+
+    def render(self, departure_date):
+        """ Returns the payload (json string) of a departure date """
+        return self._prefix + json.dumps(departure_date) + self._suffix
+
+
+def _schema_error(expected_type, attribute, value):
+    raise TypeError("Type {} expected for {}, {} received".format(
+        expected_type, attribute, type(value)))
+
+
+def _value_or(value, default):
+    return default if value is None else value
+
+
+def _no_intern(value):
+    return value
+
+
+def _compiled_schema(cls):
+    """ Class decorator compiling the _SCHEMA of a class, tuples of
+    (attribute, expected type or None, expression of its value in the raw
+    json object), into 2 functions checking the type of every attribute
+    and setting it in one pass :
+    - cls._assign(self, mydict), called by __init__
+    - cls._from_raw(raw[, related], intern=None), building the object
+      straight from the raw json object of the search results (and its
+      related objects : the trips of a folder, the segments of a trip...).
+      The attributes of cls._POOLED are shared with intern (see
+      ValuePool.intern) """
+    namespace = {"_cls": cls, "_schema_error": _schema_error,
+                 "_value_or": _value_or, "_no_intern": _no_intern}
+    assign_lines = ["def _assign(self, mydict):"]
+    raw_lines = ["def _from_raw(raw{}, intern=_no_intern):".format(
+                     ", " + cls._RELATED if cls._RELATED else ""),
+                 "    self = _cls.__new__(_cls)"]
+    for i, (attribute, expected_type, raw_expression) in \
+            enumerate(cls._SCHEMA):
+        type_name = "_type_{}".format(i)
+        namespace[type_name] = expected_type
+        for lines, expression in (
+                (assign_lines, "mydict.get({!r})".format(attribute)),
+                (raw_lines, raw_expression)):
+            if lines is raw_lines and attribute in cls._POOLED:
+                expression = "intern({})".format(expression)
+            lines.append("    value = {}".format(expression))
+            if expected_type is not None:
+                lines += [
+                    "    if type(value) is not {}:".format(type_name),
+                    "        _schema_error({}, {!r}, value)".format(
+                        type_name, attribute)]
+            lines.append("    self.{} = value".format(attribute))
+    raw_lines += ["    self._init_derived()",
+                  "    return self"]
+    source = "\n".join(assign_lines + raw_lines)
+    exec(compile(source, "<{} schema>".format(cls.__name__), "exec"),
+         namespace)
+    cls._assign = namespace["_assign"]
+    cls._from_raw = staticmethod(namespace["_from_raw"])
+    return cls
+
+
+@_compiled_schema
 class Folder(object):
     """ Class to represent a folder, composed of the trips of each passenger
     ex : Folder Paris-Toulouse : 65€, which contains 2 trips :
@@ -179,26 +957,26 @@ class Folder(object):
     - Trip Paris-Toulouse passenger2 : 20€
     """
 
-    def __init__(self, mydict):
-        expected = {
-            "id": str,
-            "departure_date": str,
-            "departure_station_id": str,
-            "arrival_date": str,
-            "arrival_station_id": str,
-            "price": float,
-            "currency": str,
-            "trip_ids": list,
-            "trips": list,
-        }
+    _SCHEMA = (
+        ("id", str, 'raw.get("id")'),
+        ("departure_date", str, 'raw.get("departure_date")'),
+        ("departure_station_id", str, 'raw.get("departure_station_id")'),
+        ("arrival_date", str, 'raw.get("arrival_date")'),
+        ("arrival_station_id", str, 'raw.get("arrival_station_id")'),
+        ("price", float, 'float(raw.get("cents")) / 100'),
+        ("currency", str, 'raw.get("currency")'),
+        # Without the ids of the trips invalid or not found
+        ("trip_ids", list, "[trip.id for trip in trips]"),
+        ("trips", list, "trips"),
+    )
+    _RELATED = "trips"  # Argument of _from_raw
+    _POOLED = ("departure_station_id", "arrival_station_id", "currency")
 
-        for expected_param, expected_type in expected.items():
-            param_value = mydict.get(expected_param)
-            if type(param_value) is not expected_type:
-                raise TypeError("Type {} expected for {}, {} received".format(
-                    expected_type, expected_param, type(param_value)))
-            setattr(self, expected_param, param_value)
+    def __init__(self, mydict):
+        self._assign(mydict)
+        self._init_derived()
 
+    def _init_derived(self):
         # Remove ':' in the +02:00 offset (=> +0200). It caused problem with
         # Python 3.6 version of strptime
         self.departure_date = _fix_date_offset_format(self.departure_date)
@@ -249,29 +1027,30 @@ class Folder(object):
         return hash((self._main_characteristics()))
 
 
+@_compiled_schema
 class Trip(object):
     """ Class to represent a trip, composed of one or more segments """
 
-    def __init__(self, mydict):
-        expected = {
-            "id": str,
-            "departure_date": str,
-            "departure_station_id": str,
-            "arrival_date": str,
-            "arrival_station_id": str,
-            "price": float,
-            "currency": str,
-            "segment_ids": list,
-            "segments": list,
-        }
+    _SCHEMA = (
+        ("id", str, 'raw.get("id")'),
+        ("departure_date", str, 'raw.get("departure_date")'),
+        ("departure_station_id", str, 'raw.get("departure_station_id")'),
+        ("arrival_date", str, 'raw.get("arrival_date")'),
+        ("arrival_station_id", str, 'raw.get("arrival_station_id")'),
+        ("price", float, 'float(raw.get("cents")) / 100'),
+        ("currency", str, 'raw.get("currency")'),
+        # Without the ids of the segments invalid or not found
+        ("segment_ids", list, "[segment.id for segment in segments]"),
+        ("segments", list, "segments"),
+    )
+    _RELATED = "segments"  # Argument of _from_raw
+    _POOLED = ("departure_station_id", "arrival_station_id", "currency")
 
-        for expected_param, expected_type in expected.items():
-            param_value = mydict.get(expected_param)
-            if type(param_value) is not expected_type:
-                raise TypeError("Type {} expected for {}, {} received".format(
-                    expected_type, expected_param, type(param_value)))
-            setattr(self, expected_param, param_value)
+    def __init__(self, mydict):
+        self._assign(mydict)
+        self._init_derived()
 
+    def _init_derived(self):
         # Remove ':' in the +02:00 offset (=> +0200). It caused problem with
         # Python 3.6 version of strptime
         self.departure_date = _fix_date_offset_format(self.departure_date)
@@ -325,23 +1104,47 @@ class Folders(object):
         self.folders = folder_list
 
     def csv(self):
-        csv_str = "departure_date;arrival_date;duration;number_of_segments;\
-price;currency;transportation_mean;bicycle_reservation\n"
-        for folder in self.folders:
-            trip_duration = folder.arrival_date_obj - folder.departure_date_obj
-            csv_str += "{dep};{arr};{dur};{seg};{price};{curr};\
+        with _span("csv") as span:
+            csv_str = "departure_date;arrival_date;duration;\
+number_of_segments;price;currency;transportation_mean;bicycle_reservation\n"
+            for folder in self.folders:
+                trip_duration = \
+                    folder.arrival_date_obj - folder.departure_date_obj
+                csv_str += "{dep};{arr};{dur};{seg};{price};{curr};\
 {tr};{bicy}\n".format(
-                dep=folder.departure_date_obj.strftime(_READABLE_DATE_FORMAT),
-                arr=folder.arrival_date_obj.strftime(_READABLE_DATE_FORMAT),
-                dur=_strfdelta(trip_duration, "{hours:02d}h{minutes:02d}"),
-                seg=folder.segment_nb,
-                price=str(folder.price).replace(".", ","),  # For French Excel
-                curr=folder.currency,
-                tr=folder.transportation_mean,
-                bicy=str(folder.bicycle_reservation).replace(".", ","),
-            )
+                    dep=folder.departure_date_obj.strftime(
+                        _READABLE_DATE_FORMAT),
+                    arr=folder.arrival_date_obj.strftime(
+                        _READABLE_DATE_FORMAT),
+                    dur=_strfdelta(trip_duration, "{hours:02d}h{minutes:02d}"),
+                    seg=folder.segment_nb,
+                    price=str(folder.price).replace(".", ","),  # French Excel
+                    curr=folder.currency,
+                    tr=folder.transportation_mean,
+                    bicy=str(folder.bicycle_reservation).replace(".", ","),
+                )
+            span.set("count", len(self.folders))
         return csv_str
 
+    def to_arrow(self, segments=False):
+        """ Returns a pyarrow Table of the folders (or of their segments),
+        see trainline.export """
+        from . import export
+        if segments:
+            return export.segments_table(self.folders)
+        return export.folders_table(self.folders)
+
+    def to_pandas(self, segments=False):
+        """ Returns a pandas DataFrame of the folders (or of their
+        segments), see trainline.export """
+        return self.to_arrow(segments=segments).to_pandas()
+
+    def to_parquet(self, path, segments_path=None):
+        """ Write the folders in a Parquet file (and their segments in
+        segments_path, if given) """
+        from . import export
+        export.write_parquet(self.folders, path, segments_path=segments_path)
+
     def __len__(self):
         return len(self.folders)
 
@@ -363,29 +1166,16 @@ class Passenger(object):
             date_format=_BIRTHDATE_FORMAT)
         self.age = self._calculate_age()
 
-        self.id = self._gen_id()
-
         if not (all(el is None for el in [firstname, lastname]) or all(el is not None for el in [firstname, lastname, trainline_session])):
             raise KeyError("Firstname, lastname AND trainline_session are required to enable TGVMax research")
 
         if firstname:
-            passengers = trainline_session.account_passengers
-            #We check every registered passenger of the account to find the passenger corresponding the the firstname, the lastname and the birthdate given
-            for passenger in passengers:
-                birthdate_format_request = self.birthdate_obj.strftime('%Y-%m-%dT00:00:00+00:00')
-                if (passenger['first_name'].lower() == firstname.lower() and passenger['last_name'].lower() == lastname.lower() and passenger['birthdate'] == birthdate_format_request):
-                    self.id = passenger['id']
-                    own_cards = []
-                    for card_item in trainline_session.account_cards:
-                        if (card_item['id'] in passenger['card_ids']):
-                            own_cards.append(card_item)
-                    self.cards = own_cards
-                    break
-            try: self.cards
-            except NameError: 
-                raise KeyError("No passenger in your business trainline account named {} {}".format(firstname, lastname))
+            passenger, self.cards = trainline_session.get_account_passenger(
+                firstname, lastname, self.birthdate_obj)
+            self.id = passenger['id']
 
         else:
+            self.id = self._gen_id()
             cards = cards or []
             for card in cards:
                 if card not in _AVAILABLE_CARDS:
@@ -396,6 +1186,7 @@ class Passenger(object):
     def _gen_id(self):
         """ Returns a unique passenger id in the proper format
         hhhhhhhh-hhhh-hhhh-hhhh-hhhhhhhhhhhh"""
+        import uuid
         return str(uuid.uuid4())  # uuid4 = make a random UUID
 
     def _calculate_age(self):
@@ -440,38 +1231,42 @@ class Passenger(object):
         if card not in _SPECIAL_CARDS:
             raise KeyError("Card '{}' unknown, [{}] available".format(
                 card, ",".join([d['reference'] for d in _SPECIAL_CARDS])))
+        import copy
         c = copy.deepcopy(card)
         c['number'] = number
         self.cards.append(c)
 
 
+@_compiled_schema
 class Segment(object):
     """ Class to represent a segment
     (a trip is composed of one or more segment) """
 
-    def __init__(self, mydict):
-        expected = {
-            "id": str,
-            "departure_date": str,
-            "departure_station_id": str,
-            "arrival_date": str,
-            "arrival_station_id": str,
-            "transportation_mean": str,
-            "carrier": str,
-            "train_number": str,
-            "travel_class": str,
-            "trip_id": str,
-            "comfort_class_ids": list,
-            "comfort_classes": list,
-        }
+    _SCHEMA = (
+        ("id", str, 'raw.get("id")'),
+        ("departure_date", str, 'raw.get("departure_date")'),
+        ("departure_station_id", str, 'raw.get("departure_station_id")'),
+        ("arrival_date", str, 'raw.get("arrival_date")'),
+        ("arrival_station_id", str, 'raw.get("arrival_station_id")'),
+        ("transportation_mean", str, 'raw.get("transportation_mean")'),
+        ("carrier", str, 'raw.get("carrier")'),
+        ("train_number", str, 'raw.get("train_number")'),
+        ("travel_class", str, 'raw.get("travel_class")'),
+        ("trip_id", str, 'raw.get("trip_id")'),
+        # Without the ids of the comfort classes invalid or not found
+        ("comfort_class_ids", list,
+         "[comfort_class.id for comfort_class in comfort_classes]"),
+        ("comfort_classes", list, "comfort_classes"),
+    )
+    _RELATED = "comfort_classes"  # Argument of _from_raw
+    _POOLED = ("departure_station_id", "arrival_station_id",
+               "transportation_mean", "carrier", "travel_class")
 
-        for expected_param, expected_type in expected.items():
-            param_value = mydict.get(expected_param)
-            if type(param_value) is not expected_type:
-                raise TypeError("Type {} expected for {}, {} received".format(
-                    expected_type, expected_param, type(param_value)))
-            setattr(self, expected_param, param_value)
+    def __init__(self, mydict):
+        self._assign(mydict)
+        self._init_derived()
 
+    def _init_derived(self):
         # Remove ':' in the +02:00 offset (=> +0200). It caused problem with
         # Python 3.6 version of strptime
         self.departure_date = _fix_date_offset_format(self.departure_date)
@@ -523,29 +1318,29 @@ class Segment(object):
         return res
 
 
+@_compiled_schema
 class ComfortClass(object):
     """ Class to represent a comfort_class
     (a trip is composed of one or more segment,
     each one composed of one or more comfort_class) """
 
-    def __init__(self, mydict):
-        expected = {
-            "id": str,
-            "name": str,
-            "description": str,
-            "title": str,
-            "segment_id": str,
-            "condition_id": str,
-        }
+    _SCHEMA = (
+        ("id", str, 'raw.get("id")'),
+        ("name", str, 'raw.get("name")'),
+        ("description", str, '_value_or(raw.get("description"), "")'),
+        ("title", str, '_value_or(raw.get("title"), "")'),
+        ("segment_id", str, 'raw.get("segment_id")'),
+        ("condition_id", str, 'raw.get("condition_id")'),
+        ("options", None, 'raw.get("options")'),  # Not checked
+    )
+    _RELATED = None
+    _POOLED = ("name", "description", "title", "condition_id")
 
-        for expected_param, expected_type in expected.items():
-            param_value = mydict.get(expected_param)
-            if type(param_value) is not expected_type:
-                raise TypeError("Type {} expected for {}, {} received".format(
-                    expected_type, expected_param, type(param_value)))
-            setattr(self, expected_param, param_value)
+    def __init__(self, mydict):
+        self._assign(mydict)
+        self._init_derived()
 
-        self.options = mydict.get("options")
+    def _init_derived(self):
         if self.options is None:
             # No options field with "benerail.default" comfort class
             self.options = {}
@@ -591,11 +1386,26 @@ def _str_datetime_to_datetime_obj(str_datetime,
         raise TypeError("date must match the format {}, received : {}".format(
             date_format, str_datetime))
     if datetime_obj.tzinfo is None:
-        tz = pytz.timezone(_DEFAULT_SEARCH_TIMEZONE)
-        datetime_obj = tz.localize(datetime_obj)
+        datetime_obj = _localize(datetime_obj, _DEFAULT_SEARCH_TIMEZONE)
     return datetime_obj
 
 
+def _localize(datetime_obj, timezone_name):
+    """ Returns the naive datetime in the timezone, with the standard
+    library zoneinfo (or pytz before Python 3.9)
+    >>> print(_localize(datetime(2018, 10, 15, 8, 0), "Europe/Paris"))
+    2018-10-15 08:00:00+02:00
+    >>> print(_localize(datetime(2018, 12, 15, 8, 0), "Europe/Paris"))
+    2018-12-15 08:00:00+01:00
+    """
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:  # Python < 3.9
+        import pytz
+        return pytz.timezone(timezone_name).localize(datetime_obj)
+    return datetime_obj.replace(tzinfo=ZoneInfo(timezone_name))
+
+
 def _str_date_to_date_obj(str_date, date_format=_BIRTHDATE_FORMAT):
     """ Check the expected format of the string date and returns a datetime
     object """
@@ -615,16 +1425,20 @@ def _fix_date_offset_format(date_str):
     return date_str[:-3] + date_str[-2:]
 
 
-def get_station_id(station_name):
-    """ Returns the Trainline station id (mandatory for search) based on the
-    stations csv file content, and the station_name passed in parameter """
+def _load_station_db():
+    """ Returns the stations database (loaded on first use) """
     global _STATION_DB
 
     if '_STATION_DB' not in globals():
         _STATION_DB = _station_to_dict(_STATIONS_CSV)
+    return _STATION_DB
 
+
+def get_station_id(station_name):
+    """ Returns the Trainline station id (mandatory for search) based on the
+    stations csv file content, and the station_name passed in parameter """
     station_id = None
-    for st_id, st_name in _STATION_DB.items():
+    for st_id, st_name in _load_station_db().items():
         if st_name == station_name.lower().strip():
             station_id = st_id
             break
@@ -635,6 +1449,32 @@ def get_station_id(station_name):
     return station_id
 
 
+@lru_cache(maxsize=None)
+def _station_groups():
+    """ Returns the names of the stations of every city (city name : tuple
+    of station names), computed once from the stations database : a
+    station belongs to the city whose station name starts its name
+    (ex : "lyon part-dieu" and "lyon perrache" belong to "lyon") """
+    names = set(_load_station_db().values())
+    groups = {}
+    for name in _load_station_db().values():
+        for position, character in enumerate(name):
+            if character == " " and name[:position] in names:
+                groups.setdefault(name[:position], []).append(name)
+    return {city: tuple(stations) for city, stations in groups.items()}
+
+
+def get_city_stations(city_name):
+    """ Returns the names of the stations of a city (see _station_groups),
+    or the name of the station if no other station belongs to it """
+    city_name = city_name.lower().strip()
+    stations = _station_groups().get(city_name)
+    if stations is None:
+        get_station_id(city_name)  # KeyError if unknown
+        stations = (city_name,)
+    return stations
+
+
 def search(departure_station, arrival_station,
            from_date, to_date,
            passengers=None,
@@ -643,14 +1483,142 @@ def search(departure_station, arrival_station,
            bicycle_with_reservation_only=None,
            bicycle_with_or_without_reservation=None,
            max_price=None,
-           trainline_session=None):
+           trainline_session=None,
+           systems=None,
+           fields=None,
+           stream=False,
+           parse_executor=None):
+    """ Returns the Folders departing between from_date and to_date.
+    Only the carriers of systems (see SYSTEMS) are searched, if given.
+    With fields (see PROJECTION_FIELDS), returns a list of named tuples of
+    these fields instead, read from the search results without building
+    any object.
+    With stream, the responses are parsed while they are received (see
+    trainline.streaming, requires ijson).
+    With fields, the responses can be parsed in a parse_executor (ex : a
+    concurrent.futures.ProcessPoolExecutor, see trainline.batch) """
+    with _span("search") as search_span:
+        t, payload, folder_filter, to_date_obj = _prepare_search(
+            departure_station, arrival_station, from_date, to_date,
+            passengers=passengers,
+            transportation_mean=transportation_mean,
+            bicycle_without_reservation_only=bicycle_without_reservation_only,
+            bicycle_with_reservation_only=bicycle_with_reservation_only,
+            bicycle_with_or_without_reservation=(
+                bicycle_with_or_without_reservation),
+            max_price=max_price,
+            trainline_session=trainline_session,
+            systems=systems,
+            fields=fields,
+            stream=stream,
+            parse_executor=parse_executor)
+
+        folder_list = []
+        pages = 0
+        for page_results in _iter_pages(t, payload, folder_filter,
+                                        to_date_obj, fields=fields,
+                                        stream=stream,
+                                        parse_executor=parse_executor):
+            pages += 1
+            folder_list += page_results
+        search_span.set("pages", pages)
+
+        if fields is not None:
+            rows = _unique_rows(folder_list)
+            search_span.set("count", len(rows))
+            return rows
+
+        with _span("dedup") as span:
+            span.set("count_in", len(folder_list))
+            # Remove duplicate trips in the list
+            _filter_folders_list = list(set(folder_list))
+            span.set("count", len(_filter_folders_list))
+
+        # Sort by date
+        with _span("sort"):
+            _filter_folders_list = sorted(
+                _filter_folders_list,
+                key=lambda folder: folder.departure_date_obj)
+
+        search_span.set("count", len(_filter_folders_list))
+        folder_list_obj = Folders(_filter_folders_list)
+        return folder_list_obj
+
+
+def iter_search(departure_station, arrival_station,
+                from_date, to_date,
+                passengers=None,
+                transportation_mean=None,
+                bicycle_without_reservation_only=None,
+                bicycle_with_reservation_only=None,
+                bicycle_with_or_without_reservation=None,
+                max_price=None,
+                trainline_session=None,
+                systems=None,
+                fields=None,
+                stream=False,
+                parse_executor=None):
+    """ Same as search, but yields the folders (or the named tuples of
+    fields) page after page, as soon as they are received. They are
+    deduplicated, but only sorted within a page """
+    t, payload, folder_filter, to_date_obj = _prepare_search(
+        departure_station, arrival_station, from_date, to_date,
+        passengers=passengers,
+        transportation_mean=transportation_mean,
+        bicycle_without_reservation_only=bicycle_without_reservation_only,
+        bicycle_with_reservation_only=bicycle_with_reservation_only,
+        bicycle_with_or_without_reservation=(
+            bicycle_with_or_without_reservation),
+        max_price=max_price,
+        trainline_session=trainline_session,
+        systems=systems,
+        fields=fields,
+        stream=stream,
+        parse_executor=parse_executor)
+    seen = set()
+    for page_results in _iter_pages(t, payload, folder_filter, to_date_obj,
+                                    fields=fields, stream=stream,
+                                    parse_executor=parse_executor):
+        if fields is None:
+            for folder in sorted(page_results,
+                                 key=lambda folder: folder.departure_date_obj):
+                if folder not in seen:
+                    seen.add(folder)
+                    yield folder
+        else:
+            for key, departure_date_obj, row in sorted(
+                    page_results, key=lambda item: item[1]):
+                if key not in seen:
+                    seen.add(key)
+                    yield row
+
+
+def _prepare_search(departure_station, arrival_station, from_date, to_date,
+                    passengers=None, transportation_mean=None,
+                    bicycle_without_reservation_only=None,
+                    bicycle_with_reservation_only=None,
+                    bicycle_with_or_without_reservation=None,
+                    max_price=None, trainline_session=None, systems=None,
+                    fields=None, stream=False, parse_executor=None):
+    """ Returns the session, the payload template, the folder filter and
+    the to_date_obj of a search """
     if not trainline_session:
         t = Trainline()
     else:
         t = trainline_session
 
-    departure_station_id = get_station_id(departure_station)
-    arrival_station_id = get_station_id(arrival_station)
+    if fields is not None:
+        _projection(tuple(fields))  # Check the fields before searching
+        if stream:
+            raise ValueError("fields can not be used with stream")
+    elif parse_executor is not None:
+        raise ValueError("fields are required with a parse_executor")
+    if stream:
+        from . import streaming  # noqa: F401 (ImportError without ijson)
+
+    with _span("search.station_lookup"):
+        departure_station_id = get_station_id(departure_station)
+        arrival_station_id = get_station_id(arrival_station)
 
     from_date_obj = _str_datetime_to_datetime_obj(
         str_datetime=from_date, date_format=_READABLE_DATE_FORMAT)
@@ -665,30 +1633,97 @@ def search(departure_station, arrival_station,
     for passenger in passengers:
         passenger_list.append(passenger.get_dict())
 
-    folder_list = []
+    if systems is None and transportation_mean == "train":
+        # Only criteria of the search API : do not ask for coaches
+        systems = [system for system in SYSTEMS
+                   if system not in _COACH_ONLY_SYSTEMS]
+
+    # Serialized once, only the departure date changes between pages
+    payload = t._search_payload(
+        departure_station_id=departure_station_id,
+        arrival_station_id=arrival_station_id,
+        passenger_list=passenger_list,
+        systems=systems)
+
+    # The folders are filtered while they are parsed
+    folder_filter = _FolderFilter(
+        from_date_obj=from_date_obj,
+        to_date_obj=to_date_obj,
+        transportation_mean=transportation_mean,
+        bicycle_without_reservation_only=bicycle_without_reservation_only,
+        bicycle_with_reservation_only=bicycle_with_reservation_only,
+        bicycle_with_or_without_reservation=(
+            bicycle_with_or_without_reservation),
+        max_price=max_price)
+    if fields is not None and folder_filter.needs_comfort_classes:
+        raise ValueError("The bicycle criteria can not be used with fields")
+    return t, payload, folder_filter, to_date_obj
+
 
-    search_date = from_date_obj
+def _iter_pages(t, payload, folder_filter, to_date_obj, fields=None,
+                stream=False, parse_executor=None):
+    """ Yields the results of every page (folders, or projected folders
+    with fields, see _project_folders), until a folder departs after
+    to_date_obj """
+    search_date = folder_filter.from_date_obj
 
     while True:
 
         last_search_date = search_date
         departure_date = search_date.strftime(_DEFAULT_DATE_FORMAT)
 
-        ret = t.search(
-            departure_station_id=departure_station_id,
-            arrival_station_id=arrival_station_id,
-            departure_date=departure_date,
-            passenger_list=passenger_list)
-        j = json.loads(ret.text)
-        folders = _get_folders(search_results_obj=j)
-        folder_list += folders
-
-        # Check the departure date of the last trip found
-        # If it is after the 'to_date', we can stop searching
-        if folders[-1].departure_date_obj > to_date_obj:
+        ret = t._post_search(payload.render(departure_date), stream=stream)
+        # One parse span per page, whatever the path of the parse
+        if stream:
+            from . import streaming
+            with _span("parse", path="stream") as span:
+                try:
+                    streamed = streaming.parse_search_results(
+                        _response_stream(ret), folder_filter=folder_filter,
+                        value_pool=t.value_pool)
+                finally:
+                    # Give the connection back to the pool, even if the
+                    # body is truncated or invalid
+                    if hasattr(ret, "close"):
+                        ret.close()
+                page_results = streamed.folders
+                span.set("count", len(page_results))
+            last_departure_date = streamed.last_departure_date
+        elif parse_executor is not None:
+            with _span("parse", path="executor") as span:
+                projected, last_departure_date = parse_executor.submit(
+                    _parse_page, ret.content, tuple(fields),
+                    folder_filter.criteria).result()
+                row_type = _projection(tuple(fields))
+                page_results = [
+                    (key, departure_date_obj, row_type._make(values))
+                    for key, departure_date_obj, values in projected]
+                span.set("bytes", len(ret.content))
+                span.set("count", len(page_results))
+        else:
+            with _span("parse", path="objects" if fields is None
+                       else "project") as span:
+                with _span("json_decode") as decode_span:
+                    j = json.loads(ret.text)
+                    decode_span.set("bytes", len(ret.content))
+                last_departure_date = j["folders"][-1]["departure_date"]
+                if fields is None:
+                    page_results = _get_folders(search_results_obj=j,
+                                                folder_filter=folder_filter,
+                                                value_pool=t.value_pool)
+                else:
+                    page_results = _project_folders(j, fields,
+                                                    folder_filter)
+                span.set("count", len(page_results))
+        yield page_results
+
+        # Check the departure date of the last trip found (filtered or
+        # not). If it is after the 'to_date', we can stop searching
+        last_departure_date_obj = _parse_api_date(last_departure_date)
+        if last_departure_date_obj > to_date_obj:
             break
         else:
-            search_date = folders[-1].departure_date_obj
+            search_date = last_departure_date_obj
             # If we get a date earlier than the last search date,
             # it means that we may be searching during the night,
             # so we must increment the search_date till we have a
@@ -696,26 +1731,28 @@ def search(departure_station, arrival_station,
             # Probably the next day in this case
             if search_date <= last_search_date:
                 search_date = last_search_date + timedelta(hours=4)
-    folder_list = list(set(folder_list))  # Remove duplicate trips in the list
 
-    # Filter the list
-    bicycle_w_or_wout_reservation = bicycle_with_or_without_reservation
-    _filter_folders_list = _filter_folders(
-        folder_list=folder_list,
-        from_date_obj=from_date_obj,
-        to_date_obj=to_date_obj,
-        transportation_mean=transportation_mean,
-        bicycle_without_reservation_only=bicycle_without_reservation_only,
-        bicycle_with_reservation_only=bicycle_with_reservation_only,
-        bicycle_with_or_without_reservation=bicycle_w_or_wout_reservation,
-        max_price=max_price)
 
-    # Sort by date
-    _filter_folders_list = sorted(_filter_folders_list,
-                                  key=lambda folder: folder.departure_date_obj)
+def _parse_page(content, fields, criteria):
+    """ Returns the projected folders of a search response (with plain
+    tuples as rows, cheap to send back from another process), and the
+    departure date of its last raw folder. Run in the parse_executor of
+    a search """
+    j = json.loads(content)
+    projected = _project_folders(j, fields, _FolderFilter(**criteria))
+    return ([(key, departure_date_obj, tuple(row))
+             for key, departure_date_obj, row in projected],
+            j["folders"][-1]["departure_date"])
 
-    folder_list_obj = Folders(_filter_folders_list)
-    return folder_list_obj
+
+def _response_stream(ret):
+    """ Returns a file-like object of the body of a response : the stream
+    of the connection if the body has not been read yet (requests response
+    with stream=True), or its content """
+    if getattr(ret, "_content_consumed", True) is False:
+        ret.raw.decode_content = True
+        return ret.raw
+    return io.BytesIO(ret.content)
 
 
 def _convert_date_format(origin_date_str,
@@ -730,169 +1767,407 @@ origin_date_format="%d/%m/%Y %H:%M", target_date_format="%Y-%m-%dT%H:%M:%S%z"))
     return date_obj.strftime(target_date_format)
 
 
-def _get_folders(search_results_obj):
-    """ Get folders from the json object of search results """
-    trip_obj_list = _get_trips(search_results_obj)
+def _get_folders(search_results_obj, folder_filter=None, value_pool=None):
+    """ Get folders from the json object of search results. With a
+    folder_filter, the folders rejected on their raw fields (price, date)
+    are not built, nor their trips, segments and comfort classes.
+    With a value_pool (ValuePool), the repeated values are shared """
+    intern = value_pool.intern if value_pool is not None else _no_intern
     folders = search_results_obj.get("folders")
-    folder_obj_list = []
-    for folder in folders:
-        dict_folder = {
-            "id": folder.get("id"),
-            "departure_date": folder.get("departure_date"),
-            "departure_station_id": folder.get("departure_station_id"),
-            "arrival_date": folder.get("arrival_date"),
-            "arrival_station_id": folder.get("arrival_station_id"),
-            "price": float(folder.get("cents")) / 100,
-            "currency": folder.get("currency"),
-            "trip_ids": folder.get("trip_ids"),
-        }
-        trips = []
-        for trip_id in dict_folder["trip_ids"]:
-            trip_found = _get_trip_from_id(
-                trip_obj_list=trip_obj_list,
-                trip_id=trip_id)
-            if trip_found:
-                trips.append(trip_found)
-            else:
-                # Remove the id if the object is invalid or not found
-                dict_folder["trip_ids"].remove(trip_id)
-        dict_folder["trips"] = trips
-
-        folder_obj = Folder(dict_folder)
-        folder_obj_list.append(folder_obj)
+    if folder_filter is not None:
+        with _span("filter.raw") as span:
+            span.set("count_in", len(folders))
+            folders = folder_filter.filter_raw(folders)
+            span.set("count", len(folders))
+    trip_objs = _get_trips(search_results_obj,
+                           trip_ids=_referenced_ids(folders, "trip_ids"),
+                           value_pool=value_pool)
+    with _span("parse.folders") as span:
+        folder_obj_list = []
+        for folder in folders:
+            # Ignore the ids of the trips invalid or not found
+            trips = [trip_objs[trip_id] for trip_id in folder.get("trip_ids")
+                     if trip_id in trip_objs]
+            folder_obj = Folder._from_raw(folder, trips, intern)
+            folder_obj_list.append(folder_obj)
+        span.set("count", len(folder_obj_list))
+    if folder_filter is not None:
+        with _span("filter") as span:
+            span.set("count_in", len(folder_obj_list))
+            folder_obj_list = folder_filter.filter_built(folder_obj_list)
+            span.set("count", len(folder_obj_list))
     return folder_obj_list
 
 
-def _get_trips(search_results_obj):
-    """ Get trips from the json object of search results """
-    segment_obj_list = _get_segments(search_results_obj)
-    trips = search_results_obj.get("trips")
-    trip_obj_list = []
-    for trip in trips:
-        dict_trip = {
-            "id": trip.get("id"),
-            "departure_date": trip.get("departure_date"),
-            "departure_station_id": trip.get("departure_station_id"),
-            "arrival_date": trip.get("arrival_date"),
-            "arrival_station_id": trip.get("arrival_station_id"),
-            "price": float(trip.get("cents")) / 100,
-            "currency": trip.get("currency"),
-            "segment_ids": trip.get("segment_ids"),
-        }
-        segments = []
-        for segment_id in dict_trip["segment_ids"]:
-            segment_found = _get_segment_from_id(
-                segment_obj_list=segment_obj_list,
-                segment_id=segment_id)
-            if segment_found:
-                segments.append(segment_found)
-            else:
-                # Remove the id if the object is invalid or not found
-                dict_trip["segment_ids"].remove(segment_id)
-        dict_trip["segments"] = segments
-
-        trip_obj = Trip(dict_trip)
-        trip_obj_list.append(trip_obj)
-    return trip_obj_list
-
-
-def _get_trip_from_id(trip_obj_list, trip_id):
-    """ Get a trip from a list, based on a trip id """
-    found_trip_obj = None
-    for trip_obj in trip_obj_list:
-        if trip_obj.id == trip_id:
-            found_trip_obj = trip_obj
-            break
-    return found_trip_obj
-
-
-def _get_segments(search_results_obj):
-    """ Get segments from the json object of search results """
-    comfort_class_obj_list = _get_comfort_classes(search_results_obj)
-    segments = search_results_obj.get("segments")
-    segment_obj_list = []
-    for segment in segments:
-        comfort_class_ids = segment.get("comfort_class_ids")
-        if comfort_class_ids is None:
-            comfort_class_ids = []
-        dict_segment = {
-            "id": segment.get("id"),
-            "departure_date": segment.get("departure_date"),
-            "departure_station_id": segment.get("departure_station_id"),
-            "arrival_date": segment.get("arrival_date"),
-            "arrival_station_id": segment.get("arrival_station_id"),
-            "transportation_mean": segment.get("transportation_mean"),
-            "carrier": segment.get("carrier"),
-            "train_number": segment.get("train_number"),
-            "travel_class": segment.get("travel_class"),
-            "trip_id": segment.get("trip_id"),
-            "comfort_class_ids": comfort_class_ids,
-        }
-        comfort_classes = []
-        for comfort_class_id in dict_segment["comfort_class_ids"]:
-            comfort_class_found = _get_comfort_class_from_id(
-                comfort_class_obj_list=comfort_class_obj_list,
-                comfort_class_id=comfort_class_id)
-            if comfort_class_found:
-                comfort_classes.append(comfort_class_found)
-            else:
-                # Remove the id if the object is invalid or not found
-                dict_segment["comfort_class_ids"].remove(comfort_class_id)
-        dict_segment["comfort_classes"] = comfort_classes
-        try:
-            segment_obj = Segment(dict_segment)
-            segment_obj_list.append(segment_obj)
-        except TypeError:
-            pass
-            # Do not add a segment if it is not contain all the required fields
-    return segment_obj_list
-
-
-def _get_segment_from_id(segment_obj_list, segment_id):
-    """ Get a segment from a list, based on a segment id """
-    found_segment_obj = None
-    for segment_obj in segment_obj_list:
-        if segment_obj.id == segment_id:
-            found_segment_obj = segment_obj
-            break
-    return found_segment_obj
-
-
-def _get_comfort_classes(search_results_obj):
-    """ Get comfort classes from the json object of search results """
-    comfort_classes = search_results_obj.get("comfort_classes")
-    if comfort_classes is None:
-        comfort_classes = []
-    comfort_class_obj_list = []
-    for comfort_class in comfort_classes:
-        description = comfort_class.get("description")
-        if description is None:
-            description = ""
-        title = comfort_class.get("title")
-        if title is None:
-            title = ""
-        dict_comfort_class = {
-            "id": comfort_class.get("id"),
-            "name": comfort_class.get("name"),
-            "description": description,
-            "title": title,
-            "options": comfort_class.get("options"),
-            "segment_id": comfort_class.get("segment_id"),
-            "condition_id": comfort_class.get("condition_id"),
-        }
-        comfort_class_obj = ComfortClass(dict_comfort_class)
-        comfort_class_obj_list.append(comfort_class_obj)
-    return comfort_class_obj_list
+def _referenced_ids(raw_objects, ids_field):
+    """ Returns the ids referenced by raw objects (without duplicates)
+    >>> _referenced_ids([{"trip_ids": ["a", "b"]}, {"trip_ids": ["b"]}], \
+"trip_ids")
+    ['a', 'b']
+    """
+    ids = {}
+    for raw_object in raw_objects:
+        for referenced_id in raw_object.get(ids_field) or []:
+            ids[referenced_id] = None
+    return list(ids)
+
+
+def _select_by_id(raw_objects, ids=None):
+    """ Returns the raw objects with these ids (the first one of each id),
+    or every raw object if ids is None """
+    raw_objects = raw_objects or []
+    if ids is None:
+        return raw_objects
+    index = {}
+    for raw_object in raw_objects:
+        index.setdefault(raw_object.get("id"), raw_object)
+    return [index[object_id] for object_id in ids if object_id in index]
+
+
+def _get_trips(search_results_obj, trip_ids=None, value_pool=None):
+    """ Get trips (dict id : Trip) from the json object of search results
+    (only the trips of trip_ids, if given) """
+    intern = value_pool.intern if value_pool is not None else _no_intern
+    trips = _select_by_id(search_results_obj.get("trips"), trip_ids)
+    segment_objs = _get_segments(
+        search_results_obj,
+        segment_ids=_referenced_ids(trips, "segment_ids"),
+        value_pool=value_pool)
+    with _span("parse.trips") as span:
+        trip_objs = {}
+        for trip in trips:
+            # Ignore the ids of the segments invalid or not found
+            segments = [segment_objs[segment_id]
+                        for segment_id in trip.get("segment_ids")
+                        if segment_id in segment_objs]
+            trip_obj = Trip._from_raw(trip, segments, intern)
+            trip_objs.setdefault(trip_obj.id, trip_obj)
+        span.set("count", len(trips))
+    return trip_objs
+
+
+def _get_segments(search_results_obj, segment_ids=None, value_pool=None):
+    """ Get segments (dict id : Segment) from the json object of search
+    results (only the segments of segment_ids, if given) """
+    intern = value_pool.intern if value_pool is not None else _no_intern
+    segments = _select_by_id(search_results_obj.get("segments"), segment_ids)
+    comfort_class_objs = _get_comfort_classes(
+        search_results_obj,
+        comfort_class_ids=_referenced_ids(segments, "comfort_class_ids"),
+        value_pool=value_pool)
+    with _span("parse.segments") as span:
+        segment_objs = {}
+        for segment in segments:
+            # Ignore the ids of the comfort classes invalid or not found
+            comfort_classes = [
+                comfort_class_objs[comfort_class_id]
+                for comfort_class_id in _value_or(
+                    segment.get("comfort_class_ids"), [])
+                if comfort_class_id in comfort_class_objs]
+            try:
+                segment_obj = Segment._from_raw(segment, comfort_classes,
+                                                intern)
+                segment_objs.setdefault(segment_obj.id, segment_obj)
+            except TypeError:
+                pass
+                # Do not add a segment if it is not contain all the required
+                # fields
+        span.set("count", len(segment_objs))
+    return segment_objs
+
+
+def _get_comfort_classes(search_results_obj, comfort_class_ids=None,
+                         value_pool=None):
+    """ Get comfort classes (dict id : ComfortClass) from the json object
+    of search results (only the comfort classes of comfort_class_ids, if
+    given) """
+    intern = value_pool.intern if value_pool is not None else _no_intern
+    with _span("parse.comfort_classes") as span:
+        comfort_classes = _select_by_id(
+            search_results_obj.get("comfort_classes"), comfort_class_ids)
+        comfort_class_objs = {}
+        for comfort_class in comfort_classes:
+            comfort_class_obj = ComfortClass._from_raw(comfort_class, intern)
+            comfort_class_objs.setdefault(comfort_class_obj.id,
+                                          comfort_class_obj)
+        span.set("count", len(comfort_classes))
+    return comfort_class_objs
+
+
+def _transportation_mean(trips_segments):
+    """ Returns the transportation means of the raw segments of a trip
+    >>> _transportation_mean([[{"transportation_mean": "train"}, \
+{"transportation_mean": "coach"}, {"transportation_mean": "train"}]])
+    'train+coach'
+    """
+    if not trips_segments:
+        return None
+    means = OrderedDict()
+    for segment in trips_segments[0]:
+        means[segment.get("transportation_mean")] = None
+    return "+".join(str(mean) for mean in means)
+
+
+# Getters of the projection fields, called with the raw folder, its
+# departure date (datetime object) and the raw segments of each of its trips
+_PROJECTION_GETTERS = {
+    "id": lambda folder, departure, segments: folder.get("id"),
+    "departure_date": lambda folder, departure, segments: departure,
+    "arrival_date":
+        lambda folder, departure, segments:
+        _parse_api_date(folder["arrival_date"]),
+    "duration":  # In minutes
+        lambda folder, departure, segments:
+        int((_parse_api_date(folder["arrival_date"]) -
+             departure).total_seconds() // 60),
+    "departure_station_id":
+        lambda folder, departure, segments:
+        folder.get("departure_station_id"),
+    "arrival_station_id":
+        lambda folder, departure, segments: folder.get("arrival_station_id"),
+    "price": lambda folder, departure, segments: float(folder["cents"]) / 100,
+    "currency": lambda folder, departure, segments: folder.get("currency"),
+    "transportation_mean":
+        lambda folder, departure, segments: _transportation_mean(segments),
+    "segment_nb":
+        lambda folder, departure, segments:
+        len(segments[0]) if segments else None,
+}
+
+
+@lru_cache(maxsize=None)
+def _projection(fields):
+    """ Returns the named tuple class of the rows of these fields
+    >>> _projection(("departure_date", "price"))._fields
+    ('departure_date', 'price')
+    """
+    fields = tuple(fields)
+    unknown = [field for field in fields if field not in _PROJECTION_GETTERS]
+    if not fields or unknown:
+        raise ValueError("Fields expected among {}, {} received".format(
+            PROJECTION_FIELDS, fields))
+    return namedtuple("Row", fields)
+
+
+def _project_folders(search_results_obj, fields, folder_filter=None):
+    """ Returns a (key, departure date, row) tuple for every folder of the
+    json object of search results, read from the raw objects without
+    building any Folder. The row is a named tuple of fields, and the key
+    identifies the duplicates like Folder.__eq__ """
+    fields = tuple(fields)
+    row_type = _projection(fields)
+    getters = [_PROJECTION_GETTERS[field] for field in fields]
+    folders = search_results_obj.get("folders")
+    with _span("project") as span:
+        span.set("count_in", len(folders))
+        if folder_filter is not None:
+            folders = folder_filter.filter_raw(folders)
+        trips = {trip.get("id"): trip for trip in _select_by_id(
+            search_results_obj.get("trips"),
+            _referenced_ids(folders, "trip_ids"))}
+        segments = {segment.get("id"): segment for segment in _select_by_id(
+            search_results_obj.get("segments"),
+            _referenced_ids(trips.values(), "segment_ids"))}
+        projected = []
+        for folder in folders:
+            # Ignore the ids of the trips and segments not found
+            folder_trips = [trips[trip_id]
+                            for trip_id in folder.get("trip_ids") or []
+                            if trip_id in trips]
+            trips_segments = [[segments[segment_id]
+                               for segment_id in trip.get("segment_ids") or []
+                               if segment_id in segments]
+                              for trip in folder_trips]
+            if folder_filter is not None and \
+                    not folder_filter.accepts_raw_trips(trips_segments):
+                continue
+            departure_date_obj = _parse_api_date(folder["departure_date"])
+            key = (folder["departure_date"], folder["arrival_date"],
+                   folder["cents"], folder.get("currency"),
+                   len(folder_trips))
+            row = row_type(*[getter(folder, departure_date_obj,
+                                    trips_segments) for getter in getters])
+            projected.append((key, departure_date_obj, row))
+        span.set("count", len(projected))
+    return projected
+
+
+def _unique_rows(projected):
+    """ Returns the rows of the projected folders, without duplicates and
+    sorted by departure date """
+    unique = OrderedDict()
+    for key, departure_date_obj, row in projected:
+        unique.setdefault(key, (departure_date_obj, row))
+    return [row for _, row in sorted(unique.values(),
+                                     key=lambda item: item[0])]
+
+
+def _parse_api_date(date_str):
+    """ Returns the datetime object of a date of the search results
+    >>> print(_parse_api_date("2018-10-15T08:49:00+02:00"))
+    2018-10-15 08:49:00+02:00
+    """
+    try:
+        date_obj = datetime.fromisoformat(date_str)
+    except (AttributeError, ValueError):  # Python < 3.7, or other format
+        return _str_datetime_to_datetime_obj(_fix_date_offset_format(date_str))
+    if date_obj.tzinfo is None:
+        date_obj = _localize(date_obj, _DEFAULT_SEARCH_TIMEZONE)
+    return date_obj
 
 
-def _get_comfort_class_from_id(comfort_class_obj_list, comfort_class_id):
-    """ Get a comfort_class from a list, based on a comfort_class id """
-    found_comfort_class_obj = None
-    for comfort_class_obj in comfort_class_obj_list:
-        if comfort_class_obj.id == comfort_class_id:
-            found_comfort_class_obj = comfort_class_obj
-            break
-    return found_comfort_class_obj
+class _FolderFilter(object):
+    """ Class to represent the criteria of a search, compiled into
+    predicates (only for the criteria which are set), cheapest first.
+    A folder is rejected at its first failing predicate.
+
+    The price and the departure date are checked on the raw folders
+    (filter_raw), before any object is built, and the other criteria on
+    the built folders (filter_built) """
+
+    def __init__(self, from_date_obj=None, to_date_obj=None,
+                 min_price=0.0, max_price=None, transportation_mean=None,
+                 min_segment_nb=1, max_segment_nb=None,
+                 bicycle_without_reservation_only=None,
+                 bicycle_with_reservation_only=None,
+                 bicycle_with_or_without_reservation=None):
+        # To build the same filter in another process (the predicates can
+        # not be pickled)
+        self.criteria = dict(
+            from_date_obj=from_date_obj, to_date_obj=to_date_obj,
+            min_price=min_price, max_price=max_price,
+            transportation_mean=transportation_mean,
+            min_segment_nb=min_segment_nb, max_segment_nb=max_segment_nb,
+            bicycle_without_reservation_only=bicycle_without_reservation_only,
+            bicycle_with_reservation_only=bicycle_with_reservation_only,
+            bicycle_with_or_without_reservation=(
+                bicycle_with_or_without_reservation))
+        # (raw predicate, built predicate) of the price and date criteria
+        folder_predicates = []
+        if min_price:
+            folder_predicates.append((
+                lambda raw: float(raw["cents"]) / 100 >= min_price,
+                lambda folder: folder.price >= min_price))
+        if max_price is not None:
+            folder_predicates.append((
+                lambda raw: float(raw["cents"]) / 100 <= max_price,
+                lambda folder: folder.price <= max_price))
+        if from_date_obj or to_date_obj:
+            def raw_date(raw):
+                return _in_period(_parse_api_date(raw["departure_date"]),
+                                  from_date_obj, to_date_obj)
+
+            def built_date(folder):
+                return _in_period(folder.departure_date_obj,
+                                  from_date_obj, to_date_obj)
+            folder_predicates.append((raw_date, built_date))
+        self._raw_predicates = [raw for raw, _ in folder_predicates]
+        self._built_predicates = [built for _, built in folder_predicates]
+
+        self.from_date_obj = from_date_obj
+        # Criteria of every trip of the folders, also checked on the raw
+        # segments by accepts_raw_trips
+        self.transportation_mean = transportation_mean
+        self.min_segment_nb = min_segment_nb
+        self.max_segment_nb = max_segment_nb
+        # The bicycle criteria are read from the comfort classes
+        self.needs_comfort_classes = bool(
+            bicycle_without_reservation_only or
+            bicycle_with_reservation_only or
+            bicycle_with_or_without_reservation)
+        trip_predicates = []
+        if min_segment_nb:
+            trip_predicates.append(
+                lambda trip: len(trip.segments) >= min_segment_nb)
+        if max_segment_nb:
+            trip_predicates.append(
+                lambda trip: len(trip.segments) <= max_segment_nb)
+        # All segments of the trip must respect the conditions
+        segment_predicates = []
+        if transportation_mean:
+            segment_predicates.append(
+                lambda segment:
+                segment.transportation_mean == transportation_mean)
+        if bicycle_with_reservation_only:
+            segment_predicates.append(
+                lambda segment: segment.bicycle_with_reservation ==
+                bicycle_with_reservation_only)
+        if bicycle_without_reservation_only:
+            segment_predicates.append(
+                lambda segment: segment.bicycle_without_reservation ==
+                bicycle_without_reservation_only)
+        if bicycle_with_or_without_reservation:
+            segment_predicates.append(
+                lambda segment: (segment.bicycle_with_reservation or
+                                 segment.bicycle_without_reservation) ==
+                bicycle_with_or_without_reservation)
+        for segment_predicate in segment_predicates:
+            trip_predicates.append(
+                lambda trip, predicate=segment_predicate:
+                all(predicate(segment) for segment in trip.segments))
+        self._trip_predicates = trip_predicates
+
+    def accepts_raw(self, raw_folder):
+        for predicate in self._raw_predicates:
+            if not predicate(raw_folder):
+                return False
+        return True
+
+    def accepts_built(self, folder):
+        for trip in folder.trips:
+            for predicate in self._trip_predicates:
+                if not predicate(trip):
+                    return False
+        return True
+
+    def accepts(self, folder):
+        for predicate in self._built_predicates:
+            if not predicate(folder):
+                return False
+        return self.accepts_built(folder)
+
+    def accepts_raw_trips(self, trips_segments):
+        """ Checks the number of segments and the transportation mean of
+        the trips of a folder, given as the lists of their raw segments
+        (the bicycle criteria are not checked) """
+        for segments in trips_segments:
+            if self.min_segment_nb and len(segments) < self.min_segment_nb:
+                return False
+            if self.max_segment_nb and len(segments) > self.max_segment_nb:
+                return False
+            if self.transportation_mean:
+                for segment in segments:
+                    if segment.get("transportation_mean") != \
+                            self.transportation_mean:
+                        return False
+        return True
+
+    def filter_raw(self, raw_folders):
+        """ Returns the raw folders (json objects) which respect the price
+        and date criteria """
+        if not self._raw_predicates:
+            return list(raw_folders)
+        return [raw_folder for raw_folder in raw_folders
+                if self.accepts_raw(raw_folder)]
+
+    def filter_built(self, folder_list):
+        """ Returns the folders (already checked with filter_raw) which
+        respect the other criteria """
+        if not self._trip_predicates:
+            return list(folder_list)
+        return [folder for folder in folder_list if self.accepts_built(folder)]
+
+    def filter(self, folder_list):
+        """ Returns the folders which respect every criteria """
+        return [folder for folder in folder_list if self.accepts(folder)]
+
+
+def _in_period(date_obj, from_date_obj=None, to_date_obj=None):
+    if from_date_obj and date_obj < from_date_obj:
+        return False
+    if to_date_obj and date_obj > to_date_obj:
+        return False
+    return True
 
 
 def _filter_folders(folder_list, from_date_obj=None, to_date_obj=None,
@@ -903,70 +2178,15 @@ def _filter_folders(folder_list, from_date_obj=None, to_date_obj=None,
                     bicycle_with_or_without_reservation=None):
     """ Filter a list of folders, based on different attributes, such as
     from_date or min_price. Returns the filtered list """
-    filtered_folder_list = []
-    for folder in folder_list:
-        to_be_filtered = False
-
-        # Price
-        if folder.price < min_price:
-            to_be_filtered = True
-        if max_price is not None:
-            if folder.price > max_price:
-                to_be_filtered = True
-
-        # Date
-        if from_date_obj:
-            if folder.departure_date_obj < from_date_obj:
-                to_be_filtered = True
-        if to_date_obj:
-            if folder.departure_date_obj > to_date_obj:
-                to_be_filtered = True
-
-        for trip in folder.trips:  # Check every trip
-
-            # Transportation mean
-            if transportation_mean:
-                for segment in trip.segments:
-                    if segment.transportation_mean != transportation_mean:
-                        to_be_filtered = True
-                        break
-
-            # Number of segments
-            if min_segment_nb:
-                if len(trip.segments) < min_segment_nb:
-                    to_be_filtered = True
-            if max_segment_nb:
-                if len(trip.segments) > max_segment_nb:
-                    to_be_filtered = True
-
-            # Bicycle
-            # All segments of the trip must respect the bicycle conditions
-            if bicycle_with_reservation_only:
-                for segment in trip.segments:
-                    if segment.bicycle_with_reservation != \
-                            bicycle_with_reservation_only:
-                        to_be_filtered = True
-                        break
-
-            if bicycle_without_reservation_only:
-                for segment in trip.segments:
-                    if segment.bicycle_without_reservation != \
-                            bicycle_without_reservation_only:
-                        to_be_filtered = True
-                        break
-
-            if bicycle_with_or_without_reservation:
-                for segment in trip.segments:
-                    condition = (segment.bicycle_with_reservation or
-                                 segment.bicycle_without_reservation)
-                    if condition != bicycle_with_or_without_reservation:
-                        to_be_filtered = True
-                        break
-
-        # Add to list if it has not been filtered
-        if not to_be_filtered:
-            filtered_folder_list.append(folder)
-    return filtered_folder_list
+    return _FolderFilter(
+        from_date_obj=from_date_obj, to_date_obj=to_date_obj,
+        min_price=min_price, max_price=max_price,
+        transportation_mean=transportation_mean,
+        min_segment_nb=min_segment_nb, max_segment_nb=max_segment_nb,
+        bicycle_without_reservation_only=bicycle_without_reservation_only,
+        bicycle_with_reservation_only=bicycle_with_reservation_only,
+        bicycle_with_or_without_reservation=bicycle_with_or_without_reservation
+    ).filter(folder_list)
 
 
 def _strfdelta(tdelta, fmt):
@@ -986,6 +2206,7 @@ def _read_file(filename):
 
 def dict_str_to_dict(dict_str):
     """ Returns the dictionnary string from result of a request (with null, false, true) as a dictionnary object """
+    import re
     dict_str_inter = re.sub('null', 'None', dict_str)
     dict_str_inter = re.sub('false', 'False', dict_str_inter)
     dict_str_inter = re.sub('true', 'True', dict_str_inter)
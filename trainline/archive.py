@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Archive of the search results in a SQLite database, for the analysis of
+the history of the fares.
+
+The folders, their trips and their segments are inserted in bulk (one
+transaction and one executemany per table for every batch of folders),
+with the time of their observation. The dates are stored as Unix
+timestamps, and the folders are indexed on their route and departure date
+(departure_station_id, arrival_station_id, departure_date) and on their
+observation time (observed_at). The segments are indexed on their train
+(train_number, departure_date).
+
+Usage :
+
+    from trainline import archive
+
+    with archive.Archive("fares.sqlite") as fares:
+        fares.add(trainline.iter_search(...))  # Observed now
+        # Cheapest price of every departure, at every observation
+        for point in fares.price_history("5311", "828",
+                                         "15/10/2018 00:00",
+                                         "16/10/2018 00:00"):
+            print(point.departure_date, point.observed_at, point.price)
+        # Cheapest price of a train, at every observation
+        fares.train_prices("8501", "15/10/2018")
+"""
+
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
+
+from . import _DEFAULT_SEARCH_TIMEZONE, _READABLE_DATE_FORMAT, \
+    _DATE_FORMAT, _str_datetime_to_datetime_obj
+
+_BATCH_SIZE = 5000  # Folders inserted per transaction
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY,
+    observed_at INTEGER NOT NULL,
+    folder_id TEXT,
+    departure_station_id TEXT,
+    arrival_station_id TEXT,
+    departure_date INTEGER,
+    arrival_date INTEGER,
+    price REAL,
+    currency TEXT,
+    transportation_mean TEXT,
+    segment_nb INTEGER
+);
+CREATE TABLE IF NOT EXISTS trips (
+    id INTEGER PRIMARY KEY,
+    folder INTEGER NOT NULL REFERENCES folders (id),
+    trip_id TEXT,
+    price REAL,
+    currency TEXT
+);
+CREATE TABLE IF NOT EXISTS segments (
+    trip INTEGER NOT NULL REFERENCES trips (id),
+    position INTEGER,
+    segment_id TEXT,
+    departure_station_id TEXT,
+    arrival_station_id TEXT,
+    departure_date INTEGER,
+    arrival_date INTEGER,
+    transportation_mean TEXT,
+    carrier TEXT,
+    train_number TEXT,
+    travel_class TEXT
+);
+CREATE INDEX IF NOT EXISTS folders_route
+    ON folders (departure_station_id, arrival_station_id, departure_date);
+CREATE INDEX IF NOT EXISTS folders_observed_at ON folders (observed_at);
+CREATE INDEX IF NOT EXISTS segments_train
+    ON segments (train_number, departure_date);
+"""
+
+_INSERT_FOLDER = "INSERT INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_INSERT_TRIP = "INSERT INTO trips VALUES (?, ?, ?, ?, ?)"
+_INSERT_SEGMENT = \
+    "INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Cheapest price of every departure of a route, at every observation
+_PRICE_HISTORY = """
+SELECT departure_date, observed_at, MIN(price), currency FROM folders
+WHERE departure_station_id = ? AND arrival_station_id = ?
+    AND departure_date >= ? AND departure_date < ?
+GROUP BY departure_date, observed_at
+ORDER BY departure_date, observed_at
+"""
+
+# Cheapest price of every departure of a route, over all the observations
+_CHEAPEST = """
+SELECT departure_date, observed_at, MIN(price), currency FROM folders
+WHERE departure_station_id = ? AND arrival_station_id = ?
+    AND departure_date >= ? AND departure_date < ?
+GROUP BY departure_date
+ORDER BY departure_date
+"""
+
+# Cheapest price of the folders with a segment of a train, at every
+# observation
+_TRAIN_PRICES = """
+SELECT segments.departure_date, folders.observed_at, MIN(folders.price),
+    folders.currency
+FROM segments
+    JOIN trips ON trips.id = segments.trip
+    JOIN folders ON folders.id = trips.folder
+WHERE segments.train_number = ?
+    AND segments.departure_date >= ? AND segments.departure_date < ?
+GROUP BY segments.departure_date, folders.observed_at
+ORDER BY segments.departure_date, folders.observed_at
+"""
+
+# Observed price of a departure (or of a train)
+PricePoint = namedtuple("PricePoint", ["departure_date", "observed_at",
+                                       "price", "currency"])
+
+
+@lru_cache(maxsize=None)
+def _search_timezone():
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:  # Python < 3.9
+        import pytz
+        return pytz.timezone(_DEFAULT_SEARCH_TIMEZONE)
+    return ZoneInfo(_DEFAULT_SEARCH_TIMEZONE)
+
+
+def _timestamp(date, date_format=_READABLE_DATE_FORMAT):
+    """ Returns the Unix timestamp of a datetime object or of a date string
+    (in the timezone of the searches) """
+    if isinstance(date, str):
+        date = _str_datetime_to_datetime_obj(date, date_format=date_format)
+    return int(date.timestamp())
+
+
+def _point(row):
+    departure_date, observed_at, price, currency = row
+    return PricePoint(
+        datetime.fromtimestamp(departure_date, _search_timezone()),
+        datetime.fromtimestamp(observed_at, _search_timezone()),
+        price, currency)
+
+
+class Archive(object):
+    """ Class to store search results in a SQLite database (see the module
+    documentation), at path (":memory:" for a temporary archive) """
+
+    def __init__(self, path, batch_size=_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(_SCHEMA)
+
+    def _next_id(self, table):
+        return self.connection.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM " + table).fetchone()[0]
+
+    def add(self, folders, observed_at=None):
+        """ Insert folders (any iterable, ex : Folders or iter_search),
+        observed at observed_at (datetime, now by default), by batches of
+        batch_size folders. Returns the number of folders inserted """
+        observed_at = int(time.time()) if observed_at is None \
+            else _timestamp(observed_at)
+        folders = iter(folders)
+        count = 0
+        while True:
+            batch = list(islice(folders, self.batch_size))
+            if not batch:
+                return count
+            self._insert(batch, observed_at)
+            count += len(batch)
+
+    def _insert(self, folders, observed_at):
+        with self.connection:  # One transaction (rolled back on error)
+            # The ids of the rows are given by the archive, so that the
+            # trips and segments of a batch are inserted with their
+            # folders : they are read under the write lock, which no other
+            # writer (Archive or process) can hold until the commit
+            self.connection.execute("BEGIN IMMEDIATE")
+            folder_rows, trip_rows, segment_rows = self._rows(
+                folders, observed_at, self._next_id("folders"),
+                self._next_id("trips"))
+            self.connection.executemany(_INSERT_FOLDER, folder_rows)
+            self.connection.executemany(_INSERT_TRIP, trip_rows)
+            self.connection.executemany(_INSERT_SEGMENT, segment_rows)
+
+    @staticmethod
+    def _rows(folders, observed_at, folder_id, trip_id):
+        """ Returns the rows of the folders, trips and segments, with ids
+        from folder_id and trip_id """
+        folder_rows = []
+        trip_rows = []
+        segment_rows = []
+        # Timestamps of the dates of the batch, shared by the folders,
+        # trips and segments of a same train
+        timestamps = {}
+
+        def timestamp(date_str, date_obj):
+            try:
+                return timestamps[date_str]
+            except KeyError:
+                timestamps[date_str] = value = int(date_obj.timestamp())
+                return value
+        for folder in folders:
+            folder_rows.append((
+                folder_id, observed_at, folder.id,
+                folder.departure_station_id, folder.arrival_station_id,
+                timestamp(folder.departure_date, folder.departure_date_obj),
+                timestamp(folder.arrival_date, folder.arrival_date_obj),
+                folder.price, folder.currency,
+                getattr(folder, "transportation_mean", None),
+                getattr(folder, "segment_nb", None)))
+            for trip in folder.trips:
+                trip_rows.append((trip_id, folder_id, trip.id, trip.price,
+                                  trip.currency))
+                for position, segment in enumerate(trip.segments):
+                    segment_rows.append((
+                        trip_id, position, segment.id,
+                        segment.departure_station_id,
+                        segment.arrival_station_id,
+                        timestamp(segment.departure_date,
+                                  segment.departure_date_obj),
+                        timestamp(segment.arrival_date,
+                                  segment.arrival_date_obj),
+                        segment.transportation_mean, segment.carrier,
+                        segment.train_number, segment.travel_class))
+                trip_id += 1
+            folder_id += 1
+        return folder_rows, trip_rows, segment_rows
+
+    def price_history(self, departure_station_id, arrival_station_id,
+                      from_date, to_date):
+        """ Returns the cheapest price of every departure of a route between
+        from_date and to_date (datetime objects or "dd/mm/yyyy HH:MM"), at
+        every observation (PricePoints sorted by departure and observation
+        dates) """
+        return [_point(row) for row in self.connection.execute(
+            _PRICE_HISTORY, (departure_station_id, arrival_station_id,
+                             _timestamp(from_date), _timestamp(to_date)))]
+
+    def cheapest(self, departure_station_id, arrival_station_id, from_date,
+                 to_date):
+        """ Returns the cheapest price ever observed for every departure of a
+        route between from_date and to_date, with the date of one of its
+        observations (PricePoints sorted by departure date) """
+        return [_point(row) for row in self.connection.execute(
+            _CHEAPEST, (departure_station_id, arrival_station_id,
+                        _timestamp(from_date), _timestamp(to_date)))]
+
+    def train_prices(self, train_number, departure_date):
+        """ Returns the cheapest price of the folders with a segment of a
+        train on departure_date (date object or "dd/mm/yyyy"), at every
+        observation (PricePoints sorted by observation date) """
+        if not isinstance(departure_date, str):
+            departure_date = departure_date.strftime(_DATE_FORMAT)
+        next_date = datetime.strptime(departure_date, _DATE_FORMAT) + \
+            timedelta(days=1)
+        return [_point(row) for row in self.connection.execute(
+            _TRAIN_PRICES, (train_number,
+                            _timestamp(departure_date + " 00:00"),
+                            _timestamp(next_date.strftime(_DATE_FORMAT) +
+                                       " 00:00")))]
+
+    def __len__(self):
+        """ Returns the number of folders archived """
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM folders").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Concurrent searches on many routes : the requests are sent by a pool of
+threads sharing one session (connections, cache and value pool), and the
+responses can be parsed by a pool of processes, so that the parsing
+throughput scales with the cores instead of one busy core.
+
+Usage :
+
+    from trainline import batch
+    searches = [
+        {"departure_station": "Toulouse Matabiau",
+         "arrival_station": "Bordeaux St-Jean",
+         "from_date": "15/10/2018 08:00", "to_date": "15/10/2018 18:00"},
+        ...]
+    for result in batch.search_many(searches, workers=8, processes=4):
+        if result.error is None:
+            print(result.params, len(result.results))
+
+    # Cheapest fares of every day of a month
+    for day in batch.fare_calendar("Toulouse Matabiau", "Bordeaux St-Jean",
+                                   "01/10/2018", 31, top_k=3):
+        print(day.date, day.cheapest and day.cheapest.price)
+
+    # 5 cheapest round trips, with at least 2 days at destination
+    for round_trip in batch.search_round_trip(
+            "Toulouse Matabiau", "Bordeaux St-Jean",
+            ("15/10/2018 06:00", "15/10/2018 12:00"),
+            ("17/10/2018 14:00", "17/10/2018 22:00"),
+            min_stay=timedelta(days=2), top_k=5):
+        print(round_trip.price, round_trip.outbound, round_trip.inbound)
+
+    # Every station of Lyon to every station of Bordeaux
+    folders = batch.search_city("Lyon", "Bordeaux", "15/10/2018 08:00",
+                                "15/10/2018 18:00")
+"""
+
+import heapq
+import logging
+from bisect import bisect_left, bisect_right
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+
+from . import Trainline, Folders, search, iter_search, get_city_stations, \
+    PROJECTION_FIELDS, _DATE_FORMAT
+
+_WORKERS = 4  # Searches running at the same time
+_TOP_K = 3  # Cheapest fares kept per day by fare_calendar
+_ROUND_TRIPS_NB = 10  # Cheapest combinations returned by search_round_trip
+_MAX_STATION_PAIRS = 64  # Searches of search_city, above which it refuses
+_LOGGER = logging.getLogger(__name__)
+
+# Result of one search of search_many : its parameters, and its results
+# (Folders, or list of named tuples with fields) or the exception raised
+BatchResult = namedtuple("BatchResult", ["params", "results", "error"])
+
+# Fares of one day of fare_calendar : its date, its cheapest row (None
+# without results), its top_k cheapest rows (sorted by price), and the
+# exception raised by its search (None if it succeeded)
+DayFares = namedtuple("DayFares", ["date", "cheapest", "top", "error"])
+
+# Combination of search_round_trip : outbound and inbound folders (or rows
+# of fields), and their total price
+RoundTrip = namedtuple("RoundTrip", ["outbound", "inbound", "price"])
+
+
+class RateLimiter(object):
+    """ Token bucket allowing rate operations per second on average, in
+    bursts of up to burst operations """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """ Returns the seconds to wait for the next operation """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def try_acquire(self):
+        """ Returns True (and counts the operation) if it is allowed now """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """ Wait until an operation is allowed, and count it """
+        while not self.try_acquire():
+            time.sleep(self.delay())
+
+
+def pooled_session(workers=_WORKERS, max_rate=None, base_url=None):
+    """ Returns a Trainline session sending the requests of its workers
+    threads through one pool of connections, at most max_rate requests per
+    second if given (see transport.ThrottledTransport), to base_url if
+    given (see transport.RedirectTransport) """
+    import requests
+    from .transport import PassthroughTransport, ThrottledTransport, \
+        RedirectTransport
+    http_session = requests.session()
+    for prefix in ("https://", "http://"):
+        http_session.mount(
+            prefix, requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    transport = PassthroughTransport(http_session)
+    if base_url:
+        transport = RedirectTransport(base_url, transport=transport)
+    if max_rate:
+        transport = ThrottledTransport(max_rate, transport=transport)
+    return Trainline(transport=transport)
+
+
+def _search(session, params, fields, parse_executor):
+    return search(trainline_session=session, fields=fields,
+                  parse_executor=parse_executor, **params)
+
+
+def search_many(searches, trainline_session=None, workers=_WORKERS,
+                processes=None, fields=None):
+    """ Runs searches (dicts of parameters of trainline.search) with workers
+    threads sharing trainline_session, and yields a BatchResult for every
+    search as soon as it is done.
+
+    With processes, the responses are decoded, parsed and filtered in a
+    pool of processes, which send back the rows of fields (PROJECTION_FIELDS
+    by default, see search) instead of pickled Folder objects """
+    session = trainline_session or pooled_session(workers)
+    parse_executor = None
+    if processes:
+        fields = fields or PROJECTION_FIELDS
+        parse_executor = ProcessPoolExecutor(max_workers=processes)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    try:
+        for params in searches:
+            future = executor.submit(_search, session, params, fields,
+                                     parse_executor)
+            futures[future] = params
+        for future in as_completed(futures):
+            try:
+                yield BatchResult(futures[future], future.result(), None)
+            except Exception as e:
+                yield BatchResult(futures[future], None, e)
+    finally:
+        for future in futures:
+            future.cancel()  # If the caller stopped iterating
+        executor.shutdown(wait=True)
+        if parse_executor is not None:
+            parse_executor.shutdown(wait=True)
+
+
+def _day_fares(session, departure_station, arrival_station, day, top_k,
+               fields, search_params):
+    """ Returns the DayFares of a day, read page after page : only the top_k
+    cheapest rows are kept """
+    rows = iter_search(departure_station, arrival_station,
+                       day.strftime(_DATE_FORMAT) + " 00:00",
+                       day.strftime(_DATE_FORMAT) + " 23:59",
+                       trainline_session=session, fields=fields,
+                       **search_params)
+    top = heapq.nsmallest(top_k, rows, key=lambda row: row.price)
+    return DayFares(day, top[0] if top else None, top, None)
+
+
+def fare_calendar(departure_station, arrival_station, start_date, days,
+                  top_k=_TOP_K, trainline_session=None, workers=_WORKERS,
+                  fields=PROJECTION_FIELDS, **search_params):
+    """ Returns the DayFares of days days from start_date (date object or
+    "dd/mm/yyyy"), sorted by date. The days are searched with workers
+    threads sharing trainline_session (with the other parameters of
+    trainline.search), and read into the rows of fields (which must contain
+    price) """
+    if "price" not in fields:
+        raise ValueError("fields must contain price")
+    if top_k < 1:
+        raise ValueError("top_k must be >= 1, {} received".format(top_k))
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, _DATE_FORMAT).date()
+    session = trainline_session or pooled_session(workers)
+    dates = [start_date + timedelta(days=day) for day in range(days)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_day_fares, session, departure_station,
+                                   arrival_station, day, top_k, fields,
+                                   search_params)
+                   for day in dates]
+        calendar = []
+        for day, future in zip(dates, futures):
+            try:
+                calendar.append(future.result())
+            except Exception as e:
+                calendar.append(DayFares(day, None, [], e))
+    return calendar
+
+
+class _RangeMin(object):
+    """ Sparse table of the cheapest item of every range of items, answered
+    in constant time """
+
+    def __init__(self, prices):
+        self.prices = prices
+        self._levels = [list(range(len(prices)))]
+        width = 1
+        while 2 * width <= len(prices):
+            previous = self._levels[-1]
+            self._levels.append([
+                self._cheapest(previous[i], previous[i + width])
+                for i in range(len(prices) - 2 * width + 1)])
+            width *= 2
+
+    def _cheapest(self, i, j):
+        return i if self.prices[i] <= self.prices[j] else j
+
+    def query(self, lo, hi):
+        """ Returns the index of the cheapest item of [lo, hi[ (not empty) """
+        level = (hi - lo).bit_length() - 1
+        return self._cheapest(self._levels[level][lo],
+                              self._levels[level][hi - (1 << level)])
+
+
+def pair_round_trips(outbounds, inbounds, min_stay=timedelta(0),
+                     max_stay=None, max_total_price=None,
+                     top_k=_ROUND_TRIPS_NB, dates=None):
+    """ Returns the top_k cheapest RoundTrips (sorted by price) of the
+    outbounds and inbounds (folders, or rows with departure_date,
+    arrival_date and price) where the inbound leaves at least min_stay (and
+    at most max_stay) after the arrival of the outbound, for at most
+    max_total_price.
+
+    The inbounds are sorted by departure date, so that the inbounds of an
+    outbound are a range of them, found by bisection. The cheapest
+    combinations are taken from a heap of ranges : the cheapest inbound of
+    a range (given by a sparse table) is combined with its outbound, and
+    the rest of the range is split in 2 ranges around it """
+    if dates is None:
+        def dates(result):
+            return result.departure_date_obj, result.arrival_date_obj
+    inbounds = sorted(inbounds, key=lambda inbound: dates(inbound)[0])
+    departures = [dates(inbound)[0] for inbound in inbounds]
+    cheapest = _RangeMin([inbound.price for inbound in inbounds])
+
+    def cheapest_of_range(outbound_index, lo, hi):
+        """ Returns the heap entry of the range (None if it is empty, or
+        above max_total_price) """
+        if lo >= hi:
+            return None
+        index = cheapest.query(lo, hi)
+        price = round(outbounds[outbound_index].price +
+                      inbounds[index].price, 2)
+        if max_total_price is not None and price > max_total_price:
+            return None
+        return price, outbound_index, index, lo, hi
+
+    heap = []
+    for outbound_index, outbound in enumerate(outbounds):
+        arrival = dates(outbound)[1]
+        entry = cheapest_of_range(
+            outbound_index, bisect_left(departures, arrival + min_stay),
+            len(departures) if max_stay is None else
+            bisect_right(departures, arrival + max_stay))
+        if entry is not None:
+            heap.append(entry)
+    heapq.heapify(heap)
+    round_trips = []
+    while heap and len(round_trips) < top_k:
+        price, outbound_index, index, lo, hi = heapq.heappop(heap)
+        round_trips.append(RoundTrip(outbounds[outbound_index],
+                                     inbounds[index], price))
+        for entry in (cheapest_of_range(outbound_index, lo, index),
+                      cheapest_of_range(outbound_index, index + 1, hi)):
+            if entry is not None:
+                heapq.heappush(heap, entry)
+    return round_trips
+
+
+def search_round_trip(departure_station, arrival_station, outbound_dates,
+                      inbound_dates, min_stay=timedelta(0), max_stay=None,
+                      max_total_price=None, top_k=_ROUND_TRIPS_NB,
+                      trainline_session=None, fields=None, **search_params):
+    """ Search the outbounds from departure_station to arrival_station
+    between outbound_dates (from_date, to_date), and the inbounds back
+    between inbound_dates, at the same time, and returns their top_k
+    cheapest RoundTrips (see pair_round_trips). The other parameters are
+    the ones of trainline.search (with fields, they must contain
+    departure_date, arrival_date and price) """
+    dates = None
+    if fields is not None:
+        if not {"departure_date", "arrival_date", "price"} <= set(fields):
+            raise ValueError("fields must contain departure_date, "
+                             "arrival_date and price")
+
+        def dates(row):
+            return row.departure_date, row.arrival_date
+    session = trainline_session or pooled_session(2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        outbound_future, inbound_future = [
+            executor.submit(search, from_station, to_station, from_date,
+                            to_date, trainline_session=session,
+                            fields=fields, **search_params)
+            for from_station, to_station, (from_date, to_date) in (
+                (departure_station, arrival_station, outbound_dates),
+                (arrival_station, departure_station, inbound_dates))]
+        outbounds = list(outbound_future.result())
+        inbounds = list(inbound_future.result())
+    return pair_round_trips(outbounds, inbounds, min_stay=min_stay,
+                            max_stay=max_stay,
+                            max_total_price=max_total_price, top_k=top_k,
+                            dates=dates)
+
+
+def _stations(city):
+    """ Returns the station names of a city name (see get_city_stations),
+    or of a list of station names """
+    if isinstance(city, str):
+        return get_city_stations(city)
+    return tuple(city)
+
+
+def search_city(departure_city, arrival_city, from_date, to_date,
+                trainline_session=None, workers=_WORKERS,
+                max_pairs=_MAX_STATION_PAIRS, **search_params):
+    """ Search from every station of departure_city to every station of
+    arrival_city (city names, see trainline.get_city_stations, or lists of
+    station names), with workers threads sharing trainline_session and the
+    other parameters of trainline.search. Returns the Folders of all the
+    station pairs, deduplicated and sorted by departure date.
+
+    The folders are merged as the searches finish. A failed search is
+    logged and skipped, unless every search failed (its error is raised).
+    Raises ValueError above max_pairs station pairs """
+    pairs = [(departure, arrival)
+             for departure in _stations(departure_city)
+             for arrival in _stations(arrival_city) if departure != arrival]
+    if len(pairs) > max_pairs:
+        raise ValueError(
+            "{} station pairs between {} and {}, more than max_pairs "
+            "({})".format(len(pairs), departure_city, arrival_city,
+                          max_pairs))
+    session = trainline_session or pooled_session(workers)
+    folders = set()
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(search, departure, arrival, from_date,
+                                   to_date, trainline_session=session,
+                                   **search_params): (departure, arrival)
+                   for departure, arrival in pairs}
+        for future in as_completed(futures):
+            try:
+                folders.update(future.result())
+            except Exception as e:
+                errors.append(e)
+                _LOGGER.warning("Search from %s to %s failed : %r",
+                                *futures[future], e)
+    if errors and len(errors) == len(pairs):
+        raise errors[-1]
+    return Folders(sorted(folders, key=lambda folder: (
+        folder.departure_date_obj, folder.price)))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Long-running local search service, which keeps the station index, the
+HTTP connections, the login token and the recent results warm between
+searches. trainline_cli.py forwards its searches to it when it is running.
+
+Usage :
+
+    python3 -m trainline.daemon  # Unix socket (DEFAULT_SOCKET)
+    python3 -m trainline.daemon --port 8080  # HTTP on 127.0.0.1
+
+    curl --unix-socket /run/user/1000/trainline-1000.sock \
+"http://localhost/search?departure=Toulouse%20Matabiau&\
+arrival=Bordeaux%20St-Jean&from_date=15/10/2018%2008:00&\
+to_date=15/10/2018%2018:00&format=json"
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import click
+
+from . import Trainline, ResponseCache, search, \
+    _load_station_db, _READABLE_DATE_FORMAT
+from .forward import DEFAULT_SOCKET, forward_search  # noqa: F401
+from .transport import PassthroughTransport
+
+_RESULT_TTL = 60  # Seconds during which the results of a search are served
+_RESULT_CACHE_SIZE = 256  # Searches kept in the results cache
+_SEARCH_PARAMETERS = ("departure", "arrival", "from_date", "to_date",
+                      "transport")
+
+_HOST = "127.0.0.1"  # The HTTP server has no authentication
+
+
+def folder_to_dict(folder):
+    """ Returns the main attributes of a folder, as in the csv """
+    return {
+        "departure_date": folder.departure_date_obj.strftime(
+            _READABLE_DATE_FORMAT),
+        "arrival_date": folder.arrival_date_obj.strftime(
+            _READABLE_DATE_FORMAT),
+        "duration": int((folder.arrival_date_obj -
+                         folder.departure_date_obj).total_seconds() // 60),
+        "number_of_segments": folder.segment_nb,
+        "price": folder.price,
+        "currency": folder.currency,
+        "transportation_mean": folder.transportation_mean,
+        "bicycle_reservation": folder.bicycle_reservation,
+    }
+
+
+class SearchDaemon(object):
+    """ Search service keeping its state warm between the searches :
+    - the station index, loaded at startup
+    - one Trainline session, with pooled connections (one requests session)
+      and the login token when an account is given
+    - the results of the last searches (served during result_ttl seconds)
+
+    With an account, the searches are done for the account passengers given
+    as (firstname, lastname, birthdate) tuples """
+
+    def __init__(self, email_account=None, password_account=None,
+                 passengers=None, result_ttl=_RESULT_TTL,
+                 result_cache_size=_RESULT_CACHE_SIZE, transport=None):
+        _load_station_db()
+        self.session = Trainline(
+            email_account=email_account, password_account=password_account,
+            cache=ResponseCache(),
+            transport=transport or PassthroughTransport())
+        self.passengers = self.session.get_passengers(passengers or []) \
+            or None
+        self.result_ttl = result_ttl
+        self.result_cache_size = result_cache_size
+        self.searches_nb = 0
+        self.cache_hits = 0
+        self._results = OrderedDict()  # key : (expiration time, Folders)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def search(self, departure, arrival, from_date, to_date, transport=None):
+        """ Returns the Folders of a search (from the results cache if it
+        was done less than result_ttl seconds ago) """
+        key = (departure.lower().strip(), arrival.lower().strip(),
+               from_date, to_date, transport)
+        now = time.monotonic()
+        with self._lock:
+            self.searches_nb += 1
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > now:
+                self._results.move_to_end(key)
+                self.cache_hits += 1
+                return cached[1]
+        results = search(
+            departure_station=departure,
+            arrival_station=arrival,
+            from_date=from_date,
+            to_date=to_date,
+            passengers=self.passengers,
+            transportation_mean=transport,
+            trainline_session=self.session)
+        with self._lock:
+            self._results[key] = (time.monotonic() + self.result_ttl,
+                                  results)
+            self._results.move_to_end(key)
+            while len(self._results) > self.result_cache_size:
+                self._results.popitem(last=False)
+        return results
+
+    def status(self):
+        with self._lock:
+            return {"status": "ok", "searches": self.searches_nb,
+                    "cache_hits": self.cache_hits,
+                    "cached_results": len(self._results),
+                    "logged_in": self.session.token_session is not None}
+
+    def listen(self, socket_path=None, port=None):
+        """ Open the server on a Unix socket (DEFAULT_SOCKET by default,
+        only accessible to the current user), or on 127.0.0.1:port if a
+        port is given (0 for any free port, accessible to all the local
+        users) """
+        if port is not None:
+            self._server = _ThreadingHTTPServer((_HOST, port),
+                                                _DaemonRequestHandler)
+        else:
+            socket_path = socket_path or DEFAULT_SOCKET
+            if os.path.exists(socket_path):
+                if _is_listening(socket_path):
+                    raise OSError("A daemon is already listening on {}".format(
+                        socket_path))
+                os.unlink(socket_path)  # Left by a daemon which was killed
+            # The socket is created with the permissions 0600 (only for
+            # the current user), without a window between bind and chmod
+            umask = os.umask(0o177)
+            try:
+                self._server = _ThreadingUnixHTTPServer(
+                    socket_path, _DaemonRequestHandler)
+            finally:
+                os.umask(umask)
+        self._server.daemon_threads = True
+        self._server.search_daemon = self
+        return self
+
+    @property
+    def address(self):
+        """ Returns the address of the server (url or Unix socket path), to
+        be given to forward_search """
+        if isinstance(self._server, _ThreadingHTTPServer):
+            host, port = self._server.server_address[:2]
+            return "http://{}:{}".format(host, port)
+        return self._server.server_address
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """ Serve the searches in a background thread """
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stop serving, and remove the Unix socket """
+        self._server.shutdown()
+        self.close()
+
+    def close(self):
+        address = self.address
+        self._server.server_close()
+        if not address.startswith("http://") and os.path.exists(address):
+            os.unlink(address)
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    pass
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                               socketserver.UnixStreamServer):
+    pass
+
+
+class _DaemonRequestHandler(BaseHTTPRequestHandler):
+    """ Answer the requests of the SearchDaemon :
+    - GET /search?departure=&arrival=&from_date=&to_date=[&transport=]
+      [&format=csv|json]
+    - GET /status """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/status":
+            return self._send(200, json.dumps(
+                self.server.search_daemon.status()))
+        if url.path != "/search":
+            return self._send(404, json.dumps(
+                {"error": "Unknown path {}".format(url.path)}))
+        params = dict(parse_qsl(url.query))
+        output_format = params.pop("format", "csv")
+        try:
+            results = self.server.search_daemon.search(**{
+                key: value for key, value in params.items()
+                if key in _SEARCH_PARAMETERS})
+        except (KeyError, TypeError, ValueError) as e:
+            # Unknown station, missing parameter or badly formatted date
+            return self._send(400, json.dumps({"error": str(e)}))
+        except Exception as e:
+            return self._send(502, json.dumps({"error": str(e)}))
+        if output_format == "json":
+            body = json.dumps([folder_to_dict(folder)
+                               for folder in results])
+            return self._send(200, body)
+        return self._send(200, results.csv(), "text/csv; charset=utf-8",
+                          count=len(results))
+
+    def _send(self, status_code, body,
+              content_type="application/json; charset=utf-8", count=None):
+        body = body.encode("utf8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if count is not None:
+            self.send_header("X-Result-Count", str(count))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        pass  # No log for every search
+
+
+def _parse_passenger(passenger):
+    """ Returns the (firstname, lastname, birthdate) of a passenger option
+    >>> _parse_passenger("Pierre;Martin;01/01/1990")
+    ('Pierre', 'Martin', '01/01/1990')
+    """
+    fields = passenger.split(";")
+    if len(fields) != 3:
+        raise click.BadParameter(
+            "expected 'firstname;lastname;dd/mm/yyyy', received {}".format(
+                passenger))
+    return tuple(fields)
+
+
+@click.command()
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET,
+              show_default=True, help='Unix socket to listen on')
+@click.option('--port', '-p', type=int, default=None,
+              help='listen on this port of 127.0.0.1 instead of a Unix socket \
+(without authentication : any local user can search)')
+@click.option('--email', envvar="TRAINLINE_EMAIL",
+              help='email of a Trainline account (env TRAINLINE_EMAIL)')
+@click.option('--password', envvar="TRAINLINE_PASSWORD",
+              help='password of the account (env TRAINLINE_PASSWORD)')
+@click.option('--passenger', 'passengers', multiple=True,
+              help='passenger of the account (firstname;lastname;dd/mm/yyyy)')
+@click.option('--result-ttl', default=_RESULT_TTL, show_default=True,
+              help='seconds during which the results of a search are reused')
+def main(socket_path, port, email, password, passengers, result_ttl):
+    """ Run the trainline search daemon """
+    daemon = SearchDaemon(
+        email_account=email, password_account=password,
+        passengers=[_parse_passenger(passenger) for passenger in passengers],
+        result_ttl=result_ttl)
+    daemon.listen(socket_path=socket_path, port=port)
+    click.echo("Serving on {}".format(daemon.address), err=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
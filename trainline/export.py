@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Export of the search results to Arrow tables, pandas DataFrames and
+Parquet files, with typed columns built directly from the folders (see
+Folders.to_arrow, Folders.to_pandas and Folders.to_parquet) :
+- departure_date, arrival_date : timestamps with the timezone of the
+  searches (Europe/Paris)
+- price, bicycle_price : float64 (bicycle_price is null if unavailable)
+- station ids, currency, transportation_mean, carrier, travel_class :
+  dictionary encoded (categoricals in pandas)
+
+The segments table has one row per segment of every trip of the folders,
+with the folder_id and trip_id keys.
+
+Usage :
+
+    results = trainline.search(...)
+    df = results.to_pandas()
+    segments_df = results.to_pandas(segments=True)
+
+    # Many searches, written by batches of folders
+    export.write_parquet(trainline.iter_search(...), "folders.parquet",
+                         segments_path="segments.parquet")
+
+Requires pyarrow (and pandas for to_pandas) : pip install pyarrow pandas
+"""
+
+from itertools import islice
+
+import pyarrow as pa
+
+from . import _DEFAULT_SEARCH_TIMEZONE
+
+_PARQUET_BATCH_SIZE = 10000  # Folders per row group of write_parquet
+
+_TIMESTAMP = pa.timestamp("us", tz=_DEFAULT_SEARCH_TIMEZONE)
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+FOLDER_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("departure_date", _TIMESTAMP),
+    ("arrival_date", _TIMESTAMP),
+    ("duration", pa.duration("s")),
+    ("departure_station_id", _CATEGORY),
+    ("arrival_station_id", _CATEGORY),
+    ("price", pa.float64()),
+    ("currency", _CATEGORY),
+    ("transportation_mean", _CATEGORY),
+    ("carrier", _CATEGORY),
+    ("segment_nb", pa.int32()),
+    ("trip_nb", pa.int32()),
+    ("bicycle_price", pa.float64()),
+])
+
+SEGMENT_SCHEMA = pa.schema([
+    ("folder_id", pa.string()),
+    ("trip_id", pa.string()),
+    ("id", pa.string()),
+    ("position", pa.int32()),  # In the trip, from 0
+    ("departure_date", _TIMESTAMP),
+    ("arrival_date", _TIMESTAMP),
+    ("departure_station_id", _CATEGORY),
+    ("arrival_station_id", _CATEGORY),
+    ("transportation_mean", _CATEGORY),
+    ("carrier", _CATEGORY),
+    ("train_number", pa.string()),
+    ("travel_class", _CATEGORY),
+    ("bicycle_price", pa.float64()),
+])
+
+
+def _carrier(folder):
+    """ Returns the carriers of the first trip of a folder (every trip of
+    a folder has the same segments), like its transportation_mean """
+    if not folder.trips:
+        return None
+    carriers = {}
+    for segment in folder.trips[0].segments:
+        carriers[segment.carrier] = None
+    return "+".join(carriers)
+
+
+def _table(schema, columns):
+    return pa.Table.from_arrays(
+        [pa.array(columns[field.name], type=field.type) for field in schema],
+        schema=schema)
+
+
+def _bicycle_price(folder):
+    bicycle_price = getattr(folder, "bicycle_reservation", None)
+    return None if bicycle_price == "unavailable" else bicycle_price
+
+
+def folders_table(folders):
+    """ Returns the Arrow table (FOLDER_SCHEMA) of folders """
+    folders = list(folders)
+    # No transportation_mean, segment_nb and bicycle_reservation attributes
+    # for a folder without trip
+    return _table(FOLDER_SCHEMA, {
+        "id": [folder.id for folder in folders],
+        "departure_date": [folder.departure_date_obj for folder in folders],
+        "arrival_date": [folder.arrival_date_obj for folder in folders],
+        "duration": [folder.arrival_date_obj - folder.departure_date_obj
+                     for folder in folders],
+        "departure_station_id": [folder.departure_station_id
+                                 for folder in folders],
+        "arrival_station_id": [folder.arrival_station_id
+                               for folder in folders],
+        "price": [folder.price for folder in folders],
+        "currency": [folder.currency for folder in folders],
+        "transportation_mean": [getattr(folder, "transportation_mean", None)
+                                for folder in folders],
+        "carrier": [_carrier(folder) for folder in folders],
+        "segment_nb": [getattr(folder, "segment_nb", None)
+                       for folder in folders],
+        "trip_nb": [len(folder.trips) for folder in folders],
+        "bicycle_price": [_bicycle_price(folder) for folder in folders],
+    })
+
+
+def segments_table(folders):
+    """ Returns the Arrow table (SEGMENT_SCHEMA) of the segments of every
+    trip of folders """
+    rows = [(folder.id, trip.id, position, segment)
+            for folder in folders for trip in folder.trips
+            for position, segment in enumerate(trip.segments)]
+    segments = [segment for _, _, _, segment in rows]
+    return _table(SEGMENT_SCHEMA, {
+        "folder_id": [folder_id for folder_id, _, _, _ in rows],
+        "trip_id": [trip_id for _, trip_id, _, _ in rows],
+        "id": [segment.id for segment in segments],
+        "position": [position for _, _, position, _ in rows],
+        "departure_date": [segment.departure_date_obj
+                           for segment in segments],
+        "arrival_date": [segment.arrival_date_obj for segment in segments],
+        "departure_station_id": [segment.departure_station_id
+                                 for segment in segments],
+        "arrival_station_id": [segment.arrival_station_id
+                               for segment in segments],
+        "transportation_mean": [segment.transportation_mean
+                                for segment in segments],
+        "carrier": [segment.carrier for segment in segments],
+        "train_number": [segment.train_number for segment in segments],
+        "travel_class": [segment.travel_class for segment in segments],
+        "bicycle_price": [segment.bicycle_price for segment in segments],
+    })
+
+
+def write_parquet(folders, path, segments_path=None,
+                  batch_size=_PARQUET_BATCH_SIZE):
+    """ Write folders (any iterable, ex : iter_search) in a Parquet file,
+    and their segments in segments_path if given, by row groups of
+    batch_size folders (only one batch is in memory at a time).
+    Returns the number of folders written """
+    import pyarrow.parquet as pq
+    folders = iter(folders)
+    count = 0
+    folder_writer = pq.ParquetWriter(path, FOLDER_SCHEMA)
+    segment_writer = None
+    if segments_path is not None:
+        segment_writer = pq.ParquetWriter(segments_path, SEGMENT_SCHEMA)
+    try:
+        while True:
+            batch = list(islice(folders, batch_size))
+            if not batch:
+                break
+            folder_writer.write_table(folders_table(batch))
+            if segment_writer is not None:
+                segment_writer.write_table(segments_table(batch))
+            count += len(batch)
+    finally:
+        folder_writer.close()
+        if segment_writer is not None:
+            segment_writer.close()
+    return count
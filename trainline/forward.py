@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Client of the search daemon (see trainline.daemon), used by
+trainline_cli.py to forward its searches. It only needs the standard
+library, so that the CLI does not import the server (http.server,
+requests...) to find out whether a daemon is running.
+
+Usage :
+
+    from trainline import forward
+
+    if os.path.exists(forward.DEFAULT_SOCKET):
+        status, text, count = forward.forward_search(
+            forward.DEFAULT_SOCKET, departure="Toulouse Matabiau",
+            arrival="Bordeaux St-Jean", from_date="15/10/2018 08:00",
+            to_date="15/10/2018 18:00")
+"""
+
+import os
+import tempfile
+
+_FORWARD_TIMEOUT = 300  # Seconds to wait for a search of the daemon
+
+
+def _default_socket():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else "user"
+    return os.path.join(runtime_dir, "trainline-{}.sock".format(uid))
+
+
+DEFAULT_SOCKET = _default_socket()
+
+
+def _connection(address, timeout):
+    """ Returns an HTTP connection to address (url or Unix socket path) """
+    import http.client
+    import socket
+    from urllib.parse import urlsplit
+
+    if address.startswith("http://"):
+        url = urlsplit(address)
+        return http.client.HTTPConnection(url.hostname, url.port,
+                                          timeout=timeout)
+    connection = http.client.HTTPConnection("localhost", timeout=timeout)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    connection.sock = sock  # Used instead of a TCP connection
+    return connection
+
+
+def forward_search(address, output_format="csv", timeout=_FORWARD_TIMEOUT,
+                   **params):
+    """ Send a search to the daemon at address (url or Unix socket path).
+    Returns (status code, text, number of results).
+    Raises a FileNotFoundError or a ConnectionRefusedError if the daemon is
+    not running, and a socket.timeout if it does not answer in timeout
+    seconds """
+    from urllib.parse import urlencode
+
+    connection = _connection(address, timeout)
+    query = urlencode(dict(
+        {key: value for key, value in params.items() if value is not None},
+        format=output_format))
+    try:
+        connection.request("GET", "/search?" + query)
+        ret = connection.getresponse()
+        text = ret.read().decode("utf8")
+        count = ret.getheader("X-Result-Count")
+    finally:
+        connection.close()
+    return ret.status, text, int(count) if count is not None else None
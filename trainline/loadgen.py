@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Load generator, running concurrent searches against a server (a local
+trainline.stubserver by default) and reporting the throughput, the latency
+percentiles and the CPU time of the client per search.
+
+Usage :
+
+    python3 -m trainline.loadgen --searches 200 --concurrency 8 \
+--latency 0.1 --page-size 30
+    python3 -m trainline.loadgen --server http://127.0.0.1:8000
+"""
+
+import math
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from . import add_hook, remove_hook, batch, _READABLE_DATE_FORMAT
+
+_SERVER_START_TIMEOUT = 10
+
+
+def percentile(sorted_values, ratio):
+    """ Returns the percentile (nearest rank) of sorted values
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.9)
+    9
+    >>> percentile([1, 2, 3], 0.5)
+    2
+    """
+    if not sorted_values:
+        return 0
+    rank = max(1, math.ceil(ratio * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LoadReport(object):
+    """ Class to represent the results of a load test """
+
+    def __init__(self, latencies, errors, elapsed, cpu_time, folders):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.cpu_time = cpu_time
+        self.folders = folders
+
+    @property
+    def searches(self):
+        return len(self.latencies) + len(self.errors)
+
+    @property
+    def throughput(self):
+        """ Successful searches per second """
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.latencies) / self.elapsed
+
+    @property
+    def cpu_per_search(self):
+        """ CPU time (in seconds) of the client per search """
+        if not self.searches:
+            return 0.0
+        return self.cpu_time / self.searches
+
+    def percentile(self, ratio):
+        return percentile(self.latencies, ratio)
+
+    def __str__(self):
+        lines = [
+            "searches     : {} ({} errors)".format(
+                self.searches, len(self.errors)),
+            "folders      : {}".format(self.folders),
+            "elapsed      : {:.2f} s".format(self.elapsed),
+            "throughput   : {:.1f} searches/s".format(self.throughput),
+            "latency      : p50={:.0f} ms  p90={:.0f} ms  p99={:.0f} ms  "
+            "max={:.0f} ms".format(
+                *[1000 * self.percentile(ratio)
+                  for ratio in (0.5, 0.9, 0.99, 1)]),
+            "cpu/search   : {:.1f} ms".format(1000 * self.cpu_per_search),
+        ]
+        errors = {}
+        for error in self.errors:
+            errors[type(error).__name__] = \
+                errors.get(type(error).__name__, 0) + 1
+        for name, count in sorted(errors.items()):
+            lines.append("error        : {} x {}".format(count, name))
+        return "\n".join(lines)
+
+
+def run(server_url, searches=100, concurrency=4,
+        departure_station="Toulouse Matabiau",
+        arrival_station="Bordeaux St-Jean", hours=6, start_date=None):
+    """ Run the searches (hours of departures each, from start_date) with
+    batch.search_many (concurrency threads sharing a pooled session)
+    against server_url, and returns a LoadReport """
+    start_date = start_date or datetime.now().replace(
+        hour=6, minute=0, second=0, microsecond=0) + timedelta(days=7)
+    session = batch.pooled_session(concurrency, base_url=server_url)
+    params = []
+    for i in range(searches):
+        # Spread the searches over a week, like the requests of many users
+        from_date = start_date + timedelta(hours=i % (7 * 24))
+        params.append({
+            "departure_station": departure_station,
+            "arrival_station": arrival_station,
+            "from_date": from_date.strftime(_READABLE_DATE_FORMAT),
+            "to_date": (from_date + timedelta(hours=hours)).strftime(
+                _READABLE_DATE_FORMAT)})
+    lock = threading.Lock()
+    latencies, errors = [], []
+    folders = 0
+
+    def _on_span(span):
+        # Latency of the successful searches, from their "search" spans
+        if span.name == "search" and span.parent is None and \
+                span.error is None:
+            with lock:
+                latencies.append(span.duration)
+
+    add_hook(_on_span)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        for result in batch.search_many(params, trainline_session=session,
+                                        workers=concurrency):
+            if result.error is None:
+                folders += len(result.results)
+            else:
+                errors.append(result.error)
+    finally:
+        remove_hook(_on_span)
+    elapsed = time.perf_counter() - start
+    cpu_time = time.process_time() - cpu_start
+    return LoadReport(latencies, errors, elapsed, cpu_time, folders)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_server(port, process):
+    deadline = time.monotonic() + _SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The stub server exited ({})".format(
+                process.returncode))
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("The stub server did not start in {} s".format(
+        _SERVER_START_TIMEOUT))
+
+
+def start_stub_server(*stub_args):
+    """ Start a trainline.stubserver in a subprocess (so that its CPU time
+    is not counted as the client's one). Returns (process, url) """
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "trainline.stubserver", "--port", str(port)] +
+        list(stub_args))
+    try:
+        _wait_for_server(port, process)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process, "http://127.0.0.1:{}".format(port)
+
+
+@click.command()
+@click.option('--server', default=None,
+              help='url of the server (a local stub server by default)')
+@click.option('--searches', '-n', default=100, show_default=True)
+@click.option('--concurrency', '-c', default=4, show_default=True)
+@click.option('--hours', default=6, show_default=True,
+              help='hours of departures of each search')
+@click.option('--page-size', default=30, show_default=True,
+              help='folders per page of the stub server')
+@click.option('--latency', default=0.0, show_default=True,
+              help='mean latency of the stub server, in seconds')
+@click.option('--latency-distribution', default="fixed", show_default=True,
+              type=click.Choice(["fixed", "uniform", "exponential",
+                                 "lognormal"]))
+@click.option('--error-rate', default=0.0, show_default=True,
+              help='ratio of 503 errors of the stub server')
+def main(server, searches, concurrency, hours, page_size, latency,
+         latency_distribution, error_rate):
+    """ Run concurrent searches and report the throughput, the latency
+    percentiles and the CPU time per search """
+    process = None
+    if server is None:
+        process, server = start_stub_server(
+            "--page-size", str(page_size), "--latency", str(latency),
+            "--latency-distribution", latency_distribution,
+            "--error-rate", str(error_rate))
+    try:
+        report = run(server, searches=searches, concurrency=concurrency,
+                     hours=hours)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    click.echo(str(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Cumulative metrics of the trainline package, in Prometheus text format.
+
+Usage :
+
+    from trainline import metrics
+    metrics.enable()  # Start collecting metrics from every search
+    print(metrics.REGISTRY.render())  # Prometheus text exposition format
+"""
+
+import threading
+
+from . import add_hook, remove_hook
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_PAGES_BUCKETS = (1, 2, 3, 4, 5, 10, 20, 50)
+_PARSE_SPANS = ("parse.comfort_classes", "parse.segments",
+                "parse.trips", "parse.folders")
+
+
+def _format_value(value):
+    """ Format a value as expected by Prometheus
+    >>> print(_format_value(3.0))
+    3
+    >>> print(_format_value(0.25))
+    0.25
+    >>> print(_format_value(float("inf")))
+    +Inf
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    """ Format a label dict (sorted by name)
+    >>> print(_format_labels({"status_code": 200, "endpoint": "search"}))
+    {endpoint="search",status_code="200"}
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())) + "}"
+
+
+class _Metric(object):
+    """ Base class of the metrics, with one value per set of labels """
+
+    type_name = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """ Returns a list of (name, labels, value) """
+        with self._lock:
+            return [(self.name, dict(key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.type_name)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(
+                name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """ Value which can only increase """
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only be increased")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """ Value which can go up and down """
+
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, in cumulative buckets """
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, buckets=_LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def get_count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return counts[-1]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            # Copy the counts, they are updated in place by observe
+            items = [(key, (list(counts), total))
+                     for key, (counts, total) in sorted(self._values.items())]
+        for key, (counts, total) in items:
+            labels = dict(key)
+            for upper_bound, count in zip(self.buckets, counts):
+                bucket_labels = dict(labels, le=_format_value(upper_bound))
+                samples.append((self.name + "_bucket", bucket_labels, count))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """ Set of metrics, which can be rendered in Prometheus text format """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, documentation, **kwargs)
+                self._metrics[name] = metric
+            elif type(metric) is not metric_class:
+                raise TypeError("Metric {} already registered as {}".format(
+                    name, metric.type_name))
+            return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._register(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=_LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation,
+                              buckets=buckets)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """ Returns every metric in the Prometheus text exposition format """
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+
+class MetricsHook(object):
+    """ Instrumentation hook which aggregates the spans of the searches
+    into cumulative metrics of a registry """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.http_duration = registry.histogram(
+            "trainline_http_request_duration_seconds",
+            "Duration of the HTTP requests, retries included")
+        self.http_responses = registry.counter(
+            "trainline_http_responses_total",
+            "HTTP responses received, by status code")
+        self.http_retries = registry.counter(
+            "trainline_http_retries_total",
+            "HTTP requests retried after a rejected request")
+        self.http_sleep = registry.counter(
+            "trainline_http_retry_sleep_seconds_total",
+            "Time spent waiting before retrying a rejected request")
+        self.http_bytes = registry.counter(
+            "trainline_http_received_bytes_total",
+            "Bytes received in HTTP responses")
+        self.circuit_open = registry.counter(
+            "trainline_http_circuit_open_total",
+            "HTTP requests not sent because the circuit was open")
+        self.searches = registry.counter(
+            "trainline_searches_total",
+            "Searches performed")
+        self.search_duration = registry.histogram(
+            "trainline_search_duration_seconds",
+            "Duration of the searches, pagination included")
+        self.search_pages = registry.histogram(
+            "trainline_search_pages",
+            "Pages fetched per search",
+            buckets=_PAGES_BUCKETS)
+        self.parse_duration = registry.histogram(
+            "trainline_parse_duration_seconds",
+            "Duration of the parse of the search pages, by path (objects, "
+            "project, stream or executor)")
+        self.parsed_folders = registry.counter(
+            "trainline_parsed_folders_total",
+            "Folders (or rows of fields) parsed from the search pages, by "
+            "path")
+        self.folders_per_second = registry.gauge(
+            "trainline_parsed_folders_per_second",
+            "Folders parsed per second of parsing, all the paths together "
+            "(cumulative average)")
+        self.parsed_objects = registry.counter(
+            "trainline_parsed_objects_total",
+            "Objects built from the search results, by kind (objects path)")
+        self.parse_seconds = registry.counter(
+            "trainline_parse_seconds_total",
+            "Time spent building objects from the search results, by kind "
+            "(objects path)")
+        # One lookup per request sent with a session cache
+        self.cache_requests = registry.counter(
+            "trainline_cache_requests_total",
+            "Lookups in the session cache, by result (hit or miss)")
+        self.cache_hit_ratio = registry.gauge(
+            "trainline_cache_hit_ratio",
+            "Ratio of the session cache lookups which were hits")
+        self._lock = threading.Lock()
+        self._parsed_folders = 0  # All the paths together
+        self._parse_seconds = 0.0
+
+    def __call__(self, span):
+        handler = self._handlers.get(span.name)
+        if handler is not None:
+            handler(self, span)
+        elif span.name in _PARSE_SPANS:
+            self._on_parse(span)
+
+    def _on_http_post(self, span):
+        attributes = span.attributes
+        endpoint = attributes.get("endpoint", "")
+        self.http_duration.observe(span.duration, endpoint=endpoint)
+        # One response per trial, rejected ones included
+        for status_code in attributes.get("status_codes", []):
+            self.http_responses.inc(endpoint=endpoint,
+                                    status_code=status_code)
+        self.http_retries.inc(attributes.get("retries", 0),
+                              endpoint=endpoint)
+        self.http_sleep.inc(attributes.get("sleep_time", 0),
+                            endpoint=endpoint)
+        self.http_bytes.inc(attributes.get("bytes", 0), endpoint=endpoint)
+        if attributes.get("circuit_open"):
+            self.circuit_open.inc(endpoint=endpoint)
+        if "cache_hit" in attributes:
+            self._on_cache_lookup(attributes["cache_hit"])
+
+    def _on_cache_lookup(self, hit):
+        self.cache_requests.inc(result="hit" if hit else "miss")
+        hits = self.cache_requests.get(result="hit")
+        total = hits + self.cache_requests.get(result="miss")
+        self.cache_hit_ratio.set(hits / total)
+
+    def _on_search(self, span):
+        self.searches.inc(status="error" if span.error else "ok")
+        self.search_duration.observe(span.duration)
+        if "pages" in span.attributes:
+            self.search_pages.observe(span.attributes["pages"])
+
+    def _on_parse_page(self, span):
+        path = span.attributes.get("path", "")
+        count = span.attributes.get("count", 0)
+        self.parse_duration.observe(span.duration, path=path)
+        self.parsed_folders.inc(count, path=path)
+        with self._lock:
+            self._parsed_folders += count
+            self._parse_seconds += span.duration
+            if self._parse_seconds > 0:
+                self.folders_per_second.set(
+                    self._parsed_folders / self._parse_seconds)
+
+    def _on_parse(self, span):
+        kind = span.name.split(".", 1)[1]
+        self.parsed_objects.inc(span.attributes.get("count", 0), kind=kind)
+        self.parse_seconds.inc(span.duration, kind=kind)
+
+    _handlers = {
+        "http.post": _on_http_post,
+        "search": _on_search,
+        "parse": _on_parse_page,
+    }
+
+
+REGISTRY = Registry()
+_ENABLED_HOOKS = {}
+
+
+def enable(registry=REGISTRY):
+    """ Start collecting the metrics of every search in the registry
+    (idempotent). Returns the registry """
+    if id(registry) not in _ENABLED_HOOKS:
+        hook = MetricsHook(registry)
+        _ENABLED_HOOKS[id(registry)] = hook
+        add_hook(hook)
+    return registry
+
+
+def disable(registry=REGISTRY):
+    """ Stop collecting metrics in the registry """
+    hook = _ENABLED_HOOKS.pop(id(registry), None)
+    if hook is not None:
+        remove_hook(hook)
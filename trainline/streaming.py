@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Incremental parse of the search responses (search(stream=True)), with
+ijson : the comfort classes, segments, trips and folders are built while
+their arrays are read from the response stream, without holding the text
+of the response nor its whole decoded json tree.
+
+Requires ijson (pip install ijson).
+"""
+
+import ijson
+
+from . import Folder, Trip, Segment, ComfortClass, _no_intern, _value_or
+
+# Arrays of the search results, each one referencing the next one
+_ARRAYS = ("folders", "trips", "segments", "comfort_classes")
+_IDS_FIELDS = {"folders": "trip_ids", "trips": "segment_ids",
+               "segments": "comfort_class_ids"}
+_REFERENCED = {"folders": "trips", "trips": "segments",
+               "segments": "comfort_classes"}
+# Fields of the raw items read to build the objects, the only ones kept
+# while an item waits for the array it references
+_RAW_FIELDS = {
+    "folders": ("id", "departure_date", "departure_station_id",
+                "arrival_date", "arrival_station_id", "cents", "currency",
+                "trip_ids"),
+    "trips": ("id", "departure_date", "departure_station_id", "arrival_date",
+              "arrival_station_id", "cents", "currency", "segment_ids"),
+    "segments": ("id", "departure_date", "departure_station_id",
+                 "arrival_date", "arrival_station_id", "transportation_mean",
+                 "carrier", "train_number", "travel_class", "trip_id",
+                 "comfort_class_ids"),
+}
+
+
+def raw_items(stream, names=_ARRAYS):
+    """ Yields (array name, raw item) for every item of the top-level arrays
+    of names, read from a stream of json bytes, and (array name, None) at
+    the end of each array """
+    item_prefixes = {name + ".item": name for name in names}
+    builder = None
+    item_prefix = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if event == "end_map" and prefix == item_prefix:
+                yield item_prefixes[item_prefix], builder.value
+                builder = None
+        elif event == "start_map" and prefix in item_prefixes:
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            item_prefix = prefix
+        elif event == "end_array" and prefix in names:
+            yield prefix, None
+
+
+class StreamedResults(object):
+    """ Class to build the objects of search results from their raw items,
+    received in any order of the arrays.
+
+    An item is built as soon as the array it references is complete (the
+    comfort classes right away), otherwise it is kept raw until then.
+    Once an array is complete, the items of the next array which it does
+    not reference (ex : the trips of the folders rejected by the filter)
+    are dropped as they arrive """
+
+    def __init__(self, folder_filter=None, value_pool=None):
+        self.folder_filter = folder_filter
+        self.intern = value_pool.intern if value_pool is not None \
+            else _no_intern
+        self.folders = []
+        # Departure date of the last raw folder (filtered or not), to
+        # paginate the search
+        self.last_departure_date = None
+        self._built = {name: {} for name in _ARRAYS}  # id : object
+        self._pending = {name: [] for name in _ARRAYS}  # raw items
+        self._referenced_ids = {}  # array name : ids referenced
+        self._ended = set()
+        self._complete = set()  # Ended, and every item built
+
+    def add(self, name, raw_item):
+        if name == "folders":
+            self.last_departure_date = raw_item.get("departure_date")
+            if self.folder_filter is not None and \
+                    not self.folder_filter.accepts_raw(raw_item):
+                return
+        else:
+            referenced_ids = self._referenced_ids.get(name)
+            if referenced_ids is not None and \
+                    raw_item.get("id") not in referenced_ids:
+                return
+        if self._ready(name):
+            self._build(name, raw_item)
+        else:
+            self._pending[name].append({
+                field: raw_item[field] for field in _RAW_FIELDS[name]
+                if field in raw_item})
+
+    def end(self, name):
+        """ Mark the end of an array, and build the items waiting for it """
+        self._ended.add(name)
+        referenced = _REFERENCED.get(name)
+        if referenced is not None and referenced not in self._complete:
+            referenced_ids = set()
+            for raw_item in self._pending[name]:
+                referenced_ids.update(raw_item.get(_IDS_FIELDS[name]) or [])
+            self._referenced_ids[referenced] = referenced_ids
+            self._pending[referenced] = [
+                raw_item for raw_item in self._pending[referenced]
+                if raw_item.get("id") in referenced_ids]
+        for array in reversed(_ARRAYS):  # Referenced arrays first
+            if array in self._ended and self._ready(array):
+                pending, self._pending[array] = self._pending[array], []
+                for raw_item in pending:
+                    self._build(array, raw_item)
+                self._complete.add(array)
+
+    def finish(self):
+        """ Returns the folders, once the whole response has been read (the
+        arrays missing from it are considered empty) """
+        for name in _ARRAYS:
+            if name not in self._ended:
+                self.end(name)
+        if self.folder_filter is not None:
+            return self.folder_filter.filter_built(self.folders)
+        return self.folders
+
+    def _ready(self, name):
+        referenced = _REFERENCED.get(name)
+        return referenced is None or referenced in self._complete
+
+    def _build(self, name, raw_item):
+        intern = self.intern
+        if name == "comfort_classes":
+            obj = ComfortClass._from_raw(raw_item, intern)
+        elif name == "segments":
+            comfort_classes = self._built["comfort_classes"]
+            try:
+                obj = Segment._from_raw(raw_item, [
+                    comfort_classes[comfort_class_id]
+                    for comfort_class_id in _value_or(
+                        raw_item.get("comfort_class_ids"), [])
+                    if comfort_class_id in comfort_classes], intern)
+            except TypeError:
+                return  # Segment without all the required fields
+        elif name == "trips":
+            segments = self._built["segments"]
+            obj = Trip._from_raw(raw_item, [
+                segments[segment_id]
+                for segment_id in raw_item.get("segment_ids")
+                if segment_id in segments], intern)
+        else:
+            trips = self._built["trips"]
+            self.folders.append(Folder._from_raw(raw_item, [
+                trips[trip_id] for trip_id in raw_item.get("trip_ids")
+                if trip_id in trips], intern))
+            return
+        self._built[name].setdefault(obj.id, obj)
+
+
+def parse_search_results(stream, folder_filter=None, value_pool=None):
+    """ Returns a StreamedResults, with the folders of the search results
+    read from a stream of json bytes (see _get_folders for the filter and
+    the value pool) """
+    results = StreamedResults(folder_filter=folder_filter,
+                              value_pool=value_pool)
+    for name, raw_item in raw_items(stream):
+        if raw_item is None:
+            results.end(name)
+        else:
+            results.add(name, raw_item)
+    results.folders = results.finish()
+    return results
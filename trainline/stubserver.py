@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Local stand-in of the Trainline API, generating realistic search results,
+for load tests and capacity planning without the real servers.
+
+Usage :
+
+    python3 -m trainline.stubserver --port 8000 --page-size 30 \
+--latency 0.2 --error-rate 0.01
+
+    from trainline import stubserver
+    server = stubserver.StubServer(page_size=30).start()
+    session = trainline.Trainline(transport=server.transport())
+    trainline.search(..., trainline_session=session)
+    server.stop()
+"""
+
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import click
+
+from . import _SEARCH_URL, _LOGIN_URL, _DEFAULT_DATE_FORMAT, \
+    _fix_date_offset_format
+from .transport import RedirectTransport
+
+SEARCH_PATH = urlsplit(_SEARCH_URL).path
+LOGIN_PATH = urlsplit(_LOGIN_URL).path
+_VIA_STATION_IDS = ["4916", "5097", "153", "4718"]
+
+# carrier : (transportation_mean, comfort classes names)
+CARRIERS = {
+    "sncf": ("train", ["pao.default", "pao.flexible", "pao.premiere"]),
+    "ouigo": ("train", ["ouigo.standard", "ouigo.plus"]),
+    "idtgv": ("train", ["idtgv.idzen", "idtgv.idzap"]),
+    "db": ("train", ["db.flexpreis", "db.sparpreis"]),
+    "trenitalia": ("train", ["trenitalia.base", "trenitalia.economy"]),
+    "flixbus": ("coach", ["flixbus.default"]),
+    "busbud": ("coach", ["busbud.default"]),
+    "benerail": ("train", ["benerail.default"]),
+}
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+def _id(rng):
+    return "%032x" % rng.getrandbits(128)
+
+
+def _date(date_obj):
+    """ Format a date like the API (with ':' in the offset)
+    >>> from datetime import timezone
+    >>> print(_date(datetime(2018, 10, 15, 8, 49, \
+tzinfo=timezone(timedelta(hours=2)))))
+    2018-10-15T08:49:00+02:00
+    """
+    date_str = date_obj.strftime(_DEFAULT_DATE_FORMAT)
+    return date_str[:-2] + ":" + date_str[-2:]
+
+
+def _comfort_class(rng, segment_id, name):
+    comfort_class = {
+        "id": _id(rng),
+        "name": name,
+        "description": rng.choice(["Un siège standard.",
+                                   "Billet échangeable et remboursable.",
+                                   None]),
+        "title": rng.choice(["Normal", "Flexible", "Première", None]),
+        "segment_id": segment_id,
+        "condition_id": _id(rng),
+        "is_available": True,
+    }
+    if not name.startswith("benerail"):  # No options with benerail
+        extras = []
+        if rng.random() < 0.3:
+            extras.append({
+                "value": rng.choice(["bicycle_with_reservation",
+                                     "bicycle_without_reservation"]),
+                "cents": rng.choice([0, 500, 1000]),
+                "currency": "EUR"})
+        comfort_class["options"] = {"extras": extras}
+    return comfort_class
+
+
+def generate_journey(rng, departure, carriers, passengers,
+                     departure_station_id, arrival_station_id):
+    """ Returns the folder, trips, segments and comfort classes of one
+    journey (one trip per passenger), departing at departure (an aware
+    datetime) """
+    carrier = rng.choice(carriers)
+    transportation_mean, comfort_class_names = CARRIERS[carrier]
+    segment_nb = rng.choice([1, 1, 1, 2, 3])
+    legs = [departure_station_id] + \
+        rng.sample(_VIA_STATION_IDS, segment_nb - 1) + [arrival_station_id]
+    durations = [timedelta(minutes=rng.randint(40, 150))
+                 for _ in range(segment_nb)]
+    folder_id = _id(rng)
+    trips, segments, comfort_classes = [], [], []
+    folder_cents = 0
+    for _ in range(passengers):
+        trip_id = _id(rng)
+        trip_cents = rng.choice([500, 1000, 1990, 2500, 3600, 6600, 9550])
+        folder_cents += trip_cents
+        segment_ids = []
+        leg_departure = departure
+        for i in range(segment_nb):
+            segment_id = _id(rng)
+            segment_ids.append(segment_id)
+            segment_comfort_classes = [
+                _comfort_class(rng, segment_id, name)
+                for name in comfort_class_names]
+            comfort_classes += segment_comfort_classes
+            segments.append({
+                "id": segment_id,
+                "departure_date": _date(leg_departure),
+                "departure_station_id": legs[i],
+                "arrival_date": _date(leg_departure + durations[i]),
+                "arrival_station_id": legs[i + 1],
+                "transportation_mean": transportation_mean,
+                "carrier": carrier,
+                "train_name": carrier.upper(),
+                "train_number": str(rng.randint(1000, 9999)),
+                "travel_class": rng.choice(["first", "second"]),
+                "trip_id": trip_id,
+                "comfort_class_ids": [
+                    cc["id"] for cc in segment_comfort_classes],
+                "co2_emission": round(rng.random() * 10, 2),
+            })
+            leg_departure += durations[i] + timedelta(minutes=15)
+        arrival = leg_departure - timedelta(minutes=15)
+        trips.append({
+            "id": trip_id,
+            "departure_date": _date(departure),
+            "departure_station_id": departure_station_id,
+            "arrival_date": _date(arrival),
+            "arrival_station_id": arrival_station_id,
+            "cents": trip_cents,
+            "currency": "EUR",
+            "segment_ids": segment_ids,
+            "folder_id": folder_id,
+        })
+    folder = {
+        "id": folder_id,
+        "departure_date": _date(departure),
+        "departure_station_id": departure_station_id,
+        "arrival_date": _date(arrival),
+        "arrival_station_id": arrival_station_id,
+        "cents": folder_cents,
+        "currency": "EUR",
+        "trip_ids": [trip["id"] for trip in trips],
+        "is_sellable": True,
+        "travel_class": "second",
+    }
+    return folder, trips, segments, comfort_classes
+
+
+def assemble_search_results(rng, journeys, passengers):
+    """ Returns search results (as a dict) made of the journeys """
+    search_results = {"folders": [], "trips": [], "segments": [],
+                      "comfort_classes": [],
+                      "passengers": [{"id": _id(rng), "age": 38}
+                                     for _ in range(passengers)]}
+    for folder, trips, segments, comfort_classes in journeys:
+        search_results["folders"].append(folder)
+        search_results["trips"] += trips
+        search_results["segments"] += segments
+        search_results["comfort_classes"] += comfort_classes
+    return search_results
+
+
+def generate_search_results(rng, departures, carriers, passengers,
+                            departure_station_id, arrival_station_id):
+    """ Returns search results (as a dict) with one folder per departure
+    date """
+    return assemble_search_results(rng, [
+        generate_journey(rng, departure, carriers, passengers,
+                         departure_station_id, arrival_station_id)
+        for departure in departures], passengers)
+
+
+class StubServer(object):
+    """ Local HTTP server implementing the search and signin endpoints.
+
+    - page_size : folders per search page, departing every 5 to 60 minutes
+      from the requested departure date
+    - latency : mean delay of the responses (in seconds), drawn from the
+      latency_distribution (fixed, uniform, exponential or lognormal)
+    - error_rate : ratio of requests answered with a 503 error
+    - carriers : carriers of the generated journeys
+
+    The results of a request only depend on its payload and on the seed,
+    so that paginated searches are consistent """
+
+    def __init__(self, host="127.0.0.1", port=0, page_size=30, latency=0,
+                 latency_distribution="fixed", error_rate=0,
+                 carriers=None, seed=0):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise KeyError("Distribution '{}' unknown, [{}] available".format(
+                latency_distribution, ",".join(LATENCY_DISTRIBUTIONS)))
+        self.page_size = page_size
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.carriers = sorted(carriers or CARRIERS)
+        self.seed = seed
+        self.requests_nb = 0
+        self.signins_nb = 0
+        self.tokens = set()  # Tokens accepted by the search endpoint
+        self._random = random.Random(seed)  # For latencies and errors
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _StubRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def transport(self):
+        """ Returns a transport sending the requests of a Client to this
+        server """
+        return RedirectTransport(self.url)
+
+    def start(self):
+        """ Serve the requests in a background thread """
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def _delay(self):
+        """ Returns the latency of a response, and if it fails """
+        with self._lock:
+            self.requests_nb += 1
+            failed = self._random.random() < self.error_rate
+            mean = self.latency
+            if not mean:
+                delay = 0
+            elif self.latency_distribution == "uniform":
+                delay = self._random.uniform(0, 2 * mean)
+            elif self.latency_distribution == "exponential":
+                delay = self._random.expovariate(1 / mean)
+            elif self.latency_distribution == "lognormal":
+                # sigma = 0.5, mu chosen to get the requested mean
+                delay = self._random.lognormvariate(
+                    math.log(mean) - 0.125, 0.5)
+            else:
+                delay = mean
+        return delay, failed
+
+    def search_results(self, payload):
+        """ Returns the search results of a search payload """
+        search = payload["search"]
+        departure_date = search["departure_date"]
+        if departure_date[-3] == ":":
+            departure_date = _fix_date_offset_format(departure_date)
+        departure_date = datetime.strptime(departure_date,
+                                           _DEFAULT_DATE_FORMAT)
+        passengers = len(search.get("passengers") or
+                         search.get("passenger_ids") or [None])
+        rng = random.Random(zlib.crc32("{}|{}|{}|{}".format(
+            self.seed, search["departure_station_id"],
+            search["arrival_station_id"], search["departure_date"])
+            .encode("utf8")))
+        departures = []
+        departure = departure_date
+        for _ in range(self.page_size):
+            departures.append(departure)
+            departure += timedelta(minutes=rng.randint(5, 60))
+        carriers = [carrier for carrier in self.carriers
+                    if carrier in search.get("systems", self.carriers)] \
+            or self.carriers
+        return generate_search_results(
+            rng, departures, carriers, passengers,
+            search["departure_station_id"], search["arrival_station_id"])
+
+    def signin_results(self, payload):
+        """ Returns the signin results of an account, with a new token """
+        with self._lock:
+            self.signins_nb += 1
+            token = _id(self._random)
+            self.tokens.add(token)
+        rng = random.Random(zlib.crc32(
+            str(payload.get("email")).encode("utf8")))
+        card = {"id": _id(rng), "reference": "SNCF.AvantageJeune"}
+        passengers = [{
+            "id": _id(rng),
+            "first_name": first_name,
+            "last_name": "Martin",
+            "birthdate": "1990-01-0{}T00:00:00+00:00".format(i + 1),
+            "card_ids": [card["id"]] if i == 0 else [],
+        } for i, first_name in enumerate(["Pierre", "Sophie", "Enzo"])]
+        return {"meta": {"token": token}, "passengers": passengers,
+                "cards": [card]}
+
+    def accepts(self, authorization):
+        """ Returns False if the authorization header has an unknown token
+        (expired or revoked) """
+        if authorization is None:
+            return True
+        # Token token="..."
+        token = authorization.split('"')[1] if '"' in authorization else ""
+        with self._lock:
+            return token in self.tokens
+
+    def revoke_tokens(self):
+        """ Reject the tokens given so far, like expired tokens """
+        with self._lock:
+            self.tokens.clear()
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    """ Answer the requests of the StubServer """
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real servers
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        delay, failed = stub._delay()
+        if delay:
+            time.sleep(delay)
+        path = urlsplit(self.path).path
+        if failed:
+            return self._send(503, {"error": "Service unavailable"})
+        try:
+            payload = json.loads(body.decode("utf8"))
+            if path == SEARCH_PATH:
+                if not stub.accepts(self.headers.get("authorization")):
+                    return self._send(401, {"error": "Invalid token"})
+                return self._send(200, stub.search_results(payload))
+            if path == LOGIN_PATH:
+                return self._send(200, stub.signin_results(payload))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(422, {"error": str(e)})
+        return self._send(404, {"error": "Unknown path {}".format(path)})
+
+    def _send(self, status_code, content):
+        body = json.dumps(content, ensure_ascii=False).encode("utf8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No log for every request
+
+
+@click.command()
+@click.option('--host', default="127.0.0.1", show_default=True)
+@click.option('--port', '-p', default=8000, show_default=True)
+@click.option('--page-size', default=30, show_default=True,
+              help='folders per search page')
+@click.option('--latency', default=0.0, show_default=True,
+              help='mean latency of the responses, in seconds')
+@click.option('--latency-distribution', default="fixed", show_default=True,
+              type=click.Choice(LATENCY_DISTRIBUTIONS))
+@click.option('--error-rate', default=0.0, show_default=True,
+              help='ratio of requests answered with a 503 error')
+@click.option('--carrier', 'carriers', multiple=True,
+              type=click.Choice(sorted(CARRIERS)),
+              help='carrier of the journeys (all by default)')
+@click.option('--seed', default=0, show_default=True)
+def main(host, port, page_size, latency, latency_distribution, error_rate,
+         carriers, seed):
+    """ Run a local stand-in of the Trainline API """
+    server = StubServer(host=host, port=port, page_size=page_size,
+                        latency=latency,
+                        latency_distribution=latency_distribution,
+                        error_rate=error_rate, carriers=carriers, seed=seed)
+    click.echo("Serving on {}".format(server.url), err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
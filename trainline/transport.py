@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Pluggable transports of the Client, to record the requests sent to the
+servers and replay them offline (for tests and load tests).
+
+Usage :
+
+    from trainline import transport
+
+    # Record the responses of real searches
+    with transport.Cassette("searches.cassette.gz") as cassette:
+        session = trainline.Trainline(
+            transport=transport.RecordTransport(cassette))
+        trainline.search(..., trainline_session=session)
+
+    # Replay them, without network
+    cassette = transport.Cassette("searches.cassette.gz")
+    session = trainline.Trainline(
+        transport=transport.ReplayTransport(cassette, latency=0.2))
+    trainline.search(..., trainline_session=session)
+
+    # Send them to another server (ex : trainline.stubserver)
+    session = trainline.Trainline(
+        transport=transport.RedirectTransport("http://127.0.0.1:8000"))
+
+    # At most 2 requests per second, for all the threads of the session
+    session = trainline.Trainline(
+        transport=transport.ThrottledTransport(2))
+"""
+
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+from . import CachedResponse
+from . import _normalize_payload as normalize_payload
+
+
+class ReplayMissError(LookupError):
+    """ Raised when a request has not been recorded in the cassette (it is
+    not a failure of the servers, so circuit breakers ignore it) """
+    pass
+
+
+class ReplayedResponse(CachedResponse):
+    """ Class to represent a recorded response, with the attributes of a
+    requests.Response used by the Client """
+
+    def __init__(self, status_code, text, url=None):
+        super(ReplayedResponse, self).__init__(text, status_code=status_code)
+        self.url = url
+
+    def __repr__(self):
+        return "[ReplayedResponse] {} ({} bytes)".format(
+            self.status_code, len(self.content))
+
+
+class Cassette(object):
+    """ Class to represent a store of recorded responses, indexed by method,
+    url and normalized payload. It is saved as gzipped json lines """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._responses = {}
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    @staticmethod
+    def key(method, url, post_data=None):
+        return (method.upper(), url, normalize_payload(post_data))
+
+    def record(self, method, url, post_data, response):
+        with self._lock:
+            self._responses[self.key(method, url, post_data)] = \
+                ReplayedResponse(response.status_code, response.text, url)
+
+    def get(self, method, url, post_data=None):
+        """ Returns the recorded response of a request, or None """
+        return self._responses.get(self.key(method, url, post_data))
+
+    def load(self, filename):
+        with gzip.open(filename, "rt", encoding="utf8") as f:
+            for line in f:
+                entry = json.loads(line)
+                key = (entry["method"], entry["url"], entry["payload"])
+                self._responses[key] = ReplayedResponse(
+                    entry["status_code"], entry["text"], entry["url"])
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with self._lock:
+            items = sorted(self._responses.items())
+        with gzip.open(filename, "wt", encoding="utf8") as f:
+            for (method, url, payload), response in items:
+                f.write(json.dumps({
+                    "method": method,
+                    "url": url,
+                    "payload": payload,
+                    "status_code": response.status_code,
+                    "text": response.text,
+                }, ensure_ascii=False) + "\n")
+
+    def __len__(self):
+        return len(self._responses)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.filename:
+            self.save()
+        return False
+
+
+class PassthroughTransport(object):
+    """ Send the requests to the servers (default transport) """
+
+    def __init__(self, session=None):
+        self.session = session or requests.session()
+
+    def get(self, url, headers=None, timeout=None):
+        return self.session.get(url=url, headers=headers, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        return self.session.post(url=url, headers=headers, data=data,
+                                 timeout=timeout, stream=stream)
+
+
+class ThrottledTransport(object):
+    """ Send the requests with another transport (PassthroughTransport by
+    default), at most max_rate requests per second (on average, in bursts
+    of up to burst requests) : the requests wait their turn """
+
+    def __init__(self, max_rate, transport=None, burst=1):
+        from .batch import RateLimiter
+        self.transport = transport or PassthroughTransport()
+        self.limiter = RateLimiter(max_rate, burst=burst)
+
+    def get(self, url, headers=None, timeout=None):
+        self.limiter.acquire()
+        return self.transport.get(url=url, headers=headers, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        self.limiter.acquire()
+        if stream:
+            return self.transport.post(url=url, headers=headers, data=data,
+                                       timeout=timeout, stream=True)
+        return self.transport.post(url=url, headers=headers, data=data,
+                                   timeout=timeout)
+
+
+class RecordTransport(object):
+    """ Send the requests with another transport (PassthroughTransport by
+    default), and record their responses in a cassette """
+
+    def __init__(self, cassette, transport=None):
+        self.cassette = cassette
+        self.transport = transport or PassthroughTransport()
+
+    def get(self, url, headers=None, timeout=None):
+        ret = self.transport.get(url=url, headers=headers, timeout=timeout)
+        self.cassette.record("GET", url, None, ret)
+        return ret
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        # The response is read whole to be recorded
+        ret = self.transport.post(url=url, headers=headers, data=data,
+                                  timeout=timeout)
+        self.cassette.record("POST", url, data, ret)
+        return ret
+
+
+class RedirectTransport(object):
+    """ Send the requests to another server (scheme and host of base_url),
+    keeping their path. The circuit breakers still see the original urls """
+
+    def __init__(self, base_url, transport=None):
+        self.base_url = base_url
+        self.transport = transport or PassthroughTransport()
+
+    def redirect(self, url):
+        """ Returns the url on the other server
+        >>> RedirectTransport("http://127.0.0.1:8000").redirect(
+        ...     "https://www.trainline.eu/api/v5_1/search?a=1")
+        'http://127.0.0.1:8000/api/v5_1/search?a=1'
+        """
+        scheme, netloc = urlsplit(self.base_url)[:2]
+        return urlunsplit((scheme, netloc) + urlsplit(url)[2:])
+
+    def get(self, url, headers=None, timeout=None):
+        return self.transport.get(url=self.redirect(url), headers=headers,
+                                  timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        kwargs = {"stream": True} if stream else {}
+        return self.transport.post(url=self.redirect(url), headers=headers,
+                                   data=data, timeout=timeout, **kwargs)
+
+
+class ReplayTransport(object):
+    """ Serve the responses recorded in a cassette, without network.
+    Each response can be delayed by latency seconds (+/- jitter seconds),
+    to simulate the servers. A request which has not been recorded raises
+    a ReplayMissError """
+
+    def __init__(self, cassette, latency=0, jitter=0):
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+
+    def _replay(self, method, url, post_data=None):
+        ret = self.cassette.get(method, url, post_data)
+        if ret is None:
+            raise ReplayMissError(
+                "No recorded response for {} {}\n{}".format(
+                    method, url, normalize_payload(post_data)))
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return ret
+
+    def get(self, url, headers=None, timeout=None):
+        return self._replay("GET", url)
+
+    def post(self, url, headers=None, data=None, timeout=None, stream=False):
+        return self._replay("POST", url, data)
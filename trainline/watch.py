@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Price watch : polls subscribed routes on timers and reports the changes
+of their results (new departures, removed departures, price changes),
+instead of the whole results of every poll.
+
+The polls of each subscription are spread with a random jitter around its
+interval, and all the polls share a global rate budget (max_rate polls per
+second). The results of a poll are compared with the previous ones by
+departure (departure and arrival dates, transportation mean and number of
+segments), on the cheapest price of each departure. The first poll of a
+subscription only records its results.
+
+Usage :
+
+    from trainline import watch
+
+    def on_change(event):
+        print(event.kind, event.key, event.old_price, event.new_price)
+
+    watcher = watch.Watcher(max_rate=0.5)
+    watcher.subscribe("Toulouse Matabiau", "Bordeaux St-Jean",
+                      "15/10/2018 08:00", "15/10/2018 18:00", interval=600)
+    watcher.add_listener(on_change)
+    watcher.run()  # Or : for event in watcher.events(): ...
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import Trainline, search
+from .batch import RateLimiter
+
+NEW = "new"
+REMOVED = "removed"
+PRICE_CHANGED = "price_changed"
+
+_INTERVAL = 600  # Seconds between the polls of a subscription
+_JITTER = 0.1  # Random variation of the intervals (ratio)
+_MAX_RATE = 1.0  # Polls per second, for all the subscriptions
+_WORKERS = 4  # Polls running at the same time
+_IDLE_WAIT = 1.0  # Seconds between the checks of a watcher without poll
+_LOGGER = logging.getLogger(__name__)
+
+# Fields of the results read by the polls (see search(fields=...))
+_FIELDS = ("departure_date", "arrival_date", "transportation_mean",
+           "segment_nb", "price", "currency")
+
+# Change of the results of a subscription : kind (NEW, REMOVED or
+# PRICE_CHANGED), key of the departure (see departure_key), prices (None
+# for a departure which is new or removed), and row of the results (the
+# previous one for a removed departure)
+ChangeEvent = namedtuple("ChangeEvent", ["kind", "subscription", "key",
+                                         "old_price", "new_price", "row"])
+
+
+def departure_key(row):
+    """ Returns the key of a departure, shared by its different prices """
+    return (row.departure_date, row.arrival_date, row.transportation_mean,
+            row.segment_nb)
+
+
+def snapshot(rows):
+    """ Returns the cheapest row of every departure key of rows """
+    cheapest = {}
+    for row in rows:
+        key = departure_key(row)
+        if key not in cheapest or row.price < cheapest[key].price:
+            cheapest[key] = row
+    return cheapest
+
+
+def diff(old_snapshot, new_snapshot, subscription=None):
+    """ Returns the ChangeEvents between 2 snapshots, sorted by departure
+    date """
+    events = []
+    for key, row in new_snapshot.items():
+        old_row = old_snapshot.get(key)
+        if old_row is None:
+            events.append(ChangeEvent(NEW, subscription, key, None,
+                                      row.price, row))
+        elif old_row.price != row.price:
+            events.append(ChangeEvent(PRICE_CHANGED, subscription, key,
+                                      old_row.price, row.price, row))
+    for key, old_row in old_snapshot.items():
+        if key not in new_snapshot:
+            events.append(ChangeEvent(REMOVED, subscription, key,
+                                      old_row.price, None, old_row))
+    return sorted(events, key=lambda event: event.key[0])
+
+
+class Subscription(object):
+    """ Class to represent a watched route : the parameters of its search
+    (see trainline.search, without the bicycle criteria), its interval (in
+    seconds), and the snapshot of its last results """
+
+    def __init__(self, departure_station, arrival_station, from_date,
+                 to_date, interval=_INTERVAL, name=None, **search_params):
+        self.search_params = dict(
+            search_params, departure_station=departure_station,
+            arrival_station=arrival_station, from_date=from_date,
+            to_date=to_date)
+        self.interval = interval
+        self.name = name or "{} → {} ({} - {})".format(
+            departure_station, arrival_station, from_date, to_date)
+        self.snapshot = None  # Until the first poll
+        self.polls_nb = 0
+        self.errors_nb = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return "[Subscription] {} every {} s".format(self.name,
+                                                      self.interval)
+
+
+class Watcher(object):
+    """ Class to poll the subscriptions with one session, and report the
+    changes of their results (see the module documentation) """
+
+    def __init__(self, trainline_session=None, max_rate=_MAX_RATE,
+                 jitter=_JITTER, workers=_WORKERS):
+        self.session = trainline_session or Trainline()
+        self.jitter = jitter
+        self.workers = workers
+        self.limiter = RateLimiter(max_rate)
+        self._listeners = []
+        self._subscriptions = set()
+        self._schedule = []  # heap of (time of the poll, n, subscription)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def subscribe(self, departure_station, arrival_station, from_date,
+                  to_date, interval=_INTERVAL, name=None, **search_params):
+        """ Watch a route, and returns its Subscription. Its first poll is
+        scheduled in the first jitter of its interval """
+        subscription = Subscription(departure_station, arrival_station,
+                                    from_date, to_date, interval=interval,
+                                    name=name, **search_params)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            self._push(subscription, time.monotonic() + random.uniform(
+                0, self.jitter * interval))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def subscriptions(self):
+        with self._lock:
+            return list(self._subscriptions)
+
+    def add_listener(self, listener):
+        """ listener(event) is called for every ChangeEvent by run() """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def poll(self, subscription):
+        """ Search the results of a subscription, and returns their changes
+        since its last poll (ChangeEvents). A failed search is counted in
+        the subscription, and changes nothing """
+        try:
+            rows = search(trainline_session=self.session, fields=_FIELDS,
+                          **subscription.search_params)
+        except Exception as e:
+            subscription.errors_nb += 1
+            subscription.last_error = e
+            _LOGGER.warning("Poll of %s failed : %r", subscription.name, e)
+            return []
+        new_snapshot = snapshot(rows)
+        events = []
+        if subscription.snapshot is not None:
+            events = diff(subscription.snapshot, new_snapshot,
+                          subscription=subscription)
+        subscription.snapshot = new_snapshot
+        subscription.polls_nb += 1
+        return events
+
+    def events(self, duration=None):
+        """ Poll the subscriptions when they are due (in workers threads,
+        within the rate budget), and yields their ChangeEvents, during
+        duration seconds (or until stop()) """
+        self._stopped.clear()
+        deadline = None if duration is None else time.monotonic() + duration
+        running = {}  # future : subscription
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self._stopped.is_set():
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                self._submit_due(executor, running, now)
+                if len(running) >= self.workers:
+                    # No free worker for the polls due : wait for the end of
+                    # a running one (or for the deadline)
+                    timeout = None if deadline is None else deadline - now
+                else:
+                    timeout = self._next_wait(now, deadline)
+                if not running:
+                    self._stopped.wait(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    subscription = running.pop(future)
+                    self._reschedule(subscription)
+                    for event in future.result():
+                        yield event
+            # The snapshots of the running polls are updated anyway : yield
+            # their changes, rather than losing them
+            for future, subscription in running.items():
+                if not future.cancel():
+                    self._reschedule(subscription)
+                    for event in future.result():
+                        yield event
+
+    def run(self, duration=None):
+        """ Call the listeners with the events of the subscriptions, during
+        duration seconds (or until stop()) """
+        for event in self.events(duration=duration):
+            for listener in list(self._listeners):
+                try:
+                    listener(event)
+                except Exception:
+                    _LOGGER.exception("Watch listener %r failed", listener)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _push(self, subscription, poll_time):
+        heapq.heappush(self._schedule,
+                       (poll_time, next(self._counter), subscription))
+
+    def _reschedule(self, subscription):
+        interval = subscription.interval * (
+            1 + random.uniform(-self.jitter, self.jitter))
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._push(subscription, time.monotonic() + interval)
+
+    def _submit_due(self, executor, running, now):
+        """ Submit the polls which are due, within the rate budget """
+        with self._lock:
+            while self._schedule and len(running) < self.workers:
+                poll_time, _, subscription = self._schedule[0]
+                if poll_time > now:
+                    break
+                if subscription not in self._subscriptions:
+                    heapq.heappop(self._schedule)  # Unsubscribed
+                    continue
+                if not self.limiter.try_acquire():
+                    break
+                heapq.heappop(self._schedule)
+                running[executor.submit(self.poll, subscription)] = \
+                    subscription
+
+    def _next_wait(self, now, deadline):
+        """ Returns the seconds to wait for the next poll (or the end of a
+        running one) """
+        with self._lock:
+            if self._schedule:
+                wait_time = max(self._schedule[0][0] - now,
+                                self.limiter.delay())
+            else:
+                wait_time = _IDLE_WAIT
+        if deadline is not None:
+            wait_time = min(wait_time, deadline - now)
+        return max(wait_time, 0)
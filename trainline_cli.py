@@ -3,11 +3,16 @@
 
 """CLI tool for trainline."""
 import click
-import trainline
+import json
 from datetime import datetime, timedelta
 
+# trainline (and its dependencies) and cProfile are imported when a search
+# is run, so that --help and invalid options answer immediately
+
 # Usage : trainline_cli.py --help
 
+_TRANSPORTS = ('train', 'coach', 'any')
+
 
 @click.command()
 @click.option(
@@ -15,13 +20,11 @@ from datetime import datetime, timedelta
     envvar="PARAM1",
     type=str,
     help='departure station (example : Toulouse)',
-    required=True,
 )
 @click.option(
     '--arrival', '-a',
     type=str,
     help='arrival station (example : Bordeaux)',
-    required=True,
 )
 @click.option(
     '--next', '-n',
@@ -33,7 +36,7 @@ from datetime import datetime, timedelta
 )
 @click.option(
     '--transport', '-t',
-    type=click.Choice(['train', 'coach', 'any']),
+    type=click.Choice(_TRANSPORTS),
     help='get only results for the selected transportation mean',
     default='train',
     show_default=True,
@@ -43,8 +46,101 @@ from datetime import datetime, timedelta
     is_flag=True,
     help='verbose mode',
 )
-def main(departure, arrival, next, transport, verbose):
+@click.option(
+    '--timings',
+    is_flag=True,
+    help='print the duration of each phase of the search on stderr',
+)
+@click.option(
+    '--profile',
+    type=click.Path(dir_okay=False, writable=True),
+    help='write a cProfile dump of the search in this file \
+(to be read with pstats)',
+)
+@click.option(
+    '--daemon',
+    envvar="TRAINLINE_DAEMON",
+    help='forward the search to this trainline daemon (Unix socket or \
+http://host:port), by default to the daemon of the default socket when it \
+is running',
+)
+@click.option(
+    '--batch',
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help='search the routes of this CSV or JSON file (columns departure, \
+arrival, and next or from_date and to_date, transport : the options are \
+their default values), "-" for stdin',
+)
+@click.option(
+    '--workers',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help='searches run at the same time in batch mode',
+)
+@click.option(
+    '--max-rps',
+    type=click.FloatRange(min=0, min_open=True),
+    help='maximum requests per second in batch mode',
+)
+@click.option(
+    '--format', 'output_format',
+    type=click.Choice(['csv', 'ndjson']),
+    default='csv',
+    show_default=True,
+    help='output format of the results in batch mode',
+)
+@click.pass_context
+def main(ctx, departure, arrival, next, transport, verbose, timings, profile,
+         daemon, batch, workers, max_rps, output_format):
     """ Search trips with Trainline and returns it in csv """
+    if batch is not None:
+        from click.core import ParameterSource
+        # A departure from the PARAM1 environment variable is ignored
+        if arrival or (departure and ctx.get_parameter_source("departure")
+                       != ParameterSource.ENVIRONMENT):
+            raise click.UsageError(
+                "--batch cannot be used with --departure and --arrival")
+    elif not departure:
+        raise click.UsageError("Missing option '--departure' / '-d'.")
+    elif not arrival:
+        raise click.UsageError("Missing option '--arrival' / '-a'.")
+
+    # The timings and the profile are measured on a local search
+    if batch is None and not (timings or profile):
+        if _forward_search(departure, arrival, next, transport, verbose,
+                           daemon):
+            return
+
+    import trainline
+    spans = []
+    if timings:
+        trainline.add_hook(spans.append)
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if batch is not None:
+            failures_nb = _search_batch(batch, next, transport, workers,
+                                        max_rps, output_format)
+        else:
+            _search(departure, arrival, next, transport, verbose)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if timings:
+            trainline.remove_hook(spans.append)
+            click.echo(_format_timings(spans), err=True)
+    if batch is not None and failures_nb > 0:
+        ctx.exit(1)
+
+
+def _search_period(next):
+    """ Returns the from_date and the to_date of the search """
 
     # Get current datetime > from_date
     from_date_obj = datetime.now()
@@ -58,6 +154,59 @@ def main(departure, arrival, next, transport, verbose):
     # Convert the datetime objects to strings
     from_date = from_date_obj.strftime("%d/%m/%Y %H:%M")
     to_date = to_date_obj.strftime("%d/%m/%Y %H:%M")
+    return from_date, to_date
+
+
+def _forward_search(departure, arrival, next, transport, verbose, daemon):
+    """ Forward the search to the trainline daemon and print its csv.
+    Returns False if no daemon is running """
+    import os
+    from trainline import forward
+
+    if daemon is None:
+        if not os.path.exists(forward.DEFAULT_SOCKET):
+            return False
+        daemon = forward.DEFAULT_SOCKET
+
+    import socket
+
+    from_date, to_date = _search_period(next)
+    try:
+        status, text, count = forward.forward_search(
+            daemon, departure=departure, arrival=arrival,
+            from_date=from_date, to_date=to_date,
+            transport=None if transport == "any" else transport,
+            timeout=forward._FORWARD_TIMEOUT)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False  # The daemon is not running, search locally
+    except socket.timeout:
+        raise click.ClickException(
+            "The trainline daemon {} did not answer in {} s".format(
+                daemon, forward._FORWARD_TIMEOUT))
+    except OSError as e:
+        raise click.ClickException(
+            "Failed to reach the trainline daemon {} : {}".format(daemon, e))
+    if status != 200:
+        raise click.ClickException(json.loads(text)["error"])
+
+    if verbose:
+        print()
+        print("Search trips from {} to {}, between {} and {} \
+(trainline daemon {})\n".format(departure, arrival, from_date, to_date, daemon))
+
+    print(text)
+
+    if verbose:
+        print()
+        print("{} results".format(count))
+    return True
+
+
+def _search(departure, arrival, next, transport, verbose):
+    """ Search trips and print them in csv """
+    import trainline
+
+    from_date, to_date = _search_period(next)
 
     if transport == "any":
         transport = None
@@ -81,6 +230,155 @@ def main(departure, arrival, next, transport, verbose):
         print("{} results".format(len(results)))
 
 
+def _read_batch(filename):
+    """ Returns the rows (dicts) of a batch file : a json list, json
+    lines, or a CSV file with a header (delimited by ',' or ';') """
+    import csv
+    import io
+    with click.open_file(filename, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        if text.lstrip().startswith("["):
+            return json.loads(text)
+        if text.lstrip().startswith("{"):
+            return [json.loads(line) for line in text.splitlines()
+                    if line.strip()]
+    except ValueError as e:
+        raise click.BadParameter("invalid JSON : {}".format(e),
+                                 param_hint="--batch")
+    lines = text.strip().splitlines()
+    if not lines:
+        return []
+    dialect = csv.Sniffer().sniff(lines[0], delimiters=",;")
+    return list(csv.DictReader(io.StringIO(text.strip()), dialect=dialect))
+
+
+def _invalid_row(line, message):
+    return click.BadParameter("row {} {}".format(line, message),
+                              param_hint="--batch")
+
+
+def _batch_searches(rows, next, transport):
+    """ Returns the parameters of trainline.search of the batch rows (the
+    options are their default values). Raises a click.BadParameter for the
+    first invalid row """
+    searches = []
+    for line, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise _invalid_row(line, "is not an object : {!r}".format(row))
+        if not row.get("departure") or not row.get("arrival"):
+            raise _invalid_row(line, "has no departure or arrival")
+        if row.get("from_date") or row.get("to_date"):
+            from_date, to_date = row.get("from_date"), row.get("to_date")
+            for name, value in [("from_date", from_date),
+                                ("to_date", to_date)]:
+                try:
+                    datetime.strptime(value or "", "%d/%m/%Y %H:%M")
+                except (TypeError, ValueError):
+                    raise _invalid_row(line, "has an invalid {} (expected \
+dd/mm/yyyy HH:MM) : {!r}".format(name, value))
+        else:
+            try:
+                from_date, to_date = _search_period(row.get("next") or next)
+            except (TypeError, ValueError):
+                raise _invalid_row(line, "has an invalid next (example : \
+1day, 3h) : {!r}".format(row.get("next") or next))
+        row_transport = row.get("transport") or transport
+        if row_transport not in _TRANSPORTS:
+            raise _invalid_row(line, "has an unknown transport (expected \
+{}) : {!r}".format(", ".join(_TRANSPORTS), row_transport))
+        searches.append({
+            "departure_station": row["departure"],
+            "arrival_station": row["arrival"],
+            "from_date": from_date,
+            "to_date": to_date,
+            "transportation_mean":
+                None if row_transport == "any" else row_transport,
+        })
+    return searches
+
+
+def _batch_lines(params, results, output_format):
+    """ Returns the lines of the results of a batch search, with the
+    columns of the route """
+    route = (params["departure_station"], params["arrival_station"])
+    if output_format == "csv":
+        return ["{};{};{}".format(route[0], route[1], line)
+                for line in results.csv().splitlines()[1:] if line]
+    return [json.dumps({
+        "departure": route[0],
+        "arrival": route[1],
+        "departure_date": folder.departure_date,
+        "arrival_date": folder.arrival_date,
+        "duration": int((folder.arrival_date_obj -
+                         folder.departure_date_obj).total_seconds() // 60),
+        "number_of_segments": folder.segment_nb,
+        "price": folder.price,
+        "currency": folder.currency,
+        "transportation_mean": folder.transportation_mean,
+        "bicycle_reservation": folder.bicycle_reservation,
+    }, ensure_ascii=False) for folder in results]
+
+
+def _search_batch(filename, next, transport, workers, max_rps,
+                  output_format):
+    """ Search the routes of a batch file concurrently, and print their
+    results as soon as each route is done (progress and failures on
+    stderr). Returns the number of failed routes """
+    from trainline import batch
+
+    searches = _batch_searches(_read_batch(filename), next, transport)
+    if output_format == "csv":
+        click.echo("departure;arrival;departure_date;arrival_date;duration;\
+number_of_segments;price;currency;transportation_mean;bicycle_reservation")
+    session = batch.pooled_session(workers, max_rate=max_rps)
+    failures_nb = 0
+    for done, result in enumerate(batch.search_many(
+            searches, trainline_session=session, workers=workers), start=1):
+        route = "[{}/{}] {} → {} ({} - {})".format(
+            done, len(searches), result.params["departure_station"],
+            result.params["arrival_station"], result.params["from_date"],
+            result.params["to_date"])
+        if result.error is not None:
+            failures_nb += 1
+            click.echo("{} failed : {!r}".format(route, result.error),
+                       err=True)
+            continue
+        for line in _batch_lines(result.params, result.results,
+                                 output_format):
+            click.echo(line)
+        click.echo("{} : {} results".format(route, len(result.results)),
+                   err=True)
+    click.echo("{} routes searched, {} failed".format(len(searches),
+                                                      failures_nb), err=True)
+    return failures_nb
+
+
+def _format_timings(spans):
+    """ Returns a table of the spans durations, in their starting order,
+    and indented by nesting level """
+    lines = ["{:<40} {:>10}".format("phase", "seconds")]
+    counters = {}
+    # perf_counter is monotonic and precise : a parent always starts
+    # strictly before its children
+    for span in sorted(spans, key=lambda span: span.perf_start):
+        depth = 0
+        parent = span.parent
+        while parent is not None:
+            depth += 1
+            parent = parent.parent
+        name = span.name
+        if span.name in ("http.post", "json_decode"):
+            counters[span.name] = counters.get(span.name, 0) + 1
+            name = "{} #{}".format(span.name, counters[span.name])
+        details = ", ".join("{}={}".format(key, value)
+                            for key, value in sorted(span.attributes.items())
+                            if key != "url")
+        lines.append("{:<40} {:>10.4f}  {}".format(
+            "  " * depth + name, span.duration, details).rstrip())
+    return "\n".join(lines)
+
+
 def _decode_next_param(next_param):
         """ From a 'next' string, returns a timedelta object
         >>> print(_decode_next_param("1day"))